@@ -0,0 +1,488 @@
+# bench.py
+"""Load-testing and benchmark suite for the license server.
+
+    python bench.py seed --db bench.db --licenses 100000 --activated 0.6 --messages 20
+    python bench.py run --db bench.db --mode inprocess --concurrency 32 --duration 10
+    python bench.py run --db bench.db --mode uvicorn --save-baseline bench_baseline.json
+    python bench.py run --db bench.db --mode uvicorn --compare bench_baseline.json
+    python bench.py serialize --rows 10000
+
+`seed` fills a database with synthetic licenses, activations and chat
+history. `run` drives each endpoint scenario for --duration seconds with
+--concurrency closed-loop clients and reports throughput and p50/p95/p99
+latency. In "inprocess" mode requests go straight into the ASGI app (no
+sockets, measures the handler + database path); in "uvicorn" mode a local
+server is started on the seeded database and clients talk HTTP/1.1
+keep-alive to it. No HTTP client library is required for either mode.
+
+`serialize` times turning --rows chat message rows into a JSON response
+body the way list endpoints used to (tuple rows -> dicts -> FastAPI's
+jsonable_encoder -> JSONResponse) against the current path
+(responses.record_factory rows -> JSONBytesResponse).
+
+With --compare the run fails (exit status 1) when an endpoint's p95 latency
+rises or its throughput drops by more than --tolerance relative to the
+stored baseline.
+"""
+from datetime import datetime, timedelta
+import argparse
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# ---------------------------------------------------------------- seeding
+
+def seed(path: str, licenses: int, activated: float, messages: int, unread: float, rng_seed: int = 1):
+    """Create (or extend) a database with synthetic data"""
+    import database
+
+    rng = random.Random(rng_seed)
+    now = datetime.now()
+    conn = database.open_connection(path)
+    database.migrate(conn)
+
+    started = time.perf_counter()
+    rows, bound = [], []
+    for i in range(licenses):
+        key = f"AWC-{rng.getrandbits(48):012X}-{rng.getrandbits(32):08X}"
+        created_at = now - timedelta(days=rng.uniform(0, 365))
+        expires_at = created_at + timedelta(days=rng.choice((30, 90, 365, 730)))
+        hwid, last_used, used_count = "", None, 0
+        if rng.random() < activated:
+            hwid = f"HWID-{i:08d}"
+            last_used = (now - timedelta(minutes=rng.uniform(0, 60 * 24 * 30))).isoformat()
+            used_count = rng.randint(1, 500)
+            bound.append((key, hwid))
+        rows.append((key, created_at.isoformat(), expires_at.isoformat(), int(rng.random() > 0.05),
+                     hwid, used_count, last_used, f"customer {i % 1000}", f"customer{i % 1000}@example.com"))
+    with conn:
+        conn.executemany("""INSERT OR IGNORE INTO licenses
+                            (key, created_at, expires_at, is_active, hwid, used_count, last_used, customer_name, customer_email)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""", rows)
+
+    chat = []
+    for key, hwid in bound:
+        count = rng.randint(0, 2 * messages)
+        sent_at = now - timedelta(days=30)
+        for n in range(count):
+            sent_at += timedelta(minutes=rng.uniform(1, 600))
+            sender = "user" if rng.random() < 0.6 else "admin"
+            is_read = 0 if (sender == "user" and n >= count - 3 and rng.random() < unread) else 1
+            chat.append((key, hwid, f"message {n} from {sender}", sender, sent_at.isoformat(), is_read))
+        if len(chat) >= 50000:
+            with conn:
+                conn.executemany("""INSERT INTO chat_messages (license_key, hwid, message, sender_type, timestamp, is_read)
+                                    VALUES (?, ?, ?, ?, ?, ?)""", chat)
+            chat = []
+    with conn:
+        conn.executemany("""INSERT INTO chat_messages (license_key, hwid, message, sender_type, timestamp, is_read)
+                            VALUES (?, ?, ?, ?, ?, ?)""", chat)
+        conn.execute("ANALYZE")
+
+    totals = conn.execute("""SELECT (SELECT COUNT(*) FROM licenses), (SELECT COUNT(*) FROM chat_messages)""").fetchone()
+    conn.close()
+    print(f"seeded {path}: {totals[0]} licenses, {totals[1]} messages in {time.perf_counter() - started:.1f}s")
+
+# ---------------------------------------------------------------- drivers
+
+class ASGIDriver:
+    """Minimal in-process ASGI client: lifespan + one http request per call"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __aenter__(self):
+        self._lifespan_in = asyncio.Queue()
+        self._lifespan_out = asyncio.Queue()
+        self._lifespan = asyncio.create_task(self.app({"type": "lifespan", "asgi": {"version": "3.0"}},
+                                                      self._lifespan_in.get, self._lifespan_out.put))
+        await self._lifespan_in.put({"type": "lifespan.startup"})
+        message = await self._lifespan_out.get()
+        if message["type"] != "lifespan.startup.complete":
+            raise RuntimeError(f"application startup failed: {message}")
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._lifespan_in.put({"type": "lifespan.shutdown"})
+        await self._lifespan_out.get()
+        await self._lifespan
+
+    async def request(self, method: str, path: str, body: bytes = b"", headers: dict = None):
+        path, _, query = path.partition("?")
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": method,
+            "scheme": "http",
+            "path": path,
+            "raw_path": path.encode(),
+            "query_string": query.encode(),
+            "root_path": "",
+            "headers": [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()],
+            "client": ("127.0.0.1", 50000),
+            "server": ("bench", 80),
+        }
+        done = asyncio.Event()
+        state = {"sent": False, "status": None, "body": []}
+
+        async def receive():
+            if not state["sent"]:
+                state["sent"] = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            await done.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                state["status"] = message["status"]
+            elif message["type"] == "http.response.body":
+                state["body"].append(message.get("body", b""))
+                if not message.get("more_body", False):
+                    done.set()
+
+        await self.app(scope, receive, send)
+        done.set()
+        return state["status"], b"".join(state["body"])
+
+class HTTPDriver:
+    """HTTP/1.1 keep-alive client on asyncio streams; one connection per client"""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self._reader = None
+        self._writer = None
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._reader = self._writer = None
+
+    async def request(self, method: str, path: str, body: bytes = b"", headers: dict = None):
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {self.host}:{self.port}"]
+        lines += [f"{k}: {v}" for k, v in (headers or {}).items()]
+        lines.append(f"Content-Length: {len(body)}")
+        self._writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + body)
+        await self._writer.drain()
+
+        status = int((await self._reader.readline()).split()[1])
+        response_headers = {}
+        while True:
+            line = await self._reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode().partition(":")
+            response_headers[name.strip().lower()] = value.strip()
+
+        if response_headers.get("transfer-encoding") == "chunked":
+            chunks = []
+            while True:
+                size = int((await self._reader.readline()).strip(), 16)
+                chunk = await self._reader.readexactly(size + 2)
+                if size == 0:
+                    break
+                chunks.append(chunk[:-2])
+            data = b"".join(chunks)
+        else:
+            data = await self._reader.readexactly(int(response_headers.get("content-length", 0)))
+        if response_headers.get("connection") == "close":
+            await self.close()
+        return status, data
+
+# ---------------------------------------------------------------- scenarios
+
+class Workload:
+    """Request factories for each benchmarked endpoint, sampled from the seeded data"""
+
+    def __init__(self, db_path: str, rng_seed: int = 2):
+        conn = sqlite3.connect(db_path)
+        self.bound = conn.execute("""SELECT key, hwid FROM licenses
+                                     WHERE is_active = 1 AND hwid != '' AND expires_at > ?
+                                     ORDER BY RANDOM() LIMIT 10000""", (datetime.now().isoformat(),)).fetchall()
+        conn.close()
+        if not self.bound:
+            raise SystemExit(f"{db_path} has no activated licenses; run `python bench.py seed` first")
+        self.rng = random.Random(rng_seed)
+        self.admin_headers = {}
+
+    def check_license(self):
+        key, hwid = self.rng.choice(self.bound)
+        return "POST", "/api/check_license", json.dumps({"key": key, "hwid": hwid}).encode(), \
+            {"Content-Type": "application/json"}
+
+    def get_messages(self):
+        key, _ = self.rng.choice(self.bound)
+        return "GET", f"/api/get_messages?license_key={key}&limit=50", b"", {}
+
+    def get_active_users(self):
+        return "GET", "/api/get_active_users?limit=100", b"", self.admin_headers
+
+    def admin_stats(self):
+        return "GET", "/api/admin/stats", b"", self.admin_headers
+
+SCENARIOS = ("check_license", "get_messages", "get_active_users", "admin_stats")
+
+def percentile(sorted_values: list, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+async def drive(make_client, workload: Workload, scenario: str, concurrency: int,
+                duration: float, warmup: float) -> dict:
+    """Run one scenario with `concurrency` closed-loop clients; returns its summary"""
+    factory = getattr(workload, scenario)
+    latencies, errors = [], {}
+    recording_from = time.perf_counter() + warmup
+    deadline = recording_from + duration
+
+    async def client():
+        driver = make_client()
+        try:
+            while True:
+                method, path, body, headers = factory()
+                started = time.perf_counter()
+                if started >= deadline:
+                    return
+                status, _ = await driver.request(method, path, body, headers)
+                finished = time.perf_counter()
+                if started < recording_from:
+                    continue
+                if status >= 400:
+                    errors[status] = errors.get(status, 0) + 1
+                latencies.append(finished - started)
+        finally:
+            if hasattr(driver, "close"):
+                await driver.close()
+
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput": round(len(latencies) / duration, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+    }
+
+async def admin_login(driver) -> dict:
+    status, body = await driver.request("POST", "/api/admin/login",
+                                        json.dumps({"username": "admin", "password": "admin123"}).encode(),
+                                        {"Content-Type": "application/json"})
+    if status != 200:
+        raise SystemExit(f"admin login failed ({status}): {body[:200]!r}")
+    return {"Authorization": f"Bearer {json.loads(body)['access_token']}"}
+
+async def run_inprocess(args, workload: Workload, scenarios) -> dict:
+    import server  # DATABASE_PATH đã được đặt trước khi import
+
+    results = {}
+    async with ASGIDriver(server.app) as driver:
+        workload.admin_headers = await admin_login(driver)
+        for scenario in scenarios:
+            results[scenario] = await drive(lambda: driver, workload, scenario,
+                                            args.concurrency, args.duration, args.warmup)
+            report_line(scenario, results[scenario])
+    return results
+
+async def run_uvicorn(args, workload: Workload, scenarios) -> dict:
+    env = dict(os.environ, DATABASE_PATH=os.path.abspath(args.db))
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1",
+                               "--port", str(args.port), "--log-level", "warning", "--no-access-log"],
+                              cwd=ROOT, env=env, stdout=subprocess.DEVNULL)
+    try:
+        for _ in range(100):
+            try:
+                probe = HTTPDriver("127.0.0.1", args.port)
+                await probe.request("GET", "/api/status")
+                await probe.close()
+                break
+            except OSError:
+                await asyncio.sleep(0.1)
+        else:
+            raise SystemExit("uvicorn did not start")
+
+        login = HTTPDriver("127.0.0.1", args.port)
+        workload.admin_headers = await admin_login(login)
+        await login.close()
+
+        results = {}
+        for scenario in scenarios:
+            results[scenario] = await drive(lambda: HTTPDriver("127.0.0.1", args.port), workload, scenario,
+                                            args.concurrency, args.duration, args.warmup)
+            report_line(scenario, results[scenario])
+        return results
+    finally:
+        server.terminate()
+        server.wait()
+
+# ---------------------------------------------------------------- serialization
+
+def serialize(rows: int, repeat: int):
+    """Per-path cost of building and encoding a get_messages style body from `rows` rows"""
+    from fastapi.encoders import jsonable_encoder
+    from starlette.responses import JSONResponse
+    import responses
+
+    rng = random.Random(3)
+    conn = sqlite3.connect(":memory:")
+    conn.execute("""CREATE TABLE chat_messages (id INTEGER PRIMARY KEY, license_key TEXT, hwid TEXT,
+                    message TEXT, sender_type TEXT, timestamp TEXT, is_read INTEGER)""")
+    now = datetime.now()
+    conn.executemany("INSERT INTO chat_messages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     [(i, f"AWC-{i % 997:012X}-0000ABCD", f"HWID-{i % 997:08d}",
+                       f"Tin nhắn số {i}: xin hỗ trợ kích hoạt bản quyền " + "x" * rng.randint(0, 80),
+                       rng.choice(("user", "admin")), (now - timedelta(minutes=i)).isoformat(), i % 2)
+                      for i in range(rows)])
+    sql = "SELECT id, license_key, hwid, message, sender_type, timestamp, is_read FROM chat_messages"
+    fields = ("id", "license_key", "hwid", "message", "sender_type", "timestamp", "is_read")
+    record = responses.record_factory(*fields, bools=("is_read",))
+
+    def before():
+        messages = [{"id": m[0], "license_key": m[1], "hwid": m[2], "message": m[3], "sender_type": m[4],
+                     "timestamp": m[5], "is_read": bool(m[6])} for m in conn.execute(sql).fetchall()]
+        built = time.perf_counter()
+        return built, JSONResponse(jsonable_encoder({"messages": messages})).body
+
+    def after():
+        cursor = conn.cursor()
+        cursor.row_factory = record
+        messages = cursor.execute(sql).fetchall()
+        built = time.perf_counter()
+        return built, responses.JSONBytesResponse({"messages": messages}).body
+
+    encoder = "orjson" if responses.orjson is not None else "json"
+    print(f"{rows} rows, best of {repeat}, encoder={encoder}")
+    print(f"{'path':<8} {'build ms':>9} {'encode ms':>10} {'total ms':>9} {'per 10k ms':>11} {'bytes':>9}")
+    bodies = {}
+    for name, path in (("before", before), ("after", after)):
+        best = None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            built, body = path()
+            done = time.perf_counter()
+            if best is None or done - started < best[0] + best[1]:
+                best = (built - started, done - built)
+        bodies[name] = body
+        total = sum(best)
+        print(f"{name:<8} {best[0] * 1000:>9.2f} {best[1] * 1000:>10.2f} {total * 1000:>9.2f} "
+              f"{total * 1000 * 10000 / rows:>11.2f} {len(body):>9}")
+    if json.loads(bodies["before"]) != json.loads(bodies["after"]):
+        raise SystemExit("serialized bodies differ")
+
+# ---------------------------------------------------------------- reporting
+
+def report_header():
+    print(f"{'endpoint':<20} {'requests':>9} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}  errors")
+
+def report_line(name: str, result: dict):
+    print(f"{name:<20} {result['requests']:>9} {result['throughput']:>9} {result['p50_ms']:>9} "
+          f"{result['p95_ms']:>9} {result['p99_ms']:>9}  {result['errors'] or ''}")
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Return a list of regression descriptions (empty when within tolerance)"""
+    regressions = []
+    for name, base in baseline["results"].items():
+        current = results.get(name)
+        if current is None:
+            continue
+        if current["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {base['p95_ms']} -> {current['p95_ms']} ms")
+        if current["throughput"] < base["throughput"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {base['throughput']} -> {current['throughput']} req/s")
+        if current["errors"] and not base["errors"]:
+            regressions.append(f"{name}: errors {current['errors']}")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="License server benchmark suite")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    seed_cmd = commands.add_parser("seed", help="fill a database with synthetic data")
+    seed_cmd.add_argument("--db", default="bench.db")
+    seed_cmd.add_argument("--licenses", type=int, default=100000)
+    seed_cmd.add_argument("--activated", type=float, default=0.6, help="fraction of licenses bound to a HWID")
+    seed_cmd.add_argument("--messages", type=int, default=20, help="average chat messages per activated license")
+    seed_cmd.add_argument("--unread", type=float, default=0.1, help="chance that a conversation ends unread")
+    seed_cmd.add_argument("--seed", type=int, default=1)
+
+    run_cmd = commands.add_parser("run", help="benchmark the endpoints")
+    run_cmd.add_argument("--db", default="bench.db")
+    run_cmd.add_argument("--mode", choices=("inprocess", "uvicorn"), default="inprocess")
+    run_cmd.add_argument("--scenarios", default=",".join(SCENARIOS))
+    run_cmd.add_argument("--concurrency", type=int, default=16)
+    run_cmd.add_argument("--duration", type=float, default=10, help="measured seconds per endpoint")
+    run_cmd.add_argument("--warmup", type=float, default=1, help="unmeasured seconds before each endpoint")
+    run_cmd.add_argument("--port", type=int, default=8799)
+    run_cmd.add_argument("--save-baseline", metavar="PATH")
+    run_cmd.add_argument("--compare", metavar="PATH")
+    run_cmd.add_argument("--tolerance", type=float, default=0.25, help="allowed relative regression")
+
+    serialize_cmd = commands.add_parser("serialize", help="time JSON serialization of a list response")
+    serialize_cmd.add_argument("--rows", type=int, default=10000)
+    serialize_cmd.add_argument("--repeat", type=int, default=20)
+
+    args = parser.parse_args(argv)
+    if args.command == "serialize":
+        sys.path.insert(0, ROOT)
+        serialize(args.rows, args.repeat)
+        return 0
+    os.chdir(ROOT)
+    sys.path.insert(0, ROOT)
+    # database.py / server.py đọc DATABASE_PATH lúc import
+    os.environ["DATABASE_PATH"] = os.path.abspath(args.db)
+    # Mọi client của bench đi từ một địa chỉ: tắt rate limit của check_license
+    for name in ("CHECK_RATE_IP", "CHECK_RATE_KEY", "CHECK_RATE_HWID"):
+        os.environ.setdefault(name, "0")
+
+    if args.command == "seed":
+        seed(args.db, args.licenses, args.activated, args.messages, args.unread, args.seed)
+        return 0
+
+    if not os.path.exists(args.db):
+        raise SystemExit(f"{args.db} does not exist; run `python bench.py seed --db {args.db}` first")
+    scenarios = [s for s in args.scenarios.split(",") if s]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    workload = Workload(args.db)
+    print(f"mode={args.mode} concurrency={args.concurrency} duration={args.duration}s db={args.db}")
+    report_header()
+    runner = run_inprocess if args.mode == "inprocess" else run_uvicorn
+    results = asyncio.run(runner(args, workload, scenarios))
+
+    meta = {"mode": args.mode, "concurrency": args.concurrency, "duration": args.duration,
+            "recorded_at": datetime.now().isoformat()}
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump({"meta": meta, "results": results}, f, indent=2)
+        print(f"baseline saved to {args.save_baseline}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if (baseline["meta"]["mode"], baseline["meta"]["concurrency"]) != (args.mode, args.concurrency):
+            print(f"warning: baseline was recorded with mode={baseline['meta']['mode']} "
+                  f"concurrency={baseline['meta']['concurrency']}")
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+        print(f"no regressions beyond {args.tolerance:.0%} against {args.compare}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,184 @@
+# cluster.py
+"""Change bus keeping in-process state consistent across server workers.
+
+With WORKERS > 1 every worker process has its own license cache, stats
+counters, SSE hub and revocation marks. Handlers report state changes with
+bus.emit(kind, *args) instead of touching those objects directly: the
+registered handler runs in the calling process right away and, when the bus
+is enabled, the change is appended to the change_log table. A background
+thread in every worker writes its pending changes and applies the rows other
+workers wrote since its last poll, so a change is visible everywhere within
+about BUS_POLL_MS.
+
+Arguments must be JSON-serializable. change_log ids come from AUTOINCREMENT
+under SQLite's single writer, so they are never reused and a worker only
+sees a gap if rows it had not read yet were purged (it was stalled for more
+than BUS_RETENTION_SECONDS); it then runs the resync callbacks, e.g. clearing
+caches, instead of trusting state it may have missed.
+
+With a single worker the bus is disabled and emit() is a plain local call.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+import database
+import metrics
+
+WORKERS = int(os.getenv("WORKERS", 1))
+BUS_POLL_MS = float(os.getenv("BUS_POLL_MS", 50))
+BUS_RETENTION_SECONDS = float(os.getenv("BUS_RETENTION_SECONDS", 300))
+
+log = metrics.StructuredLogger("license_server")
+
+class ChangeBus:
+    """Local dispatch of state changes plus propagation through change_log"""
+
+    def __init__(self, enabled: bool, poll_ms: float, retention: float):
+        self.enabled = enabled
+        self.poll_interval = poll_ms / 1000
+        self.retention = retention
+        self.origin = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._handlers = {}
+        self._resync = []
+        self._pending = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._applying = threading.local()
+        self._last_id = None
+        self._purged_at = 0.0
+        self.emitted = 0
+        self.published = 0
+        self.received = 0
+        self.resyncs = 0
+        self.failed_polls = 0
+
+    def register(self, kind: str, handler):
+        """handler(*args) applies a change of this kind to local state"""
+        self._handlers[kind] = handler
+
+    @property
+    def change_id(self):
+        """change_log id of the change a handler is applying in this thread; None for a local emit"""
+        return getattr(self._applying, "change_id", None)
+
+    def on_resync(self, callback):
+        """callback() is run when changes from other workers may have been missed"""
+        self._resync.append(callback)
+
+    def emit(self, kind: str, *args):
+        """Apply a change locally and, in multi-worker mode, queue it for the other workers"""
+        self._handlers[kind](*args)
+        self.emitted += 1
+        if self.enabled:
+            payload = json.dumps(args, separators=(",", ":"))
+            with self._lock:
+                self._pending.append((kind, payload))
+            self._wakeup.set()
+
+    def poll(self) -> int:
+        """Write pending changes, then apply those of other workers; returns how many were applied"""
+        with self._lock:
+            pending, self._pending = self._pending, []
+
+        try:
+            with database.transaction() as conn:
+                if pending:
+                    now = int(time.time())
+                    conn.executemany("INSERT INTO change_log (origin, kind, payload, created_ts) VALUES (?, ?, ?, ?)",
+                                     [(self.origin, kind, payload, now) for kind, payload in pending])
+                rows = conn.execute("SELECT id, origin, kind, payload FROM change_log WHERE id > ? ORDER BY id",
+                                    (self._last_id,)).fetchall()
+                if time.monotonic() - self._purged_at > self.retention / 2:
+                    conn.execute("DELETE FROM change_log WHERE created_ts < ?", (int(time.time() - self.retention),))
+                    self._purged_at = time.monotonic()
+        except sqlite3.Error:
+            # Trả lại các thay đổi chưa ghi, lần poll sau ghi tiếp
+            with self._lock:
+                self._pending[:0] = pending
+            raise
+        self.published += len(pending)
+
+        if rows and rows[0][0] > self._last_id + 1:
+            self._run_resync()
+
+        applied = 0
+        for change_id, origin, kind, payload in rows:
+            self._last_id = change_id
+            if origin == self.origin:
+                continue
+            handler = self._handlers.get(kind)
+            if handler is None:
+                continue  # worker phiên bản khác gửi loại thay đổi mình không biết
+            self._applying.change_id = change_id
+            try:
+                handler(*json.loads(payload))
+            finally:
+                self._applying.change_id = None
+            applied += 1
+        self.received += applied
+        return applied
+
+    def _sequence(self) -> int:
+        # Bắt đầu từ id lớn nhất từng cấp (kể cả đã purge), không đọc lại lịch sử cũ
+        with database.connection() as conn:
+            row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'change_log'").fetchone()
+        return row[0] if row else 0
+
+    def _run_resync(self):
+        self.resyncs += 1
+        for callback in self._resync:
+            callback()
+
+    def start(self):
+        if not self.enabled or self._thread is not None:
+            return
+        self._last_id = self._sequence()
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="change-bus", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopping.set()
+            self._wakeup.set()
+            self._thread.join()
+            self._thread = None
+            # Gửi nốt thay đổi còn chờ trước khi worker thoát
+            try:
+                self.poll()
+            except sqlite3.Error as e:
+                log.error("change_bus_db_error", error=str(e))
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "workers": WORKERS,
+            "origin": self.origin,
+            "poll_ms": self.poll_interval * 1000,
+            "pending": len(self._pending),
+            "last_id": self._last_id,
+            "emitted": self.emitted,
+            "published": self.published,
+            "received": self.received,
+            "resyncs": self.resyncs,
+            "failed_polls": self.failed_polls
+        }
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            try:
+                self.poll()
+            except Exception as e:
+                # Thread chết thì worker lệch trạng thái âm thầm: log rồi poll tiếp
+                log.error("change_bus_poll_failed", error=repr(e))
+                self.failed_polls += 1
+
+bus = ChangeBus(WORKERS > 1, BUS_POLL_MS, BUS_RETENTION_SECONDS)
@@ -0,0 +1,801 @@
+# database.py
+"""SQLite access layer shared by every handler in server.py.
+
+Connections are opened once, configured for concurrent use (WAL journal,
+synchronous=NORMAL, busy timeout, mmap and page cache) and handed out from a
+pool instead of calling sqlite3.connect() per request. Each pooled connection
+keeps its own compiled-statement cache, so the fixed SQL strings used by the
+handlers are prepared once per connection and reused afterwards.
+
+The schema is owned by MIGRATIONS below: migrate() records the applied
+version in schema_version and runs the missing steps in order at startup.
+
+Async handlers never touch a connection directly: they pass a function to
+run() / run_transaction(), which executes it on a dedicated thread pool.
+Every call names a lane, and each lane has its own concurrency limit so a
+large admin scan cannot take the threads license checks depend on.
+
+With DB_METRICS=1 (the default) connections are InstrumentedConnection:
+every statement is timed and counted per "<VERB> <table>" label, rows read
+through fetch*() and rows changed by DML are counted, and "database is
+locked" failures are recorded. The sqlite3 module does not expose SQLite's
+busy handler, so waiting for the write lock shows up as the duration of
+BEGIN IMMEDIATE / COMMIT (sqlite_lock_wait_seconds) rather than as a retry
+count.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Optional
+import asyncio
+import calendar
+import functools
+import os
+import queue
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+import metrics
+
+DATABASE_PATH = os.getenv("DATABASE_PATH", "licenses.db")
+DB_WORKERS = int(os.getenv("DB_WORKERS", 8))
+# Thêm connection cho các thread nền (usage flush...) ngoài executor
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", DB_WORKERS + 2))
+POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", 10000))
+MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", 256 * 1024 * 1024))
+CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", 16 * 1024))
+STATEMENT_CACHE_SIZE = 256
+DB_METRICS = os.getenv("DB_METRICS", "1") == "1"
+
+log = metrics.StructuredLogger("license_server")
+
+sql_statements = metrics.registry.counter(
+    "sqlite_statements_total", "SQL statements executed", ("statement",))
+sql_latency = metrics.registry.histogram(
+    "sqlite_statement_duration_seconds", "SQL statement execution time", ("statement",), metrics.SQL_BUCKETS)
+sql_rows = metrics.registry.counter(
+    "sqlite_rows_total", "Rows fetched by queries or changed by DML", ("statement",))
+sql_busy = metrics.registry.counter(
+    "sqlite_busy_errors_total", "Statements that failed with database is locked / busy", ("statement",))
+sql_lock_wait = metrics.registry.histogram(
+    "sqlite_lock_wait_seconds", "Time spent in BEGIN IMMEDIATE / COMMIT waiting for the write lock",
+    ("statement",), metrics.SQL_BUCKETS)
+
+_TABLE_RE = re.compile(r"\b(?:FROM|INTO|UPDATE)\s+([\w.]+)", re.IGNORECASE)
+
+@functools.lru_cache(maxsize=1024)
+def statement_label(sql: str) -> str:
+    """Low-cardinality label for a statement: "SELECT licenses", "COMMIT", ..."""
+    words = sql.split(None, 2)
+    verb = words[0].upper() if words else "?"
+    if verb == "BEGIN" and len(words) > 1:
+        return f"BEGIN {words[1].upper()}"
+    match = _TABLE_RE.search(sql)
+    return f"{verb} {match.group(1)}" if match else verb
+
+def _observe(label: str, started: float, rows: int):
+    elapsed = time.perf_counter() - started
+    sql_statements.inc(label)
+    sql_latency.observe(elapsed, label)
+    if rows > 0:
+        sql_rows.inc(label, amount=rows)
+    if label in ("BEGIN IMMEDIATE", "COMMIT"):
+        sql_lock_wait.observe(elapsed, label)
+
+def _observe_error(label: str, error: sqlite3.Error):
+    if isinstance(error, sqlite3.OperationalError) and ("locked" in str(error) or "busy" in str(error)):
+        sql_busy.inc(label)
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that times execute*() and counts rows; iterating a cursor directly is not counted"""
+
+    _label = "?"
+
+    def execute(self, sql, parameters=()):
+        self._label = label = statement_label(sql)
+        started = time.perf_counter()
+        try:
+            super().execute(sql, parameters)
+        except sqlite3.Error as e:
+            _observe_error(label, e)
+            raise
+        _observe(label, started, self.rowcount)
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        self._label = label = statement_label(sql)
+        started = time.perf_counter()
+        try:
+            super().executemany(sql, seq_of_parameters)
+        except sqlite3.Error as e:
+            _observe_error(label, e)
+            raise
+        _observe(label, started, self.rowcount)
+        return self
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            sql_rows.inc(self._label)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        if rows:
+            sql_rows.inc(self._label, amount=len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        if rows:
+            sql_rows.inc(self._label, amount=len(rows))
+        return rows
+
+class InstrumentedConnection(sqlite3.Connection):
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            super().commit()
+        except sqlite3.Error as e:
+            _observe_error("COMMIT", e)
+            raise
+        _observe("COMMIT", started, 0)
+
+def configure_connection(conn: sqlite3.Connection):
+    """Apply the per-connection pragmas used everywhere in the server"""
+    # Chỉ có hiệu lực với file mới (trước bảng đầu tiên và trước khi bật WAL), để
+    # maintenance trả trang trống bằng incremental_vacuum; DB cũ: xem maintenance.py
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+    conn.execute(f"PRAGMA cache_size = -{CACHE_SIZE_KB}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+
+def open_connection(path: str = DATABASE_PATH) -> sqlite3.Connection:
+    conn = sqlite3.connect(
+        path,
+        timeout=BUSY_TIMEOUT_MS / 1000,
+        check_same_thread=False,
+        cached_statements=STATEMENT_CACHE_SIZE,
+        factory=InstrumentedConnection if DB_METRICS else sqlite3.Connection,
+    )
+    configure_connection(conn)
+    return conn
+
+class ConnectionPool:
+    """Fixed-size pool of pre-opened, pre-configured SQLite connections"""
+
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._opened = 0
+        self._closed = False
+
+    def acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if self._closed:
+                raise sqlite3.OperationalError("connection pool is closed")
+            if self._opened < self.size:
+                self._opened += 1
+                try:
+                    return open_connection(self.path)
+                except Exception:
+                    self._opened -= 1
+                    raise
+
+        try:
+            return self._idle.get(timeout=POOL_TIMEOUT)
+        except queue.Empty:
+            raise sqlite3.OperationalError("connection pool exhausted")
+
+    def release(self, conn: sqlite3.Connection):
+        # Không trả connection còn transaction dở dang về pool
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            self.discard(conn)
+            return
+        if self._closed:
+            self.discard(conn)
+            return
+        self._idle.put(conn)
+
+    def discard(self, conn: sqlite3.Connection):
+        """Close a connection that is no longer usable instead of returning it"""
+        with self._lock:
+            self._opened -= 1
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def close(self):
+        """Close every idle connection; checked-out ones are closed on release"""
+        with self._lock:
+            self._closed = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._opened -= 1
+
+    def reopen(self):
+        with self._lock:
+            self._closed = False
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size,
+            "opened": self._opened,
+            "idle": self._idle.qsize()
+        }
+
+pool = ConnectionPool(DATABASE_PATH, POOL_SIZE)
+
+@contextmanager
+def connection():
+    """Borrow a pooled connection; any uncommitted work is rolled back on return"""
+    conn = pool.acquire()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+
+@contextmanager
+def transaction():
+    """Borrow a pooled connection and commit on success, roll back on error"""
+    with connection() as conn:
+        try:
+            yield conn
+        except BaseException:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        else:
+            conn.commit()
+
+# Số thread tối đa mỗi lane được chiếm trong executor
+LANE_LIMITS = {
+    "license": int(os.getenv("DB_LANE_LICENSE", DB_WORKERS)),
+    "chat": int(os.getenv("DB_LANE_CHAT", max(1, DB_WORKERS // 2))),
+    "admin": int(os.getenv("DB_LANE_ADMIN", max(1, DB_WORKERS // 4))),
+}
+
+class LaneStats:
+    __slots__ = ("waiting", "running", "max_waiting", "completed", "failed", "wait_seconds")
+
+    def __init__(self):
+        self.waiting = 0
+        self.running = 0
+        self.max_waiting = 0
+        self.completed = 0
+        self.failed = 0
+        self.wait_seconds = 0.0
+
+class DatabaseExecutor:
+    """Bounded thread pool for blocking SQLite calls, partitioned into lanes"""
+
+    def __init__(self, workers: int, lane_limits: dict):
+        self.workers = workers
+        self.lane_limits = dict(lane_limits)
+        self._executor = None
+        self._loop = None
+        self._semaphores = {}
+        self._stats = {lane: LaneStats() for lane in self.lane_limits}
+
+    def _semaphore(self, lane: str) -> asyncio.Semaphore:
+        # Semaphore gắn với event loop; tạo lại nếu app chạy trên loop khác
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._semaphores = {name: asyncio.Semaphore(limit) for name, limit in self.lane_limits.items()}
+        return self._semaphores[lane]
+
+    def _pool(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="db")
+        return self._executor
+
+    async def submit(self, lane: str, fn, *args):
+        """Run fn(*args) on the executor once the lane has a free slot"""
+        stats = self._stats[lane]
+        semaphore = self._semaphore(lane)
+        if semaphore.locked():
+            # Lane đang đầy: đếm độ sâu hàng đợi và thời gian chờ
+            queued_at = time.perf_counter()
+            stats.waiting += 1
+            stats.max_waiting = max(stats.max_waiting, stats.waiting)
+            try:
+                await semaphore.acquire()
+            finally:
+                stats.waiting -= 1
+            stats.wait_seconds += time.perf_counter() - queued_at
+        else:
+            await semaphore.acquire()
+        stats.running += 1
+        loop = asyncio.get_running_loop()
+        try:
+            future = self._pool().submit(fn, *args)
+        except BaseException:
+            self._finish(lane, semaphore, None)
+            raise
+        # Trả slot khi hàm đã chạy xong trên thread chứ không phải khi task await nó kết
+        # thúc: task bị hủy (client ngắt kết nối, timeout) thì truy vấn vẫn giữ thread
+        # và connection, lane phải tiếp tục tính nó
+        future.add_done_callback(lambda f: loop.call_soon_threadsafe(self._finish, lane, semaphore, f))
+        return await asyncio.wrap_future(future, loop=loop)
+
+    def _finish(self, lane: str, semaphore: asyncio.Semaphore, future):
+        stats = self._stats[lane]
+        stats.running -= 1
+        stats.completed += 1
+        if future is None or (not future.cancelled() and future.exception() is not None):
+            stats.failed += 1
+        semaphore.release()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def stats(self) -> dict:
+        lanes = {}
+        for lane, s in self._stats.items():
+            lanes[lane] = {
+                "limit": self.lane_limits[lane],
+                "running": s.running,
+                "queue_depth": s.waiting,
+                "max_queue_depth": s.max_waiting,
+                "completed": s.completed,
+                "failed": s.failed,
+                "avg_wait_ms": round(s.wait_seconds * 1000 / s.completed, 3) if s.completed else 0.0
+            }
+        return {"workers": self.workers, "lanes": lanes}
+
+executor = DatabaseExecutor(DB_WORKERS, LANE_LIMITS)
+
+def _with_connection(fn, *args):
+    with connection() as conn:
+        return fn(conn, *args)
+
+def _with_transaction(fn, *args):
+    with transaction() as conn:
+        return fn(conn, *args)
+
+async def run(lane: str, fn, *args):
+    """Run fn(conn, *args) off the event loop with a pooled connection"""
+    return await executor.submit(lane, _with_connection, fn, *args)
+
+async def run_transaction(lane: str, fn, *args):
+    """Like run(), but commit when fn returns and roll back if it raises"""
+    return await executor.submit(lane, _with_transaction, fn, *args)
+
+def epoch(value: datetime) -> int:
+    """Whole seconds of a naive local datetime read as UTC.
+
+    Matches epoch_sql() below (SQLite's strftime('%s', ...) treats the ISO text
+    as UTC), so *_ts columns and Python-side values compare directly.
+    """
+    return calendar.timegm(value.timetuple())
+
+def epoch_sql(column: str) -> str:
+    # Cắt phần micro giây trước khi đổi: strftime làm tròn .999999 lên giây kế tiếp
+    return f"CAST(strftime('%s', substr({column}, 1, 19)) AS INTEGER)"
+
+def _add_column(table: str, column: str, declaration: str):
+    """Migration step: ALTER TABLE ADD COLUMN, skipped if the column already exists"""
+    def step(conn: sqlite3.Connection):
+        columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+        if column not in columns:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+    return step
+
+LICENSE_EPOCHS = (f"created_ts = {epoch_sql('created_at')}, "
+                  f"expires_ts = {epoch_sql('expires_at')}, "
+                  f"last_used_ts = {epoch_sql('last_used')}")
+
+def fts5_available(conn: sqlite3.Connection) -> bool:
+    """True if this SQLite build can create FTS5 tables"""
+    try:
+        conn.execute("CREATE VIRTUAL TABLE temp.fts5_probe USING fts5(x)")
+        conn.execute("DROP TABLE temp.fts5_probe")
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+def search_available(conn: sqlite3.Connection) -> bool:
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'chat_fts'").fetchone() is not None
+
+# Bảng FTS5 external content: chỉ chứa index, nội dung đọc từ bảng gốc theo rowid.
+# remove_diacritics 2: "chao" khớp "chào". rowid của licenses (không có INTEGER
+# PRIMARY KEY) có thể đổi sau VACUUM toàn bộ, khi đó phải 'rebuild' licenses_fts.
+SEARCH_SCHEMA = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS chat_fts USING fts5(
+           message, content='chat_messages', content_rowid='id',
+           tokenize='unicode61 remove_diacritics 2')""",
+    """CREATE TRIGGER IF NOT EXISTS chat_fts_insert AFTER INSERT ON chat_messages BEGIN
+           INSERT INTO chat_fts (rowid, message) VALUES (NEW.id, NEW.message);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS chat_fts_delete AFTER DELETE ON chat_messages BEGIN
+           INSERT INTO chat_fts (chat_fts, rowid, message) VALUES ('delete', OLD.id, OLD.message);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS chat_fts_update AFTER UPDATE OF message ON chat_messages BEGIN
+           INSERT INTO chat_fts (chat_fts, rowid, message) VALUES ('delete', OLD.id, OLD.message);
+           INSERT INTO chat_fts (rowid, message) VALUES (NEW.id, NEW.message);
+       END""",
+    "INSERT INTO chat_fts (chat_fts) VALUES ('rebuild')",
+    """CREATE VIRTUAL TABLE IF NOT EXISTS licenses_fts USING fts5(
+           key, customer_name, customer_email, content='licenses', content_rowid='rowid',
+           tokenize='unicode61 remove_diacritics 2')""",
+    """CREATE TRIGGER IF NOT EXISTS licenses_fts_insert AFTER INSERT ON licenses BEGIN
+           INSERT INTO licenses_fts (rowid, key, customer_name, customer_email)
+           VALUES (NEW.rowid, NEW.key, NEW.customer_name, NEW.customer_email);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS licenses_fts_delete AFTER DELETE ON licenses BEGIN
+           INSERT INTO licenses_fts (licenses_fts, rowid, key, customer_name, customer_email)
+           VALUES ('delete', OLD.rowid, OLD.key, OLD.customer_name, OLD.customer_email);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS licenses_fts_update
+       AFTER UPDATE OF key, customer_name, customer_email ON licenses BEGIN
+           INSERT INTO licenses_fts (licenses_fts, rowid, key, customer_name, customer_email)
+           VALUES ('delete', OLD.rowid, OLD.key, OLD.customer_name, OLD.customer_email);
+           INSERT INTO licenses_fts (rowid, key, customer_name, customer_email)
+           VALUES (NEW.rowid, NEW.key, NEW.customer_name, NEW.customer_email);
+       END""",
+    "INSERT INTO licenses_fts (licenses_fts) VALUES ('rebuild')",
+]
+
+def _create_search_index(conn: sqlite3.Connection):
+    """Migration step: FTS5 search tables, skipped (search disabled) if FTS5 is missing"""
+    if not fts5_available(conn):
+        log.warning("fts5_unavailable", detail="SQLite was built without FTS5; /api/search is disabled")
+        return
+    for statement in SEARCH_SCHEMA:
+        conn.execute(statement)
+
+# Schema migrations: (version, description, steps) theo thứ tự tăng dần.
+# Mỗi step phải idempotent (IF NOT EXISTS...) vì DB cũ có thể đã có bảng.
+MIGRATIONS = [
+    (1, "base tables", [
+        """CREATE TABLE IF NOT EXISTS licenses
+           (key TEXT PRIMARY KEY, created_at TEXT, expires_at TEXT,
+            is_active INTEGER, hwid TEXT, used_count INTEGER,
+            last_used TEXT, customer_name TEXT, customer_email TEXT)""",
+        """CREATE TABLE IF NOT EXISTS chat_messages
+           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            license_key TEXT, hwid TEXT, message TEXT,
+            sender_type TEXT, timestamp TEXT,
+            is_read INTEGER DEFAULT 0)""",
+        """CREATE TABLE IF NOT EXISTS admin_users
+           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE,
+            password_hash TEXT,
+            created_at TEXT,
+            is_active INTEGER DEFAULT 1)""",
+        """CREATE TABLE IF NOT EXISTS admin_sessions
+           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_token TEXT UNIQUE,
+            username TEXT,
+            created_at TEXT,
+            expires_at TEXT)""",
+    ]),
+    (2, "indexes for chat and license hot queries", [
+        "CREATE INDEX IF NOT EXISTS idx_chat_license_ts ON chat_messages (license_key, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_chat_license_unread ON chat_messages (license_key, sender_type, is_read)",
+        "CREATE INDEX IF NOT EXISTS idx_chat_hwid_ts ON chat_messages (hwid, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_chat_timestamp ON chat_messages (timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_chat_is_read ON chat_messages (is_read)",
+        "CREATE INDEX IF NOT EXISTS idx_licenses_active ON licenses (is_active, hwid, last_used, key)",
+        "CREATE INDEX IF NOT EXISTS idx_licenses_expires ON licenses (expires_at)",
+        "CREATE INDEX IF NOT EXISTS idx_licenses_last_used ON licenses (last_used)",
+        "CREATE INDEX IF NOT EXISTS idx_licenses_hwid ON licenses (hwid)",
+        "ANALYZE",
+    ]),
+    (3, "order chat lookups by id for cursor pagination", [
+        # Index 1 cột đã kèm rowid (= id) ở cuối, nên WHERE license_key = ? AND id > ?
+        # và ORDER BY id đều đi thẳng trên index
+        "CREATE INDEX IF NOT EXISTS idx_chat_license ON chat_messages (license_key)",
+        "CREATE INDEX IF NOT EXISTS idx_chat_hwid ON chat_messages (hwid)",
+        "DROP INDEX IF EXISTS idx_chat_license_ts",
+        "DROP INDEX IF EXISTS idx_chat_hwid_ts",
+        "DROP INDEX IF EXISTS idx_chat_timestamp",
+    ]),
+    (4, "admin token revocations and session expiry index", [
+        # Token admin ký HMAC, không lưu DB; logout / xóa admin ghi mốc
+        # "mọi token phát hành trước thời điểm này đều vô hiệu"
+        """CREATE TABLE IF NOT EXISTS admin_revocations
+           (username TEXT PRIMARY KEY,
+            revoked_before INTEGER NOT NULL)""",
+        "CREATE INDEX IF NOT EXISTS idx_admin_sessions_expires ON admin_sessions (expires_at)",
+    ]),
+    (5, "keyset pagination indexes for the license list", [
+        # (cột sắp xếp, key): ORDER BY + cursor (sort, key) > (?, ?) đi thẳng trên index
+        "CREATE INDEX IF NOT EXISTS idx_licenses_created_key ON licenses (created_at, key)",
+        "CREATE INDEX IF NOT EXISTS idx_licenses_expires_key ON licenses (expires_at, key)",
+        "DROP INDEX IF EXISTS idx_licenses_expires",
+    ]),
+    (6, "integer epoch columns for license and chat timestamps", [
+        # Cột *_ts (giây, giờ địa phương đọc như UTC - xem epoch()) song song với
+        # chuỗi ISO mà API vẫn trả về. server.py ghi cả hai; trigger chỉ chạy khi
+        # nguồn ghi khác (sqlite3 shell, script cũ) đổi chuỗi ISO mà bỏ qua cột *_ts
+        _add_column("licenses", "created_ts", "INTEGER"),
+        _add_column("licenses", "expires_ts", "INTEGER"),
+        _add_column("licenses", "last_used_ts", "INTEGER"),
+        _add_column("chat_messages", "ts", "INTEGER"),
+        f"UPDATE licenses SET {LICENSE_EPOCHS}",
+        f"UPDATE chat_messages SET ts = {epoch_sql('timestamp')}",
+        f"""CREATE TRIGGER IF NOT EXISTS licenses_epoch_insert AFTER INSERT ON licenses
+            WHEN NEW.created_ts IS NULL BEGIN
+                UPDATE licenses SET {LICENSE_EPOCHS} WHERE rowid = NEW.rowid;
+            END""",
+        f"""CREATE TRIGGER IF NOT EXISTS licenses_epoch_update
+            AFTER UPDATE OF created_at, expires_at, last_used ON licenses
+            WHEN NEW.created_ts IS OLD.created_ts AND NEW.expires_ts IS OLD.expires_ts
+                 AND NEW.last_used_ts IS OLD.last_used_ts BEGIN
+                UPDATE licenses SET {LICENSE_EPOCHS} WHERE rowid = NEW.rowid;
+            END""",
+        f"""CREATE TRIGGER IF NOT EXISTS chat_epoch_insert AFTER INSERT ON chat_messages
+            WHEN NEW.ts IS NULL BEGIN
+                UPDATE chat_messages SET ts = {epoch_sql('timestamp')} WHERE id = NEW.id;
+            END""",
+        f"""CREATE TRIGGER IF NOT EXISTS chat_epoch_update AFTER UPDATE OF timestamp ON chat_messages
+            WHEN NEW.ts IS OLD.ts BEGIN
+                UPDATE chat_messages SET ts = {epoch_sql('timestamp')} WHERE id = NEW.id;
+            END""",
+        "CREATE INDEX IF NOT EXISTS idx_licenses_created_ts ON licenses (created_ts, key)",
+        "CREATE INDEX IF NOT EXISTS idx_licenses_expires_ts ON licenses (expires_ts, key)",
+        "CREATE INDEX IF NOT EXISTS idx_licenses_active_ts ON licenses (is_active, hwid, last_used_ts, last_used, key)",
+        "CREATE INDEX IF NOT EXISTS idx_chat_ts ON chat_messages (ts)",
+        "DROP INDEX IF EXISTS idx_licenses_created_key",
+        "DROP INDEX IF EXISTS idx_licenses_expires_key",
+        "DROP INDEX IF EXISTS idx_licenses_active",
+        "DROP INDEX IF EXISTS idx_licenses_last_used",
+        "ANALYZE",
+    ]),
+    (7, "change log shared between server workers", [
+        # Xem cluster.py; AUTOINCREMENT để id không bị dùng lại sau khi purge
+        """CREATE TABLE IF NOT EXISTS change_log
+           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            origin TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            created_ts INTEGER NOT NULL)""",
+    ]),
+    (8, "full-text search over chat messages and license customers", [
+        _create_search_index,
+    ]),
+    (9, "shortened lease period for licenses toggled by an admin", [
+        # Giờ unix (time.time()) như claim trong lease, xem leases.py
+        _add_column("licenses", "lease_limited_until", "INTEGER"),
+    ]),
+    (10, "single-use tickets for the admin event stream", [
+        # Xem event_stream trong server.py; chỉ lưu hash của ticket
+        """CREATE TABLE IF NOT EXISTS event_tickets
+           (ticket_hash TEXT PRIMARY KEY,
+            username TEXT NOT NULL,
+            expires_ts REAL NOT NULL)""",
+    ]),
+    (11, "maintained unread counter for the active users list", [
+        # licenses.unread_count = số tin của user chưa đọc, trigger giữ đồng bộ với
+        # chat_messages nên danh sách chat admin không phải đếm lại mỗi lần poll
+        _add_column("licenses", "unread_count", "INTEGER NOT NULL DEFAULT 0"),
+        """UPDATE licenses SET unread_count =
+               (SELECT COUNT(*) FROM chat_messages m
+                 WHERE m.license_key = licenses.key AND m.sender_type = 'user' AND m.is_read = 0)""",
+        """CREATE TRIGGER IF NOT EXISTS chat_unread_insert AFTER INSERT ON chat_messages
+           WHEN NEW.sender_type = 'user' AND NEW.is_read = 0 BEGIN
+               UPDATE licenses SET unread_count = unread_count + 1 WHERE key = NEW.license_key;
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS chat_unread_delete AFTER DELETE ON chat_messages
+           WHEN OLD.sender_type = 'user' AND OLD.is_read = 0 BEGIN
+               UPDATE licenses SET unread_count = unread_count - 1 WHERE key = OLD.license_key;
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS chat_unread_update
+           AFTER UPDATE OF license_key, sender_type, is_read ON chat_messages
+           WHEN (OLD.sender_type = 'user' AND OLD.is_read = 0) OR (NEW.sender_type = 'user' AND NEW.is_read = 0) BEGIN
+               UPDATE licenses SET unread_count = unread_count - 1
+                WHERE key = OLD.license_key AND OLD.sender_type = 'user' AND OLD.is_read = 0;
+               UPDATE licenses SET unread_count = unread_count + 1
+                WHERE key = NEW.license_key AND NEW.sender_type = 'user' AND NEW.is_read = 0;
+           END""",
+        # Đúng thứ tự của ACTIVE_USERS_QUERY: đọc ngược index rồi dừng sau LIMIT
+        """CREATE INDEX IF NOT EXISTS idx_licenses_chat_users
+           ON licenses (unread_count, last_used_ts IS NULL, last_used_ts)
+           WHERE is_active = 1 AND hwid IS NOT NULL AND hwid != ''""",
+        "ANALYZE",
+    ]),
+    (12, "maintenance leader lease shared between server workers", [
+        # Xem Maintenance.acquire_lease(); expires_ts là giờ unix (time.time())
+        """CREATE TABLE IF NOT EXISTS maintenance_lock
+           (name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_ts REAL NOT NULL)""",
+        "INSERT OR IGNORE INTO maintenance_lock (name, owner, expires_ts) VALUES ('maintenance', '', 0)",
+    ]),
+]
+
+def schema_version(conn: sqlite3.Connection) -> int:
+    conn.execute("""CREATE TABLE IF NOT EXISTS schema_version
+                    (version INTEGER PRIMARY KEY, description TEXT, applied_at TEXT)""")
+    return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """Apply every migration newer than the recorded schema version"""
+    current = schema_version(conn)
+    for version, description, steps in MIGRATIONS:
+        if version <= current:
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Worker khác có thể đã áp migration này trong lúc chờ write lock
+            if schema_version(conn) >= version:
+                conn.rollback()
+                current = version
+                continue
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+            conn.execute("INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                         (version, description, datetime.now().isoformat()))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        log.info("schema_migrated", version=version, description=description)
+        current = version
+    return current
+
+# SQL của các truy vấn nóng, dùng chung cho handler trong server.py và HOT_QUERIES
+LICENSE_RECORD_COLUMNS = "key, created_at, expires_at, expires_ts, is_active, hwid, customer_name, lease_limited_until"
+
+def license_record_sql(keys: int = 1) -> str:
+    """check_license: one license by key, or `keys` licenses with WHERE key IN (...)"""
+    if keys == 1:
+        return f"SELECT {LICENSE_RECORD_COLUMNS} FROM licenses WHERE key = ?"
+    return f"SELECT {LICENSE_RECORD_COLUMNS} FROM licenses WHERE key IN ({', '.join('?' * keys)})"
+
+MESSAGE_COLUMNS = ("id", "license_key", "hwid", "message", "sender_type", "timestamp", "is_read")
+
+def messages_sql(where: str, cursor: Optional[str]) -> str:
+    """get_messages page, params (where params..., cursor id, limit).
+
+    where: "" hoặc một điều kiện ("license_key = ?", "hwid = ?").
+    cursor: "since" (id > ?, tăng dần), "before" (id < ?, giảm dần), None (mới nhất, giảm dần).
+    """
+    conditions = [where] if where else []
+    if cursor == "since":
+        conditions.append("id > ?")
+    elif cursor == "before":
+        conditions.append("id < ?")
+    sql = f"SELECT {', '.join(MESSAGE_COLUMNS)} FROM chat_messages"
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    return sql + f" ORDER BY id {'ASC' if cursor == 'since' else 'DESC'} LIMIT ?"
+
+LICENSE_COLUMNS = ("key", "created_at", "expires_at", "is_active", "hwid", "used_count",
+                   "last_used", "customer_name", "customer_email")
+# Cột đọc thêm (không trả về API): sắp xếp / cursor / is_expired bằng số nguyên
+LICENSE_SELECT = LICENSE_COLUMNS + ("created_ts", "expires_ts")
+
+def license_page_sql(where: list, order_columns: tuple, descending: bool, after: bool) -> str:
+    """get_licenses / export page ordered by order_columns (the last one is key), params (where params..., cursor values..., limit).
+
+    after: thêm điều kiện keyset (order_columns) > cursor (< khi descending).
+    """
+    direction, op = ("DESC", "<") if descending else ("ASC", ">")
+    conditions = list(where)
+    if after:
+        # Row value so sánh cả (sort, key) nên đi thẳng trên index (sort, key)
+        conditions.append(f"({', '.join(order_columns)}) {op} ({', '.join('?' * len(order_columns))})")
+    sql = f"SELECT {', '.join(LICENSE_SELECT)} FROM licenses"
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    return sql + " ORDER BY " + ", ".join(f"{column} {direction}" for column in order_columns) + " LIMIT ?"
+
+# Danh sách user đang active cho khung chat admin, sắp xếp: có tin chưa đọc
+# lên đầu, sau đó theo lần dùng gần nhất (chưa dùng lần nào coi như mới nhất).
+# unread_count do trigger duy trì (migration 11); idx_licenses_chat_users có
+# đúng thứ tự này nên mỗi poll chỉ đọc LIMIT + OFFSET dòng, không phụ thuộc số license.
+# INDEXED BY: khi chưa có ANALYZE planner chọn idx_licenses_active_ts rồi sort cả tập
+ACTIVE_USERS_QUERY = """
+    SELECT l.key, l.hwid, l.last_used, l.last_used_ts, l.unread_count,
+           (SELECT m.message FROM chat_messages m
+             WHERE m.license_key = l.key
+             ORDER BY m.id DESC LIMIT 1) AS last_message
+    FROM licenses l INDEXED BY idx_licenses_chat_users
+    WHERE l.is_active = 1 AND l.hwid IS NOT NULL AND l.hwid != ''
+    ORDER BY l.unread_count DESC, l.last_used_ts IS NULL DESC, l.last_used_ts DESC
+    LIMIT ? OFFSET ?
+"""
+
+# Các truy vấn nóng của server.py; check_query_plans() bảo đảm chúng không
+# quay về full table scan. SQL lấy từ chính các hàm dựng truy vấn mà handler dùng.
+HOT_QUERIES = {
+    "check_license": (license_record_sql(), ("k",)),
+    "check_license.batch": (license_record_sql(3), ("a", "b", "c")),
+    "get_messages.license": (messages_sql("license_key = ?", "since"), ("k", 0, 201)),
+    "get_messages.license_tail": (messages_sql("license_key = ?", None), ("k", 201)),
+    "get_messages.license_older": (messages_sql("license_key = ?", "before"), ("k", 1000, 201)),
+    "get_messages.hwid": (messages_sql("hwid = ?", "since"), ("h", 0, 201)),
+    "get_messages.all": (messages_sql("", "since"), (0, 201)),
+    "get_active_users": (ACTIVE_USERS_QUERY, (101, 0)),
+    "archive_chat": ("SELECT id FROM main.chat_messages WHERE ts < ? ORDER BY ts LIMIT ?", (0, 1000)),
+    "get_licenses.key": (license_page_sql([], ("key",), False, True), ("k", 101)),
+    "get_licenses.created_at": (license_page_sql([], ("created_ts", "key"), True, True), (0, "k", 101)),
+    "get_licenses.expires_at": (license_page_sql([], ("expires_ts", "key"), False, True), (0, "k", 101)),
+}
+
+# Truy vấn của /api/search, chỉ kiểm tra khi DB có bảng FTS5
+SEARCH_QUERIES = {
+    "search.messages.rank": ("""SELECT m.id FROM chat_fts JOIN chat_messages m ON m.id = chat_fts.rowid
+                                WHERE chat_fts MATCH ?1 AND chat_fts.rowid >= COALESCE(
+                                    (SELECT chat_fts.rowid FROM chat_fts JOIN chat_messages m ON m.id = chat_fts.rowid
+                                     WHERE chat_fts MATCH ?1 ORDER BY chat_fts.rowid DESC LIMIT 1 OFFSET ?2), 0)
+                                ORDER BY rank LIMIT ?3 OFFSET ?4""", ('"a"*', 1999, 21, 0)),
+    "search.messages.license": ("""SELECT m.id FROM chat_fts JOIN chat_messages m ON m.id = chat_fts.rowid
+                                   WHERE chat_fts MATCH ? AND m.license_key = ?
+                                   ORDER BY chat_fts.rowid DESC LIMIT ? OFFSET ?""", ('"a"*', "k", 21, 0)),
+    "search.licenses": ("""SELECT l.key FROM licenses_fts JOIN licenses l ON l.rowid = licenses_fts.rowid
+                           WHERE licenses_fts MATCH ? ORDER BY licenses_fts.rowid DESC LIMIT ? OFFSET ?""",
+                        ('"a"*', 21, 0)),
+}
+
+def query_plan(conn: sqlite3.Connection, sql: str, params=()) -> list:
+    return [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+
+def check_query_plans(conn: sqlite3.Connection) -> dict:
+    """Return {query name: plan} for hot queries that scan a table or sort in a temp b-tree"""
+    problems = {}
+    queries = dict(HOT_QUERIES, **SEARCH_QUERIES) if search_available(conn) else HOT_QUERIES
+    for name, (sql, params) in queries.items():
+        plan = query_plan(conn, sql, params)
+        # Quét kết quả của subquery (CO-ROUTINE / MATERIALIZE) không phải quét bảng
+        subqueries = {detail.split()[-1] for detail in plan if detail.startswith(("CO-ROUTINE", "MATERIALIZE"))}
+        for detail in plan:
+            parts = detail.split()
+            # "SCAN x VIRTUAL TABLE INDEX ..." là tra cứu qua index của FTS5, không phải quét bảng
+            full_scan = (parts[0] == "SCAN" and "USING" not in parts and "VIRTUAL" not in parts
+                         and parts[1] not in subqueries)
+            if full_scan or "TEMP B-TREE" in detail:
+                problems[name] = plan
+                break
+    return problems
+
+if __name__ == "__main__":
+    # python database.py --check-plans : kiểm tra query plan trên một DB tạm
+    if "--check-plans" in sys.argv:
+        conn = sqlite3.connect(":memory:")
+        migrate(conn)
+        problems = check_query_plans(conn)
+        for name, plan in problems.items():
+            print(f"{name}: {' | '.join(plan)}")
+        print("query plans OK" if not problems else f"{len(problems)} hot queries degrade to a scan")
+        sys.exit(1 if problems else 0)
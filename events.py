@@ -0,0 +1,140 @@
+# events.py
+"""In-process fan-out hub for pushing chat events to Server-Sent Events streams.
+
+Handlers publish an event to one or more topics ("admin", "license:<key>",
+"hwid:<hwid>"); every subscription listening on one of those topics gets it
+once. Each subscriber has a bounded queue: a consumer that falls behind is
+not allowed to grow memory, its queue is dropped and replaced by a single
+"resync" event, after which the stream closes and the client reconnects and
+reloads through the normal REST endpoints.
+"""
+import asyncio
+import json
+import os
+import threading
+from typing import Iterable, Optional
+
+EVENT_QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE", 100))
+EVENT_HEARTBEAT_SECONDS = float(os.getenv("EVENT_HEARTBEAT_SECONDS", 15))
+
+def admin_topic() -> str:
+    return "admin"
+
+def license_topic(license_key: str) -> str:
+    return f"license:{license_key}"
+
+def hwid_topic(hwid: str) -> str:
+    return f"hwid:{hwid}"
+
+class Subscription:
+    def __init__(self, topics: Iterable[str], queue_size: int):
+        self.topics = frozenset(topics)
+        self.queue = asyncio.Queue(queue_size)
+        self.overflowed = False
+
+class EventHub:
+    """Topic-based publish/subscribe with per-subscriber backpressure"""
+
+    def __init__(self, queue_size: int = EVENT_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._subscribers = {}  # topic -> set(Subscription)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = threading.Lock()
+        self.published = 0
+        self.delivered = 0
+        self.overflows = 0
+
+    def subscribe(self, topics: Iterable[str]) -> Subscription:
+        """Register a subscription; must be called from the event loop"""
+        self._loop = asyncio.get_running_loop()
+        sub = Subscription(topics, self.queue_size)
+        with self._lock:
+            for topic in sub.topics:
+                self._subscribers.setdefault(topic, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscription):
+        with self._lock:
+            for topic in sub.topics:
+                subs = self._subscribers.get(topic)
+                if subs is not None:
+                    subs.discard(sub)
+                    if not subs:
+                        del self._subscribers[topic]
+
+    def publish(self, topics: Iterable[str], event_type: str, data: dict):
+        """Deliver an event to every subscriber of any of the topics.
+
+        Safe to call from the event loop or from worker threads.
+        """
+        loop = self._loop
+        if loop is None:
+            return  # chưa có ai subscribe
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self._deliver(topics, event_type, data)
+        elif not loop.is_closed():
+            loop.call_soon_threadsafe(self._deliver, list(topics), event_type, data)
+
+    def _deliver(self, topics, event_type: str, data: dict):
+        with self._lock:
+            targets = set()
+            for topic in topics:
+                targets.update(self._subscribers.get(topic, ()))
+        self.published += 1
+        if not targets:
+            return
+
+        payload = format_event(event_type, data)
+        for sub in targets:
+            if sub.overflowed:
+                continue
+            try:
+                sub.queue.put_nowait(payload)
+                self.delivered += 1
+            except asyncio.QueueFull:
+                # Consumer chậm: bỏ hàng đợi, báo client tải lại từ REST
+                sub.overflowed = True
+                self.overflows += 1
+                while not sub.queue.empty():
+                    sub.queue.get_nowait()
+                sub.queue.put_nowait(format_event("resync", {"reason": "slow consumer"}))
+
+    async def stream(self, sub: Subscription):
+        """Async generator of SSE frames for a subscription, with heartbeats"""
+        try:
+            yield format_event("ready", {"topics": sorted(sub.topics)})
+            while True:
+                try:
+                    payload = await asyncio.wait_for(sub.queue.get(), EVENT_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                yield payload
+                if sub.overflowed and sub.queue.empty():
+                    break
+        finally:
+            self.unsubscribe(sub)
+
+    def stats(self) -> dict:
+        with self._lock:
+            subscriptions = set()
+            for subs in self._subscribers.values():
+                subscriptions.update(subs)
+            topics = len(self._subscribers)
+        return {
+            "subscribers": len(subscriptions),
+            "topics": topics,
+            "queue_size": self.queue_size,
+            "published": self.published,
+            "delivered": self.delivered,
+            "overflows": self.overflows
+        }
+
+def format_event(event_type: str, data: dict) -> str:
+    return f"event: {event_type}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+hub = EventHub()
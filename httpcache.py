@@ -0,0 +1,132 @@
+# httpcache.py
+"""Conditional GET for the endpoints the admin panel polls, and gzip.
+
+ChangeVersions keeps one counter per table ("licenses", "chat"), bumped by
+server.py from the cluster.bus handlers every write already goes through,
+so with WORKERS > 1 writes made by other workers count too (within
+BUS_POLL_MS). Writes made outside the server are not seen; entries older
+than HTTP_CACHE_MAX_AGE_SECONDS are never answered from the versions alone.
+
+A response carries a weak ETag, the hash of its JSON body. ETagCache
+remembers, per resource (path + query string), the last ETag served with
+the versions it was built from and `valid_until`, the moment the body would
+change on its own as time passes (a license expiring, a user going
+offline). A request whose If-None-Match holds that ETag while the versions
+are unchanged and valid_until has not passed gets 304 without running any
+query; otherwise the body is rebuilt, and still answered with 304 if it
+hashes to the ETag the client sent.
+
+Times are database.epoch() seconds, like the *_ts columns.
+
+CompressionMiddleware gzips bodies of at least GZIP_MIN_SIZE bytes for
+clients sending Accept-Encoding: gzip, except on UNCOMPRESSED_PATHS: the
+gzip stream would hold Server-Sent Events back until its buffer fills.
+"""
+from collections import OrderedDict
+from typing import Optional
+import hashlib
+import os
+import threading
+import time
+
+from starlette.middleware.gzip import GZipMiddleware
+
+HTTP_CACHE_ENTRIES = int(os.getenv("HTTP_CACHE_ENTRIES", 10000))
+HTTP_CACHE_MAX_AGE_SECONDS = float(os.getenv("HTTP_CACHE_MAX_AGE_SECONDS", 300))
+GZIP_MIN_SIZE = int(os.getenv("GZIP_MIN_SIZE", 1024))  # 0 = tắt nén
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", 6))
+UNCOMPRESSED_PATHS = {"/api/events"}
+
+def etag(body: bytes) -> str:
+    return f'W/"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+def parse_if_none_match(header: Optional[str]) -> set:
+    """ETags listed in an If-None-Match header, compared weakly (W/ prefix ignored)"""
+    if not header:
+        return set()
+    return {tag.strip().removeprefix("W/") for tag in header.split(",") if tag.strip()}
+
+class ChangeVersions:
+    """Per-table write counters"""
+
+    def __init__(self, *tables: str):
+        self._versions = dict.fromkeys(tables, 0)
+        self._lock = threading.Lock()
+
+    def bump(self, *tables: str):
+        with self._lock:
+            for table in tables:
+                self._versions[table] += 1
+
+    def bump_all(self):
+        with self._lock:
+            for table in self._versions:
+                self._versions[table] += 1
+
+    def get(self, *tables: str) -> tuple:
+        with self._lock:
+            return tuple(self._versions[table] for table in tables)
+
+class ETagCache:
+    """Last ETag served per resource with the versions and deadline it stays valid for"""
+
+    def __init__(self, max_entries: int, max_age: float):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self._entries = OrderedDict()  # resource -> (etag, versions, valid_until, stored_at)
+        self._lock = threading.Lock()
+        self.not_modified = 0
+        self.rebuilt_not_modified = 0
+        self.rebuilt = 0
+
+    def match(self, resource: str, requested: set, versions: tuple, now_ts: float) -> Optional[str]:
+        """The ETag to answer 304 with, if the client holds the current body; None = rebuild"""
+        if not requested:
+            return None
+        with self._lock:
+            entry = self._entries.get(resource)
+            if entry is None:
+                return None
+            tag, stored_versions, valid_until, stored_at = entry
+            if (tag.removeprefix("W/") in requested and stored_versions == versions and now_ts < valid_until
+                    and time.monotonic() - stored_at < self.max_age):
+                self._entries.move_to_end(resource)
+                self.not_modified += 1
+                return tag
+        return None
+
+    def store(self, resource: str, tag: str, versions: tuple, valid_until: float):
+        with self._lock:
+            self._entries[resource] = (tag, versions, valid_until, time.monotonic())
+            self._entries.move_to_end(resource)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def record_build(self, not_modified: bool):
+        with self._lock:
+            self.rebuilt += 1
+            self.rebuilt_not_modified += not_modified
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "max_age_seconds": self.max_age,
+                "not_modified": self.not_modified,
+                "rebuilt": self.rebuilt,
+                "rebuilt_not_modified": self.rebuilt_not_modified
+            }
+
+class CompressionMiddleware:
+    """GZipMiddleware for everything but UNCOMPRESSED_PATHS"""
+
+    def __init__(self, app):
+        self.app = app
+        self.gzip = GZipMiddleware(app, minimum_size=GZIP_MIN_SIZE, compresslevel=GZIP_LEVEL)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and GZIP_MIN_SIZE > 0 and scope["path"] not in UNCOMPRESSED_PATHS:
+            await self.gzip(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
@@ -0,0 +1,133 @@
+# leases.py
+"""Signed license leases that clients verify offline.
+
+A valid check_license answer carries a lease,
+base64url(claims).base64url(HMAC-SHA256(claims)), with claims
+
+    key, hwid   the license and the device it is bound to
+    expires_at  license expiry, the same ISO string check_license returns
+    iat, exp    lease issue and expiry time, unix seconds (time.time())
+
+The client keeps the lease and treats the license as valid without calling
+the server until exp; when the lease nears expiry it calls
+/api/lease/renew, which re-checks the license and returns a fresh lease.
+Steady-state validation traffic drops to one request per lease period.
+
+Leases last LEASE_SECONDS, never past the license expiry. A revocation
+cannot reach a lease that was already issued, so after an admin toggles
+is_active the license row gets lease_limited_until = now +
+LEASE_LIMIT_DAYS and its leases are cut to LEASE_LIMITED_SECONDS until
+then: a license that was revoked once is re-checked often.
+
+The lease key is derived from SECRET_KEY (or set with LEASE_SECRET) and is
+a different key from the one signing admin tokens, because it has to ship
+inside the client: `python leases.py` prints it. HMAC means anyone holding
+the client's key can mint leases for that client - no more than patching
+the check out of the client binary - while Ed25519 would need the
+cryptography package, which the server does not depend on.
+"""
+from typing import Optional
+import base64
+import hashlib
+import hmac
+import json
+import os
+import sys
+import threading
+import time
+
+LEASE_SECONDS = float(os.getenv("LEASE_SECONDS", 6 * 3600))  # 0 = không phát lease
+LEASE_LIMITED_SECONDS = float(os.getenv("LEASE_LIMITED_SECONDS", 900))
+LEASE_LIMIT_DAYS = float(os.getenv("LEASE_LIMIT_DAYS", 30))
+# Lease hết hạn chưa quá lâu vẫn được renew (máy tắt qua đêm, mất mạng)
+LEASE_RENEW_GRACE_SECONDS = float(os.getenv("LEASE_RENEW_GRACE_SECONDS", 7 * 86400))
+LEASE_SECRET = os.getenv("LEASE_SECRET")
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+def lease_key(secret_key: str) -> bytes:
+    """Key for signing leases: LEASE_SECRET if set, else derived from the server SECRET_KEY"""
+    if LEASE_SECRET:
+        return LEASE_SECRET.encode()
+    # Dẫn xuất một chiều: client giữ key này cũng không suy ra được SECRET_KEY ký token admin
+    return hmac.new(secret_key.encode(), b"license-lease-v1", hashlib.sha256).digest()
+
+def limited_until(now: Optional[float] = None) -> int:
+    """lease_limited_until value to store when an admin toggles a license"""
+    return int((time.time() if now is None else now) + LEASE_LIMIT_DAYS * 86400)
+
+class LeaseSigner:
+    """Issue and verify signed leases"""
+
+    def __init__(self, key: bytes):
+        self._key = key
+        self._lock = threading.Lock()
+        self.issued = 0
+        self.limited = 0
+        self.verified = 0
+        self.rejected = 0
+
+    def _sign(self, payload: str) -> str:
+        return _b64encode(hmac.new(self._key, payload.encode(), hashlib.sha256).digest())
+
+    def issue(self, key: str, hwid: str, expires_at: str, license_seconds: int,
+              lease_limited_until: Optional[int]) -> dict:
+        """Lease fields to merge into a valid check_license answer ({} when leases are off).
+
+        license_seconds: số giây còn lại của license, lease không được dài hơn.
+        """
+        if LEASE_SECONDS <= 0:
+            return {}
+        now = int(time.time())
+        duration = LEASE_SECONDS
+        limited = lease_limited_until is not None and now < lease_limited_until
+        if limited:
+            duration = min(duration, LEASE_LIMITED_SECONDS)
+        duration = int(max(0, min(duration, license_seconds)))
+        claims = {"key": key, "hwid": hwid, "expires_at": expires_at, "iat": now, "exp": now + duration}
+        payload = _b64encode(json.dumps(claims, separators=(',', ':')).encode())
+        with self._lock:
+            self.issued += 1
+            self.limited += limited
+        return {"lease": f"{payload}.{self._sign(payload)}", "lease_expires": now + duration}
+
+    def verify(self, token: str, grace: float = 0) -> Optional[dict]:
+        """Return the claims of a lease signed by this server and not expired for more than grace seconds"""
+        claims = None
+        parts = token.split('.')
+        if len(parts) == 2 and hmac.compare_digest(parts[1], self._sign(parts[0])):
+            try:
+                claims = json.loads(_b64decode(parts[0]))
+                if time.time() > claims["exp"] + grace or not isinstance(claims["key"], str) \
+                        or not isinstance(claims["hwid"], str):
+                    claims = None
+            except (ValueError, KeyError, TypeError):
+                claims = None
+        with self._lock:
+            if claims is None:
+                self.rejected += 1
+            else:
+                self.verified += 1
+        return claims
+
+    def stats(self) -> dict:
+        return {
+            "lease_seconds": LEASE_SECONDS,
+            "limited_seconds": LEASE_LIMITED_SECONDS,
+            "limit_days": LEASE_LIMIT_DAYS,
+            "issued": self.issued,
+            "limited": self.limited,
+            "verified": self.verified,
+            "rejected": self.rejected
+        }
+
+if __name__ == "__main__":
+    # SECRET_KEY=... python leases.py : in key ký lease (base64url) để nhúng vào client
+    secret_key = os.getenv("SECRET_KEY")
+    if not LEASE_SECRET and not secret_key:
+        sys.exit("Set SECRET_KEY (or LEASE_SECRET) as for the server")
+    print(_b64encode(lease_key(secret_key)))
@@ -0,0 +1,277 @@
+# maintenance.py
+"""Background database maintenance: chat archival, planner statistics, vacuum.
+
+Every MAINTENANCE_INTERVAL_SECONDS one pass:
+
+- moves chat messages older than CHAT_RETENTION_DAYS into a separate SQLite
+  file (CHAT_ARCHIVE_PATH), ARCHIVE_BATCH_SIZE rows per transaction with a
+  short pause between batches, so the write lock is never held long enough
+  to stall check_license activations or usage flushes. Each batch copies with
+  INSERT OR IGNORE before deleting, so a crash between the two (the archive is
+  a different file, commits are not atomic across both in WAL mode) is
+  repaired by the next pass;
+- runs PRAGMA optimize, which re-analyzes only tables whose statistics have
+  gone stale;
+- returns up to VACUUM_PAGES_PER_RUN free pages to the filesystem with
+  incremental vacuum, in small steps. Databases created before auto_vacuum
+  was enabled need a one-time full VACUUM first:
+  `python maintenance.py --enable-incremental-vacuum` (offline).
+
+With WORKERS > 1 every worker starts the thread but only the one holding the
+maintenance_lock lease runs a pass; the lease lasts two intervals and is
+renewed by each pass, so another worker takes over when the holder stops.
+
+Expired admin_sessions rows are purged by the session purge thread in
+server.py and old change_log rows by cluster.bus.
+
+Archived history stays readable through read_archived_messages().
+"""
+from datetime import datetime, timedelta
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import cluster
+import database
+import metrics
+
+MAINTENANCE_INTERVAL_SECONDS = float(os.getenv("MAINTENANCE_INTERVAL_SECONDS", 3600))
+CHAT_RETENTION_DAYS = float(os.getenv("CHAT_RETENTION_DAYS", 180))  # 0 = không archive
+CHAT_ARCHIVE_PATH = os.getenv("CHAT_ARCHIVE_PATH", "chat_archive.db")
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", 1000))
+ARCHIVE_PAUSE_MS = float(os.getenv("ARCHIVE_PAUSE_MS", 50))
+VACUUM_PAGES_PER_RUN = int(os.getenv("VACUUM_PAGES_PER_RUN", 10000))
+VACUUM_STEP_PAGES = 500
+
+log = metrics.StructuredLogger("license_server")
+
+CHAT_COLUMNS = "id, license_key, hwid, message, sender_type, timestamp, is_read, ts"
+
+ARCHIVE_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS archive.chat_messages
+       (id INTEGER PRIMARY KEY,
+        license_key TEXT,
+        hwid TEXT,
+        message TEXT,
+        sender_type TEXT,
+        timestamp TEXT,
+        is_read INTEGER,
+        ts INTEGER,
+        archived_ts INTEGER)""",
+    # Index 1 cột đã kèm rowid (= id), đủ cho WHERE license_key = ? AND id < ? ORDER BY id
+    "CREATE INDEX IF NOT EXISTS archive.idx_archive_license ON chat_messages (license_key)",
+    "CREATE INDEX IF NOT EXISTS archive.idx_archive_hwid ON chat_messages (hwid)",
+]
+
+def open_archive_writer() -> sqlite3.Connection:
+    """Connection to the main database with the archive attached as `archive`"""
+    conn = database.open_connection()
+    conn.execute("ATTACH DATABASE ? AS archive", (CHAT_ARCHIVE_PATH,))
+    conn.execute("PRAGMA archive.journal_mode = WAL")
+    for statement in ARCHIVE_SCHEMA:
+        conn.execute(statement)
+    conn.commit()
+    return conn
+
+def archive_batch(conn: sqlite3.Connection, cutoff_ts: int, limit: int):
+    """Move up to limit messages older than cutoff_ts; returns (moved, unread among them)"""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        ids = [row[0] for row in conn.execute(
+            "SELECT id FROM main.chat_messages WHERE ts < ? ORDER BY ts LIMIT ?", (cutoff_ts, limit))]
+        if not ids:
+            conn.rollback()
+            return 0, 0
+        placeholders = ", ".join("?" * len(ids))
+        conn.execute(f"""INSERT OR IGNORE INTO archive.chat_messages ({CHAT_COLUMNS}, archived_ts)
+                         SELECT {CHAT_COLUMNS}, ? FROM main.chat_messages WHERE id IN ({placeholders})""",
+                     [int(time.time())] + ids)
+        unread = conn.execute(f"SELECT COUNT(*) FROM main.chat_messages WHERE id IN ({placeholders}) AND is_read = 0",
+                              ids).fetchone()[0]
+        conn.execute(f"DELETE FROM main.chat_messages WHERE id IN ({placeholders})", ids)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return len(ids), unread
+
+def read_archived_messages(license_key=None, hwid=None, before_id=None, limit: int = 200):
+    """Newest-first page of archived messages (blocking; run it on the executor)"""
+    if not os.path.exists(CHAT_ARCHIVE_PATH):
+        return []
+    where, params = [], []
+    if license_key:
+        where.append("license_key = ?")
+        params.append(license_key)
+    elif hwid:
+        where.append("hwid = ?")
+        params.append(hwid)
+    if before_id is not None:
+        where.append("id < ?")
+        params.append(before_id)
+    sql = f"""SELECT {CHAT_COLUMNS} FROM chat_messages
+              {'WHERE ' + ' AND '.join(where) if where else ''}
+              ORDER BY id DESC LIMIT ?"""
+    # Mở read-only theo yêu cầu: lịch sử archive hiếm khi được đọc
+    conn = sqlite3.connect(f"file:{CHAT_ARCHIVE_PATH}?mode=ro", uri=True, timeout=database.BUSY_TIMEOUT_MS / 1000)
+    try:
+        return conn.execute(sql, params + [limit]).fetchall()
+    except sqlite3.OperationalError as e:
+        if "no such table" in str(e):
+            return []
+        raise
+    finally:
+        conn.close()
+
+class Maintenance:
+    """Periodic archival / optimize / incremental vacuum on a background thread"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._stopping = threading.Event()
+        self._thread = None
+        self.runs = 0
+        self.failed_runs = 0
+        self.archived = 0
+        self.vacuumed_pages = 0
+        self.last_run = None
+        self.leader = False
+        self.skipped_runs = 0
+
+    def archive_chat(self) -> int:
+        if CHAT_RETENTION_DAYS <= 0:
+            return 0
+        cutoff_ts = database.epoch(datetime.now() - timedelta(days=CHAT_RETENTION_DAYS))
+        moved_total = 0
+        conn = open_archive_writer()
+        try:
+            while not self._stopping.is_set():
+                moved, unread = archive_batch(conn, cutoff_ts, ARCHIVE_BATCH_SIZE)
+                if not moved:
+                    break
+                moved_total += moved
+                self.archived += moved
+                cluster.bus.emit("stats", "messages_archived", moved, unread)
+                # Nhả write lock giữa các lô cho các request đang chờ ghi
+                self._stopping.wait(ARCHIVE_PAUSE_MS / 1000)
+        finally:
+            conn.close()
+        return moved_total
+
+    def optimize(self):
+        with database.connection() as conn:
+            conn.execute("PRAGMA analysis_limit = 1000")
+            conn.execute("PRAGMA optimize")
+
+    def incremental_vacuum(self) -> int:
+        with database.connection() as conn:
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                return 0  # DB cũ chưa bật auto_vacuum = INCREMENTAL
+            freed = 0
+            while freed < VACUUM_PAGES_PER_RUN and not self._stopping.is_set():
+                free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+                step = min(free, VACUUM_STEP_PAGES, VACUUM_PAGES_PER_RUN - freed)
+                if step <= 0:
+                    break
+                # execute() chỉ step pragma này một lần (1 trang); executescript chạy hết
+                conn.executescript(f"PRAGMA incremental_vacuum({step});")
+                freed += step
+                self._stopping.wait(ARCHIVE_PAUSE_MS / 1000)
+        self.vacuumed_pages += freed
+        return freed
+
+    def acquire_lease(self) -> bool:
+        """Take or renew the maintenance_lock lease; only its holder runs maintenance"""
+        now = time.time()
+        with database.transaction() as conn:
+            taken = conn.execute("""UPDATE maintenance_lock SET owner = ?, expires_ts = ?
+                                    WHERE name = 'maintenance' AND (owner = ? OR expires_ts < ?)""",
+                                 (cluster.bus.origin, now + 2 * self.interval, cluster.bus.origin, now)).rowcount
+        self.leader = taken == 1
+        return self.leader
+
+    def release_lease(self):
+        # Dừng có kiểm soát: worker khác nhận ngay ở lượt kế tiếp, không chờ lease hết hạn
+        if not self.leader:
+            return
+        with database.transaction() as conn:
+            conn.execute("UPDATE maintenance_lock SET expires_ts = 0 WHERE name = 'maintenance' AND owner = ?",
+                         (cluster.bus.origin,))
+        self.leader = False
+
+    def run_once(self) -> dict:
+        started = time.monotonic()
+        result = {"archived": self.archive_chat()}
+        self.optimize()
+        result["vacuumed_pages"] = self.incremental_vacuum()
+        result["seconds"] = round(time.monotonic() - started, 3)
+        self.runs += 1
+        self.last_run = {"at": datetime.now().isoformat(), **result}
+        return result
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="maintenance", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread.join()
+            self._thread = None
+            try:
+                self.release_lease()
+            except sqlite3.Error as e:
+                log.error("maintenance_db_error", error=str(e))
+
+    def stats(self) -> dict:
+        return {
+            "interval_seconds": self.interval,
+            "chat_retention_days": CHAT_RETENTION_DAYS,
+            "archive_path": CHAT_ARCHIVE_PATH,
+            "leader": self.leader,
+            "runs": self.runs,
+            "skipped_runs": self.skipped_runs,
+            "failed_runs": self.failed_runs,
+            "archived_messages": self.archived,
+            "vacuumed_pages": self.vacuumed_pages,
+            "last_run": self.last_run
+        }
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            try:
+                if not self.acquire_lease():
+                    self.skipped_runs += 1  # worker khác đang giữ lease
+                    continue
+                self.run_once()
+                self.acquire_lease()  # gia hạn tính từ lúc lượt này xong
+            except sqlite3.Error as e:
+                log.error("maintenance_db_error", error=str(e))
+                self.failed_runs += 1
+
+maintenance = Maintenance(MAINTENANCE_INTERVAL_SECONDS)
+
+if __name__ == "__main__":
+    # python maintenance.py --run : chạy một lượt ngay
+    # python maintenance.py --enable-incremental-vacuum : bật auto_vacuum cho DB cũ (VACUUM toàn bộ, nên dừng server)
+    if "--enable-incremental-vacuum" in sys.argv:
+        conn = database.open_connection()
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        if database.search_available(conn):
+            # VACUUM đánh số lại rowid của licenses (khoá TEXT), index FTS phải dựng lại
+            conn.execute("INSERT INTO licenses_fts (licenses_fts) VALUES ('rebuild')")
+            conn.commit()
+        print(f"auto_vacuum = {conn.execute('PRAGMA auto_vacuum').fetchone()[0]} (2 = incremental)")
+        conn.close()
+    elif "--run" in sys.argv:
+        # Ngoài server không có bộ đếm để cập nhật; server tự sửa lệch ở lần reconcile kế tiếp
+        cluster.bus.register("stats", lambda *args: None)
+        with database.connection() as conn:
+            database.migrate(conn)
+        print(maintenance.run_once())
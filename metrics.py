@@ -0,0 +1,220 @@
+# metrics.py
+"""Prometheus-style metrics, request timing middleware and structured logging.
+
+Counters and histograms live in one process-wide registry and are rendered
+in the Prometheus text exposition format by /metrics. Every metric is a
+dict keyed by label values guarded by a lock, so they can be updated from
+the event loop and from the database worker threads alike. Collectors
+registered with registry.register_collector() are called at scrape time and
+turn existing stats() dicts (pool, executor lanes, caches) into gauges
+without touching the hot path.
+
+MetricsMiddleware times each HTTP request and labels it with the route
+template ("/api/licenses/{license_key}"), not the raw path, so label
+cardinality stays bounded.
+
+StructuredLogger writes "event key=value ..." lines through the standard
+logging module: LOG_LEVEL decides what is emitted at all, and events logged
+with sample=True are additionally kept only with probability
+LOG_SAMPLE_RATE, for per-request messages on hot paths.
+"""
+from bisect import bisect_left
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", 0.01))
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SQL_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+def _format_labels(names, values, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> list:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labels, values)} {_format_value(v)}" for values, v in items]
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(label_values)
+            if entry is None:
+                entry = self._values[label_values] = [0] * (len(self.buckets) + 3)
+            entry[index] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    def render(self) -> list:
+        with self._lock:
+            items = [(values, list(entry)) for values, entry in self._values.items()]
+        lines = []
+        for values, entry in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), entry):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, values, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, values)} {_format_value(entry[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, values)} {entry[-1]}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name: str, help: str, labels=()) -> Counter:
+        metric = Counter(name, help, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help: str, labels=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(name, help, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collect):
+        """collect() -> iterable of (name, type, help, [(labels dict, value), ...])"""
+        self._collectors.append(collect)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        for collect in self._collectors:
+            for name, kind, help, samples in collect():
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(labels.keys(), labels.values())} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+http_requests = registry.counter(
+    "http_requests_total", "HTTP requests by route and status", ("method", "route", "status"))
+http_latency = registry.histogram(
+    "http_request_duration_seconds", "HTTP request latency by route and status", ("method", "route", "status"))
+
+class MetricsMiddleware:
+    """Pure ASGI middleware recording request count and latency per route template"""
+
+    def __init__(self, app):
+        self.app = app
+        self._routes = {}  # endpoint -> route path, lấy từ app.routes khi gặp lần đầu
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        started = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # Router ghi endpoint vào scope; request không khớp route nào gom chung một nhãn
+            route = self._route(scope)
+            elapsed = time.perf_counter() - started
+            http_requests.inc(scope["method"], route, status)
+            http_latency.observe(elapsed, scope["method"], route, status)
+
+    def _route(self, scope) -> str:
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+        route = self._routes.get(endpoint)
+        if route is None:
+            app = scope.get("app")
+            for candidate in getattr(app, "routes", ()):
+                if getattr(candidate, "endpoint", None) is endpoint or getattr(candidate, "app", None) is endpoint:
+                    route = candidate.path
+                    break
+            route = self._routes[endpoint] = route or "unmatched"
+        return route
+
+class StructuredLogger:
+    """Leveled key=value logging with optional sampling for hot-path events"""
+
+    def __init__(self, name: str, level: str = LOG_LEVEL, sample_rate: float = LOG_SAMPLE_RATE):
+        self._logger = logging.getLogger(name)
+        self._logger.setLevel(level)
+        if not self._logger.handlers:
+            handler = logging.StreamHandler(sys.stderr)
+            handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+            self._logger.addHandler(handler)
+            self._logger.propagate = False
+        self.sample_rate = sample_rate
+
+    def log(self, level: int, event: str, sample: bool = False, **fields):
+        # Kiểm tra level / sampling trước khi format để log bị tắt gần như miễn phí
+        if not self._logger.isEnabledFor(level):
+            return
+        if sample and random.random() >= self.sample_rate:
+            return
+        message = " ".join([event] + [f"{key}={json.dumps(value, default=str)}" for key, value in fields.items()])
+        self._logger.log(level, message)
+
+    def debug(self, event: str, sample: bool = False, **fields):
+        self.log(logging.DEBUG, event, sample, **fields)
+
+    def info(self, event: str, sample: bool = False, **fields):
+        self.log(logging.INFO, event, sample, **fields)
+
+    def warning(self, event: str, sample: bool = False, **fields):
+        self.log(logging.WARNING, event, sample, **fields)
+
+    def error(self, event: str, sample: bool = False, **fields):
+        self.log(logging.ERROR, event, sample, **fields)
@@ -0,0 +1,138 @@
+# passwords.py
+"""Admin password hashing on a dedicated, bounded thread pool.
+
+New hashes use scrypt from hashlib ("scrypt$n$r$p$salt$hash", base64 salt
+and hash), or PBKDF2-SHA256 ("pbkdf2_sha256$iterations$salt$hash") when the
+linked OpenSSL has no scrypt. Hashes written before this module are a bare
+hex SHA-256 of the password; they still verify and are reported as needing
+an upgrade so the caller can rehash on the next successful login.
+
+A KDF call costs tens of milliseconds of CPU, so the async API runs it on
+its own PASSWORD_WORKERS threads rather than the database executor or the
+event loop, which caps how much CPU logins can take from check_license. At
+most PASSWORD_MAX_PENDING calls may wait for a thread; beyond that
+PasswordBusy is raised instead of queueing a login burst without bound.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", 2))
+PASSWORD_MAX_PENDING = int(os.getenv("PASSWORD_MAX_PENDING", 32))
+SCRYPT_N = int(os.getenv("PASSWORD_SCRYPT_N", 2 ** 14))
+SCRYPT_R = 8
+SCRYPT_P = 1
+PBKDF2_ITERATIONS = int(os.getenv("PASSWORD_PBKDF2_ITERATIONS", 600000))
+
+HAS_SCRYPT = hasattr(hashlib, "scrypt")
+
+class PasswordBusy(Exception):
+    """Too many password hashes are already waiting for the pool"""
+
+def _b64(data: bytes) -> str:
+    return base64.b64encode(data).decode()
+
+def hash_password(password: str) -> str:
+    """Hash a password with the current KDF (blocking)"""
+    salt = secrets.token_bytes(16)
+    if HAS_SCRYPT:
+        digest = hashlib.scrypt(password.encode(), salt=salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P, dklen=32)
+        return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${_b64(salt)}${_b64(digest)}"
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, PBKDF2_ITERATIONS)
+    return f"pbkdf2_sha256${PBKDF2_ITERATIONS}${_b64(salt)}${_b64(digest)}"
+
+def needs_upgrade(stored: str) -> bool:
+    """True if the hash is not in the current format or uses weaker parameters"""
+    if HAS_SCRYPT:
+        return not stored.startswith(f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}$")
+    return not stored.startswith(f"pbkdf2_sha256${PBKDF2_ITERATIONS}$")
+
+def verify_password(password: str, stored: str) -> bool:
+    """Check a password against any supported hash format (blocking)"""
+    scheme, _, rest = stored.partition("$")
+    try:
+        if scheme == "scrypt":
+            n, r, p, salt, digest = rest.split("$")
+            expected = base64.b64decode(digest)
+            actual = hashlib.scrypt(password.encode(), salt=base64.b64decode(salt),
+                                    n=int(n), r=int(r), p=int(p), dklen=len(expected))
+        elif scheme == "pbkdf2_sha256":
+            iterations, salt, digest = rest.split("$")
+            expected = base64.b64decode(digest)
+            actual = hashlib.pbkdf2_hmac("sha256", password.encode(), base64.b64decode(salt), int(iterations))
+        else:
+            # Hash cũ: SHA-256 hex không salt
+            expected = stored.encode()
+            actual = hashlib.sha256(password.encode()).hexdigest().encode()
+    except (ValueError, TypeError):
+        return False  # hash hỏng trong DB: coi như sai mật khẩu
+    return hmac.compare_digest(actual, expected)
+
+class PasswordHasher:
+    """Async front end running KDF work on its own capped thread pool"""
+
+    def __init__(self, workers: int, max_pending: int):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._dummy_hash = None
+        self.hashed = 0
+        self.verified = 0
+        self.rejected = 0
+
+    def _pool(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="kdf")
+        return self._executor
+
+    async def _submit(self, fn, *args):
+        with self._lock:
+            if self._pending >= self.max_pending + self.workers:
+                self.rejected += 1
+                raise PasswordBusy()
+            self._pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._pool(), fn, *args)
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    async def hash(self, password: str) -> str:
+        self.hashed += 1
+        return await self._submit(hash_password, password)
+
+    async def verify(self, password: str, stored: str) -> bool:
+        self.verified += 1
+        return await self._submit(verify_password, password, stored)
+
+    async def verify_missing(self, password: str) -> bool:
+        """Spend the same KDF time for an unknown user, so timing does not reveal which usernames exist"""
+        if self._dummy_hash is None:
+            self._dummy_hash = await self._submit(hash_password, secrets.token_hex(8))
+        await self.verify(password, self._dummy_hash)
+        return False
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def stats(self) -> dict:
+        return {
+            "algorithm": "scrypt" if HAS_SCRYPT else "pbkdf2_sha256",
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "in_flight": self._pending,
+            "hashed": self.hashed,
+            "verified": self.verified,
+            "rejected": self.rejected
+        }
+
+hasher = PasswordHasher(PASSWORD_WORKERS, PASSWORD_MAX_PENDING)
@@ -0,0 +1,54 @@
+# responses.py
+"""Pre-encoded JSON responses for the large list endpoints.
+
+A dict returned from a FastAPI handler goes through jsonable_encoder, which
+walks and copies every value of every row before json.dumps runs; for a
+page of a thousand licenses that walk costs several times the encoding
+itself. The list endpoints instead return JSONBytesResponse, whose body is
+encoded in one call, and read their rows with record_factory so each row
+already is the dict the API returns.
+
+Encoding uses orjson when it is installed (optional: pip install orjson)
+and the standard json module otherwise; both produce the same compact
+UTF-8 JSON as Starlette's JSONResponse. `python bench.py serialize`
+measures both paths.
+"""
+import json
+
+from starlette.responses import Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def dumps(content) -> bytes:
+    """Compact UTF-8 JSON, as JSONResponse would render it"""
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode()
+
+class JSONBytesResponse(Response):
+    """JSON response rendered with dumps(), skipping jsonable_encoder"""
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+def record_factory(*fields: str, bools: tuple = ()):
+    """sqlite3 row_factory building {field: value} dicts; columns named in bools become True/False.
+
+    fields phải khớp thứ tự cột trong SELECT. Gán cho cursor (không phải
+    connection) vì connection của pool dùng chung cho mọi truy vấn khác.
+    """
+    if not bools:
+        def factory(cursor, row):
+            return dict(zip(fields, row))
+        return factory
+
+    def factory(cursor, row):
+        record = dict(zip(fields, row))
+        for field in bools:
+            record[field] = bool(record[field])
+        return record
+    return factory
@@ -1,19 +1,39 @@
 # main.py
-from fastapi import FastAPI, HTTPException, Depends, Header
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
-from pydantic import BaseModel
+from fastapi.responses import FileResponse, StreamingResponse, PlainTextResponse, Response
+from pydantic import BaseModel, Field
 from datetime import datetime, timedelta
 import sqlite3
 import hashlib
 import secrets
 import uvicorn
-from typing import Optional, List
+from typing import Optional, List, NamedTuple
+from collections import OrderedDict
+import threading
+import time
 import hmac
+import math
 import base64
+import json
+import re
+import csv
+import io
 import os
 
+import cluster
+import database
+import events
+import httpcache
+import leases
+import maintenance
+import metrics
+import passwords
+import responses
+import stats
+import throttle
+
 app = FastAPI(title="AwingConnect License Server", version="3.0.0")
 
 # CORS middleware
@@ -25,52 +45,109 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Đếm request và đo latency theo route cho /metrics
+app.add_middleware(metrics.MetricsMiddleware)
+
+# Nén gzip body lớn (ngoài cùng, sau metrics); bỏ qua SSE
+app.add_middleware(httpcache.CompressionMiddleware)
+
+log = metrics.StructuredLogger("license_server")
+
 # Security - THAY ĐỔI KEY NÀY TRONG MÔI TRƯỜNG PRODUCTION
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-here-change-in-production")
 
+# Token admin tự chứa (ký HMAC), thời hạn và chu kỳ dọn session/mốc thu hồi hết hạn
+ADMIN_SESSION_HOURS = float(os.getenv("ADMIN_SESSION_HOURS", 24))
+SESSION_PURGE_SECONDS = float(os.getenv("SESSION_PURGE_SECONDS", 3600))
+# Ticket dùng một lần để mở /api/events (thay cho token trong query string)
+EVENT_TICKET_SECONDS = float(os.getenv("EVENT_TICKET_SECONDS", 60))
+
+# License verdict cache - kích thước và TTL có thể chỉnh qua biến môi trường
+LICENSE_CACHE_SIZE = int(os.getenv("LICENSE_CACHE_SIZE", 10000))
+LICENSE_CACHE_TTL = float(os.getenv("LICENSE_CACHE_TTL", 60))
+
+# Phân trang get_messages
+MESSAGES_PAGE_SIZE = int(os.getenv("MESSAGES_PAGE_SIZE", 200))
+MESSAGES_MAX_PAGE_SIZE = int(os.getenv("MESSAGES_MAX_PAGE_SIZE", 1000))
+
+# Phân trang / export /api/licenses
+LICENSES_PAGE_SIZE = int(os.getenv("LICENSES_PAGE_SIZE", 100))
+LICENSES_MAX_PAGE_SIZE = int(os.getenv("LICENSES_MAX_PAGE_SIZE", 1000))
+LICENSE_EXPORT_CHUNK = int(os.getenv("LICENSE_EXPORT_CHUNK", 1000))
+
+# /api/search: số kết quả mỗi trang
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", 20))
+SEARCH_MAX_PAGE_SIZE = int(os.getenv("SEARCH_MAX_PAGE_SIZE", 100))
+SEARCH_RANK_WINDOW = int(os.getenv("SEARCH_RANK_WINDOW", 2000))
+
+# Tạo license hàng loạt: số key tối đa mỗi request và mỗi transaction
+LICENSE_BULK_MAX = int(os.getenv("LICENSE_BULK_MAX", 100000))
+LICENSE_BULK_CHUNK = int(os.getenv("LICENSE_BULK_CHUNK", 5000))
+# Số license mỗi admin được tạo hàng loạt mỗi giây (bucket đầy = LICENSE_BULK_MAX); 0 = không giới hạn
+LICENSE_BULK_RATE = float(os.getenv("LICENSE_BULK_RATE", 200))
+
+# Kiểm tra license theo lô (relay / gateway): số cặp (key, hwid) tối đa mỗi request
+LICENSE_BATCH_MAX = int(os.getenv("LICENSE_BATCH_MAX", 1000))
+LICENSE_BATCH_CHUNK = 500  # số key mỗi câu WHERE key IN (...)
+
+# Token bucket cho check_license: request/giây và burst theo IP, license key, HWID (rate 0 = tắt)
+CHECK_RATE_IP = float(os.getenv("CHECK_RATE_IP", 20))
+CHECK_BURST_IP = float(os.getenv("CHECK_BURST_IP", 60))
+CHECK_RATE_KEY = float(os.getenv("CHECK_RATE_KEY", 2))
+CHECK_BURST_KEY = float(os.getenv("CHECK_BURST_KEY", 10))
+CHECK_RATE_HWID = float(os.getenv("CHECK_RATE_HWID", 2))
+CHECK_BURST_HWID = float(os.getenv("CHECK_BURST_HWID", 10))
+RATE_LIMIT_MAX_SUBJECTS = int(os.getenv("RATE_LIMIT_MAX_SUBJECTS", 100000))
+
+# Gom used_count / last_used và ghi theo lô thay vì commit mỗi request
+USAGE_FLUSH_INTERVAL_MS = int(os.getenv("USAGE_FLUSH_INTERVAL_MS", 1000))
+USAGE_FLUSH_MAX_PENDING = int(os.getenv("USAGE_FLUSH_MAX_PENDING", 1000))
+
 # Mount static files for admin panel
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 # Helper functions
-def hash_password(password: str) -> str:
-    """Hash password using SHA256"""
-    return hashlib.sha256(password.encode()).hexdigest()
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
 
-def verify_password(password: str, hashed: str) -> bool:
-    """Verify password against hash"""
-    return hash_password(password) == hashed
+def _sign(data: str) -> str:
+    return _b64encode(hmac.new(SECRET_KEY.encode(), data.encode(), hashlib.sha256).digest())
 
 def create_session_token(username: str) -> str:
-    """Create session token - ĐÃ SỬA LỖI DATABASE LOCK"""
-    timestamp = str(int(datetime.now().timestamp()))
-    data = f"{username}:{timestamp}"
-    signature = base64.b64encode(
-        hmac.new(SECRET_KEY.encode(), data.encode(), hashlib.sha256).digest()
-    ).decode()
-    token = f"{signature}:{timestamp}"
-    
-    # SỬA: Sử dụng connection context manager để tránh database lock
-    try:
-        conn = sqlite3.connect('licenses.db', timeout=10)  # Thêm timeout
-        c = conn.cursor()
-        
-        # Xóa session cũ của user - SỬA: dùng REPLACE thay vì DELETE + INSERT
-        c.execute(
-            "INSERT OR REPLACE INTO admin_sessions (session_token, username, created_at, expires_at) VALUES (?, ?, ?, ?)",
-            (token, username, datetime.now().isoformat(), (datetime.now() + timedelta(hours=24)).isoformat())
-        )
-        
-        conn.commit()
-        conn.close()
-        
-        return token
-    except sqlite3.Error as e:
-        print(f"Database error in create_session_token: {e}")
-        # Fallback: tạo token mà không lưu vào database
-        return token
+    """Create a stateless session token: base64url(claims).base64url(HMAC-SHA256)
+
+    Claims: sub = username, iat / exp = issue and expiry time in epoch milliseconds.
+    """
+    issued_at = int(time.time() * 1000)
+    claims = {"sub": username, "iat": issued_at, "exp": issued_at + int(ADMIN_SESSION_HOURS * 3600 * 1000)}
+    payload = _b64encode(json.dumps(claims, separators=(',', ':')).encode())
+    return f"{payload}.{_sign(payload)}"
 
 def verify_session_token(token: str) -> Optional[str]:
-    """Verify session token and return username - ĐÃ SỬA LỖI DATABASE LOCK"""
+    """Verify a signed session token in memory and return username"""
+    parts = token.split('.')
+    if len(parts) != 2:
+        return None
+    
+    payload, signature = parts
+    if not hmac.compare_digest(signature, _sign(payload)):
+        return None
+    
+    try:
+        claims = json.loads(_b64decode(payload))
+        username, issued_at, expires_at = claims["sub"], claims["iat"], claims["exp"]
+    except (ValueError, KeyError, TypeError):
+        return None
+    
+    if time.time() * 1000 > expires_at or session_revocations.is_revoked(username, issued_at):
+        return None
+    return username
+
+def verify_legacy_session_token(token: str) -> Optional[str]:
+    """Verify an old "signature:timestamp" token stored in admin_sessions"""
     try:
         # Tách token và timestamp
         parts = token.split(':')
@@ -79,15 +156,14 @@ def verify_session_token(token: str) -> Optional[str]:
             
         token_part, timestamp = parts
         
-        # Tìm session trong database - SỬA: dùng connection riêng
+        # Tìm session trong database
         try:
-            conn = sqlite3.connect('licenses.db', timeout=10)
-            c = conn.cursor()
-            c.execute("SELECT username, expires_at FROM admin_sessions WHERE session_token = ?", (token,))
-            session_data = c.fetchone()
-            conn.close()
+            with database.connection() as conn:
+                session_data = conn.execute(
+                    "SELECT username, expires_at FROM admin_sessions WHERE session_token = ?", (token,)
+                ).fetchone()
         except sqlite3.Error as e:
-            print(f"Database error in verify_session_token: {e}")
+            log.error("legacy_session_db_error", error=str(e))
             return None
         
         if session_data:
@@ -95,17 +171,17 @@ def verify_session_token(token: str) -> Optional[str]:
             
             # Kiểm tra token hết hạn
             if datetime.now() > datetime.fromisoformat(expires_at):
-                # Xóa session hết hạn - SỬA: dùng connection riêng
+                # Xóa session hết hạn
                 try:
-                    conn = sqlite3.connect('licenses.db', timeout=10)
-                    c = conn.cursor()
-                    c.execute("DELETE FROM admin_sessions WHERE session_token = ?", (token,))
-                    conn.commit()
-                    conn.close()
+                    with database.transaction() as conn:
+                        conn.execute("DELETE FROM admin_sessions WHERE session_token = ?", (token,))
                 except sqlite3.Error:
                     pass  # Bỏ qua lỗi khi xóa session hết hạn
                 return None
             
+            if session_revocations.is_revoked(username, int(timestamp) * 1000):
+                return None
+            
             # Xác thực token signature
             data = f"{username}:{timestamp}"
             expected_token = base64.b64encode(
@@ -115,54 +191,131 @@ def verify_session_token(token: str) -> Optional[str]:
             if hmac.compare_digest(token_part, expected_token):
                 return username
     except Exception as e:
-        print(f"Token verification error: {e}")
+        log.warning("token_verification_failed", error=str(e))
     
     return None
+
+async def authenticate_token(token: str) -> Optional[str]:
+    """Resolve an admin token to a username; only legacy tokens need the database"""
+    if ':' in token:
+        return await database.executor.submit("admin", verify_legacy_session_token, token)
+    return verify_session_token(token)
+
+class SessionRevocations:
+    """Per-admin revocation marks for stateless session tokens.
+
+    Logout and admin deletion store "every token of this user issued up to now
+    is invalid" in admin_revocations and in memory; verification only reads
+    the in-memory dict. Marks older than the token lifetime cannot match a
+    live token any more and are purged periodically, together with expired
+    rows of the legacy admin_sessions table.
+    """
+
+    def __init__(self, ttl_hours: float, purge_interval: float):
+        self.ttl_ms = int(ttl_hours * 3600 * 1000)
+        self.purge_interval = purge_interval
+        self._revoked_before = {}  # username -> epoch ms
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+        self.revocations = 0
+        self.purged_sessions = 0
+        self.purged_marks = 0
+
+    def load(self, conn):
+        rows = conn.execute("SELECT username, revoked_before FROM admin_revocations").fetchall()
+        with self._lock:
+            self._revoked_before = dict(rows)
+
+    def is_revoked(self, username: str, issued_at_ms: int) -> bool:
+        revoked_before = self._revoked_before.get(username)
+        return revoked_before is not None and issued_at_ms <= revoked_before
+
+    def revoke(self, conn, username: str):
+        """Revoke every token of username issued so far; call inside the handler's transaction"""
+        revoked_before = int(time.time() * 1000)
+        conn.execute("INSERT OR REPLACE INTO admin_revocations (username, revoked_before) VALUES (?, ?)",
+                     (username, revoked_before))
+        # Ghi vào bộ nhớ (mọi worker) ngay: nếu transaction rollback thì chỉ là thu hồi thừa
+        cluster.bus.emit("admin_revoked", username, revoked_before)
+
+    def mark(self, username: str, revoked_before: int):
+        with self._lock:
+            self._revoked_before[username] = max(revoked_before, self._revoked_before.get(username, 0))
+            self.revocations += 1
+
+    def purge(self) -> int:
+        """Delete expired session rows and revocation marks no token can hit any more"""
+        cutoff = int(time.time() * 1000) - self.ttl_ms
+        with database.transaction() as conn:
+            sessions = conn.execute("DELETE FROM admin_sessions WHERE expires_at < ?",
+                                    (datetime.now().isoformat(),)).rowcount
+            conn.execute("DELETE FROM admin_revocations WHERE revoked_before < ?", (cutoff,))
+        with self._lock:
+            stale = [u for u, t in self._revoked_before.items() if t < cutoff]
+            for username in stale:
+                del self._revoked_before[username]
+        self.purged_sessions += sessions
+        self.purged_marks += len(stale)
+        return sessions
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="session-purge", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread.join()
+            self._thread = None
+
+    def stats(self) -> dict:
+        return {
+            "revoked_users": len(self._revoked_before),
+            "revocations": self.revocations,
+            "purged_sessions": self.purged_sessions,
+            "purged_marks": self.purged_marks,
+            "purge_interval_seconds": self.purge_interval
+        }
+
+    def _run(self):
+        while not self._stopping.wait(self.purge_interval):
+            try:
+                self.purge()
+            except sqlite3.Error as e:
+                log.error("session_purge_db_error", error=str(e))
+
+session_revocations = SessionRevocations(ADMIN_SESSION_HOURS, SESSION_PURGE_SECONDS)
+search_enabled = False  # init_db đặt lại: SQLite có FTS5 và migration đã tạo bảng search
     
 # Database setup
 def init_db():
-    conn = sqlite3.connect('licenses.db')
-    c = conn.cursor()
-    
-    # Licenses table
-    c.execute('''CREATE TABLE IF NOT EXISTS licenses
-                 (key TEXT PRIMARY KEY, created_at TEXT, expires_at TEXT, 
-                  is_active INTEGER, hwid TEXT, used_count INTEGER,
-                  last_used TEXT, customer_name TEXT, customer_email TEXT)''')
-    
-    # Chat messages table
-    c.execute('''CREATE TABLE IF NOT EXISTS chat_messages
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  license_key TEXT, hwid TEXT, message TEXT, 
-                  sender_type TEXT, timestamp TEXT,
-                  is_read INTEGER DEFAULT 0)''')
-    
-    # Admin users table
-    c.execute('''CREATE TABLE IF NOT EXISTS admin_users
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  username TEXT UNIQUE, 
-                  password_hash TEXT,
-                  created_at TEXT,
-                  is_active INTEGER DEFAULT 1)''')
-    
-    # Admin sessions table
-    c.execute('''CREATE TABLE IF NOT EXISTS admin_sessions
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  session_token TEXT UNIQUE,
-                  username TEXT,
-                  created_at TEXT,
-                  expires_at TEXT)''')
-    
-    # Tạo admin mặc định nếu chưa có
-    c.execute("SELECT COUNT(*) FROM admin_users WHERE username = 'admin'")
-    if c.fetchone()[0] == 0:
-        password_hash = hash_password("admin123")
-        c.execute("INSERT INTO admin_users (username, password_hash, created_at) VALUES (?, ?, ?)",
-                 ("admin", password_hash, datetime.now().isoformat()))
-        print("Default admin user created: admin / admin123")
-    
-    conn.commit()
-    conn.close()
+    with database.connection() as conn:
+        database.migrate(conn)
+        session_revocations.load(conn)
+        global search_enabled
+        search_enabled = database.search_available(conn)
+        
+        for name, plan in database.check_query_plans(conn).items():
+            log.warning("hot_query_full_scan", query=name, plan=" | ".join(plan))
+        
+        # Tạo admin mặc định nếu chưa có
+        c = conn.cursor()
+        c.execute("SELECT COUNT(*) FROM admin_users WHERE username = 'admin'")
+        if c.fetchone()[0] == 0:
+            password_hash = passwords.hash_password("admin123")
+            # OR IGNORE: các worker khởi động cùng lúc có thể cùng thấy chưa có admin
+            c.execute("INSERT OR IGNORE INTO admin_users (username, password_hash, created_at) VALUES (?, ?, ?)",
+                     ("admin", password_hash, datetime.now().isoformat()))
+            if c.rowcount:
+                log.warning("default_admin_created", username="admin", password="admin123")
+        conn.commit()
+        
+        # Nạp bộ đếm cho /api/status và /api/admin/stats
+        stats.counters.reconcile(conn)
 
 init_db()
 
@@ -171,11 +324,37 @@ class LicenseRequest(BaseModel):
     key: str
     hwid: str
 
+class LeaseRenewal(BaseModel):
+    lease: str = Field(..., max_length=2048)
+
+class LicenseBatchRequest(BaseModel):
+    requests: List[LicenseRequest] = Field(..., min_length=1, max_length=LICENSE_BATCH_MAX)
+
 class LicenseCreate(BaseModel):
     days_valid: int = 30
     customer_name: Optional[str] = None
     customer_email: Optional[str] = None
 
+class LicenseBulkCreate(BaseModel):
+    count: int = Field(..., ge=1, le=LICENSE_BULK_MAX)
+    days_valid: int = 30
+    customer_name: Optional[str] = None
+    customer_email: Optional[str] = None
+
+class LicenseSelection(BaseModel):
+    """Licenses targeted by a bulk operation: a key list and/or filters (ANDed)"""
+    keys: Optional[List[str]] = Field(None, max_length=LICENSE_BULK_MAX)
+    customer_name: Optional[str] = None
+    customer_email: Optional[str] = None
+    created_from: Optional[datetime] = None
+    created_to: Optional[datetime] = None
+    expires_from: Optional[datetime] = None
+    expires_to: Optional[datetime] = None
+
+class LicenseBulkUpdate(LicenseSelection):
+    is_active: Optional[bool] = None
+    days_to_add: Optional[int] = None
+
 class ChatMessage(BaseModel):
     license_key: Optional[str] = None
     hwid: Optional[str] = None
@@ -198,6 +377,303 @@ def generate_license_key():
     """Generate a secure license key"""
     return f"AWC-{secrets.token_hex(6).upper()}-{secrets.token_hex(4).upper()}"
 
+class LicenseRecord(NamedTuple):
+    """Decoded licenses row as needed by check_license"""
+    key: str
+    created_at: str
+    expires_at: str
+    expires_ts: int
+    is_active: bool
+    hwid: str
+    customer_name: Optional[str]
+    lease_limited_until: Optional[int]
+
+def license_verdict(record: Optional[LicenseRecord], hwid: str, now_ts: int):
+    """Return (status_code, detail) if the license must be rejected, None if valid.
+
+    now_ts là database.epoch(now), so sánh số nguyên với cột expires_ts.
+    """
+    if record is None:
+        return 404, "License key not found"
+    if not record.is_active:
+        return 403, "License is inactive"
+    if now_ts > record.expires_ts:
+        return 403, "License has expired"
+    if record.hwid and record.hwid != hwid:
+        return 403, "License is already used on another device"
+    return None
+
+class LicenseCache:
+    """Bounded TTL/LRU cache of license records keyed on (key, hwid).
+
+    Only answers that do not depend on a pending HWID bind are cached: unknown
+    keys and licenses already bound to a device. Every write to a license must
+    call invalidate() so the next check goes back to the database.
+
+    A record read from the database may be overtaken by an invalidation that
+    lands while the read is in flight; callers take generation(key) before the
+    read and pass it to put(), which drops the record if the key was
+    invalidated in between.
+    """
+
+    GENERATION_STRIPES = 4096
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # (key, hwid) -> (stored_at, record)
+        self._hwids_by_key = {}        # key -> set(hwid), phục vụ invalidate theo key
+        # Đếm số lần invalidate theo nhóm key (hash % số nhóm) để bộ nhớ không tăng theo số key;
+        # key cùng nhóm chỉ làm put bị bỏ qua nhầm, không bao giờ giữ record cũ
+        self._generations = [0] * self.GENERATION_STRIPES
+        self._cleared = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.stale_puts = 0
+
+    def generation(self, key: str) -> tuple:
+        """Take before reading a record from the database; pass to put()"""
+        with self._lock:
+            return self._cleared, self._generations[hash(key) % self.GENERATION_STRIPES]
+
+    def get(self, key: str, hwid: str):
+        """Return (found, record); record is None for a cached "not found" answer"""
+        with self._lock:
+            entry = self._entries.get((key, hwid))
+            if entry is None:
+                self.misses += 1
+                return False, None
+            stored_at, record = entry
+            if time.monotonic() - stored_at > self.ttl:
+                self._remove((key, hwid))
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end((key, hwid))
+            self.hits += 1
+            return True, record
+
+    def put(self, key: str, hwid: str, record: Optional[LicenseRecord], generation: tuple):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            if generation != (self._cleared, self._generations[hash(key) % self.GENERATION_STRIPES]):
+                # Có invalidate trong lúc đang đọc DB: record có thể đã cũ
+                self.stale_puts += 1
+                return
+            self._entries[(key, hwid)] = (time.monotonic(), record)
+            self._entries.move_to_end((key, hwid))
+            self._hwids_by_key.setdefault(key, set()).add(hwid)
+            while len(self._entries) > self.max_size:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate(self, key: str):
+        """Drop every cached entry for a license key"""
+        self.invalidate_many((key,))
+
+    def invalidate_many(self, keys):
+        """Drop every cached entry for each of the keys, under one lock acquisition"""
+        with self._lock:
+            for key in keys:
+                self._generations[hash(key) % self.GENERATION_STRIPES] += 1
+                for hwid in self._hwids_by_key.pop(key, ()):
+                    if self._entries.pop((key, hwid), None) is not None:
+                        self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._cleared += 1
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self._hwids_by_key.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "stale_puts": self.stale_puts
+            }
+
+    def _remove(self, cache_key):
+        self._entries.pop(cache_key, None)
+        key, hwid = cache_key
+        hwids = self._hwids_by_key.get(key)
+        if hwids is not None:
+            hwids.discard(hwid)
+            if not hwids:
+                del self._hwids_by_key[key]
+
+license_cache = LicenseCache(LICENSE_CACHE_SIZE, LICENSE_CACHE_TTL)
+
+class UsageBatcher:
+    """Write-behind aggregation of license usage counters.
+
+    check_license only records (key, last_used) in memory; a background thread
+    applies the accumulated increments in one transaction every interval, as
+    soon as max_pending distinct keys are waiting, and once more on shutdown.
+    """
+
+    def __init__(self, interval_ms: int, max_pending: int):
+        self.interval = interval_ms / 1000
+        self.max_pending = max_pending
+        self._pending = {}  # key -> [used_count increment, latest last_used]
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self.recorded = 0
+        self.flushes = 0
+        self.flushed_keys = 0
+        self.failed_flushes = 0
+
+    def record(self, key: str, last_used: str, count: int = 1):
+        with self._lock:
+            self._merge(key, count, last_used)
+            self.recorded += count
+            if len(self._pending) >= self.max_pending:
+                self._wakeup.set()
+
+    def flush(self) -> int:
+        """Apply all pending increments in a single transaction"""
+        with self._lock:
+            batch, self._pending = self._pending, {}
+        if not batch:
+            return 0
+        
+        try:
+            with database.transaction() as conn:
+                # Vẫn một transaction; execute từng key để biết key nào còn tồn tại
+                c = conn.cursor()
+                used = []
+                for key, (count, last_used) in batch.items():
+                    c.execute("""UPDATE licenses SET used_count = used_count + ?, last_used = ?, last_used_ts = ?
+                                 WHERE key = ?""",
+                              (count, last_used, database.epoch(datetime.fromisoformat(last_used)), key))
+                    if c.rowcount:
+                        used.append((key, last_used))
+        except sqlite3.Error as e:
+            log.error("usage_flush_db_error", error=str(e))
+            self.failed_flushes += 1
+            # Trả lại batch để lần flush sau ghi tiếp, không mất số liệu
+            with self._lock:
+                for key, (count, last_used) in batch.items():
+                    self._merge(key, count, last_used)
+            return 0
+        
+        for key, last_used in used:
+            cluster.bus.emit("stats", "license_used", key, last_used)
+        self.flushes += 1
+        self.flushed_keys += len(batch)
+        return len(batch)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="usage-batcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the flusher thread and write out whatever is still pending"""
+        if self._thread is not None:
+            self._stopping.set()
+            self._wakeup.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def stats(self) -> dict:
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            "pending_keys": pending,
+            "flush_interval_ms": int(self.interval * 1000),
+            "max_pending": self.max_pending,
+            "recorded": self.recorded,
+            "flushes": self.flushes,
+            "flushed_keys": self.flushed_keys,
+            "failed_flushes": self.failed_flushes
+        }
+
+    def _merge(self, key: str, count: int, last_used: str):
+        entry = self._pending.get(key)
+        if entry is None:
+            self._pending[key] = [count, last_used]
+        else:
+            entry[0] += count
+            if last_used > entry[1]:
+                entry[1] = last_used
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+usage_batcher = UsageBatcher(USAGE_FLUSH_INTERVAL_MS, USAGE_FLUSH_MAX_PENDING)
+
+change_versions = httpcache.ChangeVersions("licenses", "chat")
+etag_cache = httpcache.ETagCache(httpcache.HTTP_CACHE_ENTRIES, httpcache.HTTP_CACHE_MAX_AGE_SECONDS)
+
+# Sự kiện stats không đi kèm licenses_changed / chat_event nhưng vẫn đổi dữ liệu trả về
+STATS_EVENT_TABLES = {"license_used": "licenses", "messages_archived": "chat"}
+
+def on_licenses_changed(keys: list):
+    license_cache.invalidate_many(keys)
+    change_versions.bump("licenses")
+
+def on_stats(event: str, *args):
+    stats.counters.apply(event, *args, change_id=cluster.bus.change_id)
+    if event in STATS_EVENT_TABLES:
+        change_versions.bump(STATS_EVENT_TABLES[event])
+
+def on_chat_event(topics: list, event: str, data: dict):
+    events.hub.publish(topics, event, data)
+    change_versions.bump("chat")
+
+def on_resync():
+    license_cache.clear()
+    change_versions.bump_all()
+
+# Trạng thái trong process đổi qua cluster.bus.emit() để mọi worker cùng thấy
+cluster.bus.register("licenses_changed", on_licenses_changed)
+cluster.bus.register("stats", on_stats)
+cluster.bus.register("chat_event", on_chat_event)
+cluster.bus.register("admin_revoked", session_revocations.mark)
+cluster.bus.on_resync(on_resync)
+
+@app.on_event("startup")
+async def start_background_workers():
+    database.pool.reopen()
+    usage_batcher.start()
+    stats.counters.start()
+    session_revocations.start()
+    cluster.bus.start()
+    maintenance.maintenance.start()
+
+@app.on_event("shutdown")
+async def stop_background_workers():
+    database.executor.shutdown()
+    maintenance.maintenance.stop()
+    usage_batcher.stop()
+    stats.counters.stop()
+    session_revocations.stop()
+    cluster.bus.stop()
+    passwords.hasher.shutdown()
+    database.pool.close()
+
 async def get_current_admin(authorization: Optional[str] = Header(None)):
     if not authorization:
         raise HTTPException(
@@ -222,7 +698,7 @@ async def get_current_admin(authorization: Optional[str] = Header(None)):
             headers={"WWW-Authenticate": "Bearer"},
         )
     
-    username = verify_session_token(token)
+    username = await authenticate_token(token)
     if not username:
         raise HTTPException(
             status_code=401,
@@ -231,6 +707,31 @@ async def get_current_admin(authorization: Optional[str] = Header(None)):
         )
     return username
 
+CONDITIONAL_HEADERS = {"Cache-Control": "private, no-cache"}
+
+async def conditional_json(http_request: Request, versions: tuple, build) -> Response:
+    """JSON response with an ETag; If-None-Match is answered with 304 from versions alone when possible.
+
+    versions: change_versions.get(...) của các bảng mà body phụ thuộc, lấy TRƯỚC
+    khi đọc DB. build() trả về (content, valid_until) - valid_until
+    (database.epoch) là lúc body tự đổi theo thời gian, math.inf nếu không.
+    """
+    resource = f"{http_request.url.path}?{http_request.url.query}"
+    requested = httpcache.parse_if_none_match(http_request.headers.get("if-none-match"))
+    tag = etag_cache.match(resource, requested, versions, database.epoch(datetime.now()))
+    if tag is not None:
+        return Response(status_code=304, headers={"ETag": tag, **CONDITIONAL_HEADERS})
+    
+    content, valid_until = await build()
+    body = responses.dumps(content)
+    tag = httpcache.etag(body)
+    etag_cache.store(resource, tag, versions, valid_until)
+    not_modified = tag.removeprefix("W/") in requested
+    etag_cache.record_build(not_modified)
+    if not_modified:
+        return Response(status_code=304, headers={"ETag": tag, **CONDITIONAL_HEADERS})
+    return Response(body, media_type="application/json", headers={"ETag": tag, **CONDITIONAL_HEADERS})
+
 # Serve admin panel
 @app.get("/")
 async def serve_admin():
@@ -247,73 +748,233 @@ async def serve_js():
 @app.get("/api/status")
 async def server_status():
     """Check server status"""
-    conn = sqlite3.connect('licenses.db')
-    c = conn.cursor()
-    
-    c.execute("SELECT COUNT(*) FROM licenses")
-    total_licenses = c.fetchone()[0]
-    
-    c.execute("SELECT COUNT(*) FROM licenses WHERE is_active = 1")
-    active_licenses = c.fetchone()[0]
-    
-    c.execute("SELECT COUNT(*) FROM chat_messages")
-    total_messages = c.fetchone()[0]
-    
-    conn.close()
+    now = datetime.now()
+    counts = stats.counters.snapshot(now)
     
     return {
         "status": "online",
-        "total_licenses": total_licenses,
-        "active_licenses": active_licenses,
-        "total_messages": total_messages,
-        "server_time": datetime.now().isoformat()
+        "total_licenses": counts["total_licenses"],
+        "active_licenses": counts["active_licenses"],
+        "total_messages": counts["total_messages"],
+        "server_time": now.isoformat()
     }
 
-@app.post("/api/check_license")
-async def check_license(request: LicenseRequest):
-    """Validate license key"""
-    conn = sqlite3.connect('licenses.db')
+def decode_license_row(row) -> LicenseRecord:
+    key, created_at, expires_at, expires_ts, is_active, bound_hwid, customer_name, lease_limited_until = row
+    return LicenseRecord(key, created_at, expires_at, expires_ts, bool(is_active), bound_hwid or "",
+                         customer_name, lease_limited_until)
+
+def bind_license_hwid(c, record: LicenseRecord, hwid: str):
+    """First activation: bind hwid unless another device got there first.
+
+    Returns (record with the HWID now bound, True if this call bound it).
+    """
+    c.execute("UPDATE licenses SET hwid = ? WHERE key = ? AND (hwid IS NULL OR hwid = '')",
+              (hwid, record.key))
+    if c.rowcount == 1:
+        return record._replace(hwid=hwid), True
+    c.execute("SELECT hwid FROM licenses WHERE key = ?", (record.key,))
+    bound = c.fetchone()
+    return record._replace(hwid=bound[0] if bound else ""), False
+
+def load_license_record(conn, license_key: str, hwid: str, now_ts: int) -> Optional[LicenseRecord]:
+    """Read a license for check_license, binding the HWID on first activation"""
     c = conn.cursor()
-    
-    c.execute("SELECT * FROM licenses WHERE key = ?", (request.key,))
+    c.execute(database.license_record_sql(), (license_key,))
     license_data = c.fetchone()
-    
     if not license_data:
-        conn.close()
-        raise HTTPException(status_code=404, detail="License key not found")
-    
-    key, created_at, expires_at, is_active, hwid, used_count, last_used, customer_name, customer_email = license_data
-    
-    if not is_active:
-        conn.close()
-        raise HTTPException(status_code=403, detail="License is inactive")
-    
-    if datetime.now() > datetime.fromisoformat(expires_at):
-        conn.close()
-        raise HTTPException(status_code=403, detail="License has expired")
-    
-    # Update usage statistics
-    if not hwid:
-        c.execute("UPDATE licenses SET hwid = ?, used_count = used_count + 1, last_used = ? WHERE key = ?", 
-                 (request.hwid, datetime.now().isoformat(), request.key))
-    elif hwid != request.hwid:
-        conn.close()
-        raise HTTPException(status_code=403, detail="License is already used on another device")
-    else:
-        c.execute("UPDATE licenses SET used_count = used_count + 1, last_used = ? WHERE key = ?", 
-                 (datetime.now().isoformat(), request.key))
+        return None
     
+    record = decode_license_row(license_data)
+    if not record.hwid and license_verdict(record, hwid, now_ts) is None:
+        # Kích hoạt lần đầu: bind HWID ngay (đồng bộ), chỉ khi chưa có máy nào bind trước
+        record, activated = bind_license_hwid(c, record, hwid)
+        conn.commit()
+        cluster.bus.emit("licenses_changed", [license_key])
+        if activated:
+            cluster.bus.emit("stats", "license_activated", license_key)
+    return record
+
+def load_license_records(conn, requests: List[LicenseRequest], now_ts: int) -> dict:
+    """Batch form of load_license_record: returns {key: LicenseRecord} for keys that exist.
+
+    Đọc bằng WHERE key IN (...) theo từng LICENSE_BATCH_CHUNK key; mọi lần bind
+    HWID lần đầu trong lô được ghi chung một transaction. Nếu lô có nhiều HWID
+    cho cùng một key chưa kích hoạt, HWID xuất hiện trước được bind.
+    """
+    c = conn.cursor()
+    keys = list(dict.fromkeys(r.key for r in requests))
+    records = {}
+    for i in range(0, len(keys), LICENSE_BATCH_CHUNK):
+        chunk = keys[i:i + LICENSE_BATCH_CHUNK]
+        c.execute(database.license_record_sql(len(chunk)), chunk)
+        for row in c.fetchall():
+            records[row[0]] = decode_license_row(row)
+    
+    binds = {}
+    for r in requests:
+        record = records.get(r.key)
+        if (record is not None and not record.hwid and r.key not in binds
+                and license_verdict(record, r.hwid, now_ts) is None):
+            binds[r.key] = r.hwid
+    if not binds:
+        return records
+    
+    activated = []
+    for key, hwid in binds.items():
+        records[key], bound = bind_license_hwid(c, records[key], hwid)
+        if bound:
+            activated.append(key)
     conn.commit()
-    conn.close()
-    
+    cluster.bus.emit("licenses_changed", list(binds))
+    for key in activated:
+        cluster.bus.emit("stats", "license_activated", key)
+    return records
+
+lease_signer = leases.LeaseSigner(leases.lease_key(SECRET_KEY))
+
+def issue_lease(record: LicenseRecord, now_ts: int) -> dict:
+    return lease_signer.issue(record.key, record.hwid, record.expires_at, record.expires_ts - now_ts,
+                              record.lease_limited_until)
+
+def valid_license_response(record: LicenseRecord, now_ts: int) -> dict:
     return {
         "status": "valid",
-        "expires_at": expires_at,
-        "created_at": created_at,
-        "customer_name": customer_name,
-        "days_remaining": (datetime.fromisoformat(expires_at) - datetime.now()).days
+        "expires_at": record.expires_at,
+        "created_at": record.created_at,
+        "customer_name": record.customer_name,
+        "days_remaining": (record.expires_ts - now_ts) // 86400,
+        **issue_lease(record, now_ts)
     }
 
+def check_rate_limiter(rate: float, burst: float) -> Optional[throttle.RateLimiter]:
+    return throttle.RateLimiter(rate, burst, RATE_LIMIT_MAX_SUBJECTS) if rate > 0 else None
+
+check_limiters = {
+    "ip": check_rate_limiter(CHECK_RATE_IP, CHECK_BURST_IP),
+    "key": check_rate_limiter(CHECK_RATE_KEY, CHECK_BURST_KEY),
+    "hwid": check_rate_limiter(CHECK_RATE_HWID, CHECK_BURST_HWID)
+}
+rate_limited = metrics.registry.counter(
+    "rate_limited_total", "Requests rejected with 429 by limiter", ("limiter",))
+
+def enforce_rate_limits(**subjects):
+    """Take a token from each limiter (ip=..., key=..., hwid=...); 429 + Retry-After if one is empty"""
+    for name, subject in subjects.items():
+        limiter = check_limiters[name]
+        if limiter is None:
+            continue
+        retry_after = limiter.acquire(subject)
+        if retry_after:
+            rate_limited.inc(name)
+            raise HTTPException(status_code=429, detail="Too many requests",
+                                headers={"Retry-After": str(math.ceil(retry_after))})
+
+def client_ip(http_request: Request) -> str:
+    return http_request.client.host if http_request.client else ""
+
+license_flights = throttle.SingleFlight()
+
+async def fetch_license_record(license_key: str, hwid: str, now_ts: int) -> Optional[LicenseRecord]:
+    generation = license_cache.generation(license_key)
+    record = await database.run("license", load_license_record, license_key, hwid, now_ts)
+    
+    # Chỉ cache khi không còn phụ thuộc vào việc bind HWID lần đầu
+    if record is None or record.hwid:
+        license_cache.put(license_key, hwid, record, generation)
+    return record
+
+async def validate_license(license_key: str, hwid: str, now: datetime) -> LicenseRecord:
+    """Cache / single-flight lookup + verdict shared by check_license and lease renewal"""
+    now_ts = database.epoch(now)
+    found, record = license_cache.get(license_key, hwid)
+    
+    shared = False
+    if not found:
+        # Các lần kiểm tra cùng (key, hwid) đang chờ DB dùng chung một lần đọc
+        record, shared = await license_flights.do(
+            (license_key, hwid), lambda: fetch_license_record(license_key, hwid, now_ts))
+    
+    verdict = license_verdict(record, hwid, now_ts)
+    if verdict:
+        raise HTTPException(status_code=verdict[0], detail=verdict[1])
+    
+    # Update usage statistics - ghi theo lô bởi usage_batcher; cả nhóm được gộp chỉ tính một lần
+    if not shared:
+        usage_batcher.record(license_key, now.isoformat())
+    return record
+
+@app.post("/api/check_license")
+async def check_license(request: LicenseRequest, http_request: Request):
+    """Validate license key; the answer carries a signed lease (see leases.py)"""
+    enforce_rate_limits(ip=client_ip(http_request), key=request.key, hwid=request.hwid)
+    
+    now = datetime.now()
+    record = await validate_license(request.key, request.hwid, now)
+    return valid_license_response(record, database.epoch(now))
+
+@app.post("/api/lease/renew")
+async def renew_lease(renewal: LeaseRenewal, http_request: Request):
+    """Exchange a lease for a fresh one if its license is still valid.
+
+    Lease đã hết hạn trong vòng LEASE_RENEW_GRACE_SECONDS vẫn renew được; quá
+    hạn đó client phải gọi lại /api/check_license. Trả về 401 nếu chữ ký sai,
+    các lỗi license (403/404) giống check_license.
+    """
+    claims = lease_signer.verify(renewal.lease, leases.LEASE_RENEW_GRACE_SECONDS)
+    if claims is None:
+        raise HTTPException(status_code=401, detail="Invalid or expired lease")
+    enforce_rate_limits(ip=client_ip(http_request), key=claims["key"], hwid=claims["hwid"])
+    
+    now = datetime.now()
+    record = await validate_license(claims["key"], claims["hwid"], now)
+    now_ts = database.epoch(now)
+    return {"status": "valid", "expires_at": record.expires_at, **issue_lease(record, now_ts)}
+
+@app.post("/api/check_license/batch")
+async def check_license_batch(batch: LicenseBatchRequest, http_request: Request):
+    """Validate many (key, hwid) pairs at once, với cùng luật như /api/check_license.
+
+    Trả về results theo đúng thứ tự requests; mục bị từ chối có status "invalid"
+    kèm status_code / detail giống lỗi HTTP của check_license. Giới hạn tốc độ
+    chỉ theo IP, mỗi lô tính một request.
+    """
+    enforce_rate_limits(ip=client_ip(http_request))
+    
+    now = datetime.now()
+    now_ts = database.epoch(now)
+    records = {}
+    missing = []
+    for r in batch.requests:
+        found, record = license_cache.get(r.key, r.hwid)
+        if found:
+            records[(r.key, r.hwid)] = record
+        else:
+            missing.append(r)
+    
+    if missing:
+        generations = {r.key: license_cache.generation(r.key) for r in missing}
+        loaded = await database.run("license", load_license_records, missing, now_ts)
+        for r in missing:
+            record = loaded.get(r.key)
+            records[(r.key, r.hwid)] = record
+            if record is None or record.hwid:
+                license_cache.put(r.key, r.hwid, record, generations[r.key])
+    
+    results = []
+    now_iso = now.isoformat()
+    for r in batch.requests:
+        record = records[(r.key, r.hwid)]
+        verdict = license_verdict(record, r.hwid, now_ts)
+        if verdict:
+            results.append({"key": r.key, "hwid": r.hwid, "status": "invalid",
+                            "status_code": verdict[0], "detail": verdict[1]})
+        else:
+            usage_batcher.record(r.key, now_iso)
+            results.append({"key": r.key, "hwid": r.hwid, **valid_license_response(record, now_ts)})
+    
+    return {"results": results}
+
 @app.post("/api/create_license")
 async def create_license(data: LicenseCreate):
     """Create a new license"""
@@ -321,16 +982,17 @@ async def create_license(data: LicenseCreate):
     created_at = datetime.now()
     expires_at = created_at + timedelta(days=data.days_valid)
     
-    conn = sqlite3.connect('licenses.db')
-    c = conn.cursor()
-    
-    c.execute("""INSERT INTO licenses 
-                 (key, created_at, expires_at, is_active, hwid, used_count, last_used, customer_name, customer_email) 
-                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-              (license_key, created_at.isoformat(), expires_at.isoformat(), 1, "", 0, None, data.customer_name, data.customer_email))
+    def insert(conn):
+        conn.execute("""INSERT INTO licenses 
+                        (key, created_at, expires_at, is_active, hwid, used_count, last_used, customer_name, customer_email,
+                         created_ts, expires_ts) 
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                     (license_key, created_at.isoformat(), expires_at.isoformat(), 1, "", 0, None, data.customer_name, data.customer_email,
+                      database.epoch(created_at), database.epoch(expires_at)))
     
-    conn.commit()
-    conn.close()
+    await database.run_transaction("admin", insert)
+    cluster.bus.emit("licenses_changed", [license_key])
+    cluster.bus.emit("stats", "license_created", license_key, expires_at.isoformat())
     
     return {
         "license_key": license_key,
@@ -340,39 +1002,139 @@ async def create_license(data: LicenseCreate):
         "days_valid": data.days_valid
     }
 
+def insert_license_chunk(conn, count: int, data: LicenseBulkCreate, created_at: datetime, expires_at: datetime) -> list:
+    """Insert count new licenses with fresh, collision-checked keys; returns the keys"""
+    # Giữ write lock từ lúc kiểm tra trùng key đến lúc insert
+    conn.execute("BEGIN IMMEDIATE")
+    keys = set()
+    while len(keys) < count:
+        candidates = {generate_license_key() for _ in range(count - len(keys))} - keys
+        placeholders = ", ".join("?" * len(candidates))
+        taken = {row[0] for row in conn.execute(
+            f"SELECT key FROM licenses WHERE key IN ({placeholders})", list(candidates))}
+        keys |= candidates - taken
+    
+    keys = list(keys)
+    row = (created_at.isoformat(), expires_at.isoformat(), data.customer_name, data.customer_email,
+           database.epoch(created_at), database.epoch(expires_at))
+    conn.executemany("""INSERT INTO licenses 
+                        (key, created_at, expires_at, is_active, hwid, used_count, last_used, customer_name, customer_email,
+                         created_ts, expires_ts) 
+                        VALUES (?, ?, ?, 1, '', 0, NULL, ?, ?, ?, ?)""",
+                     [(key,) + row for key in keys])
+    return keys
+
+bulk_create_limiter = (throttle.RateLimiter(LICENSE_BULK_RATE, LICENSE_BULK_MAX, RATE_LIMIT_MAX_SUBJECTS)
+                       if LICENSE_BULK_RATE > 0 else None)
+
+@app.post("/api/licenses/bulk")
+async def create_licenses_bulk(data: LicenseBulkCreate, current_admin: str = Depends(get_current_admin)):
+    """Create `count` licenses sharing duration and customer.
+
+    Key được ghi theo từng transaction LICENSE_BULK_CHUNK dòng và stream về dạng
+    NDJSON ngay khi commit: mỗi dòng {"license_key": ...}, dòng cuối là tổng kết
+    {"status": "success" | "error", "created": n, ...}. Mỗi admin tạo tối đa
+    LICENSE_BULK_RATE license/giây (429 + Retry-After khi vượt).
+    """
+    if bulk_create_limiter is not None:
+        retry_after = bulk_create_limiter.acquire(current_admin, data.count)
+        if retry_after:
+            rate_limited.inc("bulk_create")
+            raise HTTPException(status_code=429, detail="Too many licenses created, try again later",
+                                headers={"Retry-After": str(math.ceil(retry_after))})
+    created_at = datetime.now()
+    expires_at = created_at + timedelta(days=data.days_valid)
+    expires_iso = expires_at.isoformat()
+    
+    async def body():
+        created = 0
+        try:
+            while created < data.count:
+                keys = await database.run_transaction("admin", insert_license_chunk,
+                                                      min(LICENSE_BULK_CHUNK, data.count - created),
+                                                      data, created_at, expires_at)
+                created += len(keys)
+                cluster.bus.emit("licenses_changed", keys)
+                cluster.bus.emit("stats", "licenses_created", keys, expires_iso)
+                yield "".join(json.dumps({"license_key": key}) + "\n" for key in keys)
+        except sqlite3.Error as e:
+            # Header 200 đã gửi đi: báo lỗi ở dòng cuối, các key đã stream vẫn hợp lệ
+            log.error("bulk_create_db_error", created=created, error=str(e))
+            yield json.dumps({"status": "error", "detail": "Database error", "created": created}) + "\n"
+            return
+        
+        yield json.dumps({
+            "status": "success",
+            "created": created,
+            "created_at": created_at.isoformat(),
+            "expires_at": expires_iso,
+            "customer_name": data.customer_name,
+            "days_valid": data.days_valid
+        }) + "\n"
+    
+    return StreamingResponse(body(), media_type="application/x-ndjson")
+
+def chat_topics(license_key: Optional[str], hwid: Optional[str] = None) -> list:
+    """Event topics interested in a conversation: admins, the license and the device"""
+    topics = [events.admin_topic()]
+    if license_key:
+        topics.append(events.license_topic(license_key))
+    if hwid:
+        topics.append(events.hwid_topic(hwid))
+    return topics
+
+def count_unread(conn, license_key: Optional[str]) -> int:
+    """Unread user messages of one conversation (licenses.unread_count, kept by triggers)"""
+    if not license_key:
+        return 0
+    row = conn.execute("SELECT unread_count FROM licenses WHERE key = ?", (license_key,)).fetchone()
+    return row[0] if row else 0
+
 @app.post("/api/send_message")
 async def send_message(message: ChatMessage):
-    """Send a chat message - ĐÃ SỬA ĐỂ LƯU ĐÚNG DATABASE"""
-    conn = sqlite3.connect('licenses.db')
-    c = conn.cursor()
+    """Send a chat message"""
+    sent_at = datetime.now()
+    timestamp = sent_at.isoformat()
     
-    try:
+    def insert(conn):
+        c = conn.cursor()
+        
         # Kiểm tra license có tồn tại không (nếu có license_key)
         if message.license_key:
-            c.execute("SELECT * FROM licenses WHERE key = ?", (message.license_key,))
-            license_data = c.fetchone()
-            if not license_data:
-                conn.close()
+            c.execute("SELECT 1 FROM licenses WHERE key = ?", (message.license_key,))
+            if not c.fetchone():
                 raise HTTPException(status_code=404, detail="License not found")
         
         # Lưu tin nhắn vào database
         c.execute("""INSERT INTO chat_messages 
-                     (license_key, hwid, message, sender_type, timestamp) 
-                     VALUES (?, ?, ?, ?, ?)""",
+                     (license_key, hwid, message, sender_type, timestamp, ts) 
+                     VALUES (?, ?, ?, ?, ?, ?)""",
                   (message.license_key, message.hwid, message.message, 
-                   message.sender_type, datetime.now().isoformat()))
-        
-        message_id = c.lastrowid
-        conn.commit()
+                   message.sender_type, timestamp, database.epoch(sent_at)))
+        return c.lastrowid, count_unread(conn, message.license_key)
+    
+    try:
+        message_id, unread_count = await database.run_transaction("chat", insert)
         
-        print(f"DEBUG: Message saved - ID: {message_id}, License: {message.license_key}, Sender: {message.sender_type}")  # Debug log
+        log.debug("message_saved", sample=True, message_id=message_id,
+                  license_key=message.license_key, sender_type=message.sender_type)
         
-    except Exception as e:
-        conn.rollback()
-        conn.close()
+    except sqlite3.Error as e:
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
     
-    conn.close()
+    cluster.bus.emit("stats", "message_created")
+    
+    # Đẩy tin nhắn tới admin và client đang subscribe /api/events
+    cluster.bus.emit("chat_event", chat_topics(message.license_key, message.hwid), "message", {
+        "id": message_id,
+        "license_key": message.license_key,
+        "hwid": message.hwid,
+        "message": message.message,
+        "sender_type": message.sender_type,
+        "timestamp": timestamp,
+        "is_read": False,
+        "unread_count": unread_count
+    })
     
     return {
         "status": "success",
@@ -380,38 +1142,86 @@ async def send_message(message: ChatMessage):
         "message": "Message sent successfully"
     }
 
+MESSAGE_FIELDS = database.MESSAGE_COLUMNS
+message_record = responses.record_factory(*MESSAGE_FIELDS, bools=("is_read",))
+
 @app.get("/api/get_messages")
-async def get_messages(license_key: Optional[str] = None, hwid: Optional[str] = None):
-    """Get chat messages - ĐÃ SỬA ĐỂ LẤY ĐÚNG DỮ LIỆU"""
-    conn = sqlite3.connect('licenses.db')
-    c = conn.cursor()
-    
-    try:
-        if license_key:
-            # Lấy tin nhắn theo license_key
-            c.execute("""SELECT * FROM chat_messages 
-                         WHERE license_key = ? 
-                         ORDER BY timestamp ASC""", (license_key,))
-        elif hwid:
-            # Lấy tin nhắn theo hwid
-            c.execute("""SELECT * FROM chat_messages 
-                         WHERE hwid = ? 
-                         ORDER BY timestamp ASC""", (hwid,))
-        else:
-            # Lấy tất cả tin nhắn (cho admin)
-            c.execute("""SELECT * FROM chat_messages 
-                         ORDER BY timestamp ASC""")
+async def get_messages(http_request: Request,
+                       license_key: Optional[str] = None, hwid: Optional[str] = None,
+                       since_id: Optional[int] = Query(None, ge=0),
+                       before_id: Optional[int] = Query(None, ge=1),
+                       limit: int = Query(MESSAGES_PAGE_SIZE, ge=1, le=MESSAGES_MAX_PAGE_SIZE)):
+    """Get chat messages, một trang mỗi lần.
+
+    since_id: chỉ lấy tin mới hơn cursor (dùng next_cursor của lần gọi trước khi poll).
+    Không có since_id: lấy `limit` tin mới nhất (trước before_id nếu có), xếp tăng dần.
+    Có ETag: poll lại với If-None-Match được 304 khi chat không đổi.
+    """
+    if license_key:
+        where, params = "license_key = ?", [license_key]
+    elif hwid:
+        where, params = "hwid = ?", [hwid]
+    else:
+        # Tất cả tin nhắn (cho admin) - luôn phân trang
+        where, params = "", []
+    
+    def query(conn):
+        if since_id is not None:
+            sql = database.messages_sql(where, "since")
+            rows = fetch_records(conn, message_record, sql, params + [since_id, limit + 1])
+            return rows[:limit], len(rows) > limit
         
-        messages = c.fetchall()
+        if before_id is not None:
+            sql = database.messages_sql(where, "before")
+            rows = fetch_records(conn, message_record, sql, params + [before_id, limit + 1])
+        else:
+            sql = database.messages_sql(where, None)
+            rows = fetch_records(conn, message_record, sql, params + [limit + 1])
+        has_older = len(rows) > limit
+        return rows[:limit][::-1], has_older
+    
+    async def build():
+        try:
+            messages, more = await database.run("chat", query)
+            
+            log.debug("messages_loaded", sample=True, count=len(messages), license_key=license_key,
+                      hwid=hwid, since_id=since_id)
+            
+        except sqlite3.Error as e:
+            raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
         
-        print(f"DEBUG: Found {len(messages)} messages for license_key: {license_key}")  # Debug log
+        if since_id is not None:
+            next_cursor = messages[-1]["id"] if messages else since_id
+            has_more, older_cursor = more, None
+        else:
+            next_cursor = messages[-1]["id"] if messages else (before_id - 1 if before_id else 0)
+            has_more, older_cursor = False, (messages[0]["id"] if messages and more else None)
         
-    except Exception as e:
-        conn.close()
-        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+        return {
+            "messages": messages,
+            "next_cursor": next_cursor,
+            "has_more": has_more,
+            "older_cursor": older_cursor
+        }, math.inf
     
-    conn.close()
+    return await conditional_json(http_request, change_versions.get("chat"), build)
+
+@app.get("/api/get_messages/archive")
+async def get_archived_messages(license_key: Optional[str] = None, hwid: Optional[str] = None,
+                                before_id: Optional[int] = Query(None, ge=1),
+                                limit: int = Query(MESSAGES_PAGE_SIZE, ge=1, le=MESSAGES_MAX_PAGE_SIZE)):
+    """Chat history đã được maintenance chuyển sang archive (cũ hơn CHAT_RETENTION_DAYS).
+
+    Cùng bộ lọc với get_messages; đọc lùi dần bằng before_id = older_cursor.
+    """
+    try:
+        # File archive riêng, không dùng connection của pool
+        rows = await database.executor.submit("chat", maintenance.read_archived_messages,
+                                              license_key, hwid, before_id, limit + 1)
+    except sqlite3.Error as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
     
+    messages = rows[:limit][::-1]
     return {
         "messages": [
             {
@@ -421,89 +1231,151 @@ async def get_messages(license_key: Optional[str] = None, hwid: Optional[str] =
                 "message": m[3],
                 "sender_type": m[4],
                 "timestamp": m[5],
-                "is_read": bool(m[6])
+                "is_read": bool(m[6]),
+                "archived": True
             } for m in messages
-        ]
+        ],
+        "older_cursor": messages[0][0] if messages and len(rows) > limit else None
     }
+
 @app.post("/api/messages/{message_id}/mark_read")
 async def mark_message_read(message_id: int):
     """Mark message as read"""
-    conn = sqlite3.connect('licenses.db')
-    c = conn.cursor()
-    
-    c.execute("UPDATE chat_messages SET is_read = 1 WHERE id = ?", (message_id,))
+    def update(conn):
+        message_data = conn.execute("SELECT license_key, hwid, is_read FROM chat_messages WHERE id = ?",
+                                    (message_id,)).fetchone()
+        if not message_data:
+            return None
+        license_key, hwid, is_read = message_data
+        if not is_read:
+            conn.execute("UPDATE chat_messages SET is_read = 1 WHERE id = ?", (message_id,))
+        return license_key, hwid, not is_read, count_unread(conn, license_key)
     
-    if c.rowcount == 0:
-        conn.close()
+    result = await database.run_transaction("chat", update)
+    if result is None:
         raise HTTPException(status_code=404, detail="Message not found")
     
-    conn.commit()
-    conn.close()
+    license_key, hwid, newly_read, unread_count = result
+    if newly_read:
+        cluster.bus.emit("stats", "messages_read", 1)
+    cluster.bus.emit("chat_event", chat_topics(license_key, hwid), "read", {
+        "license_key": license_key,
+        "message_id": message_id,
+        "unread_count": unread_count
+    })
     
     return {"status": "success", "message": "Message marked as read"}
 
+def event_ticket_hash(ticket: str) -> str:
+    return hashlib.sha256(ticket.encode()).hexdigest()
+
+@app.post("/api/events/ticket")
+async def create_event_ticket(current_admin: str = Depends(get_current_admin)):
+    """Single-use ticket for opening /api/events as admin.
+
+    EventSource không gửi được header Authorization, còn URL (kể cả query) hay bị
+    ghi vào access log / proxy, nên access token không đi qua URL: admin đổi nó lấy
+    một ticket dùng một lần, hết hạn sau EVENT_TICKET_SECONDS. Ticket lưu trong DB
+    (chỉ hash) để worker nào nhận kết nối stream cũng đổi được.
+    """
+    ticket = secrets.token_urlsafe(32)
+    now = time.time()
+    
+    def store(conn):
+        conn.execute("DELETE FROM event_tickets WHERE expires_ts < ?", (now,))
+        conn.execute("INSERT INTO event_tickets (ticket_hash, username, expires_ts) VALUES (?, ?, ?)",
+                     (event_ticket_hash(ticket), current_admin, now + EVENT_TICKET_SECONDS))
+    
+    await database.run_transaction("admin", store)
+    return {"ticket": ticket, "expires_in": EVENT_TICKET_SECONDS}
+
+def redeem_event_ticket(conn, ticket: str) -> Optional[str]:
+    """Consume a ticket; returns its admin username, None if unknown, expired or already used"""
+    ticket_hash = event_ticket_hash(ticket)
+    row = conn.execute("SELECT username FROM event_tickets WHERE ticket_hash = ?", (ticket_hash,)).fetchone()
+    # rowcount == 1 chỉ ở một request khi hai kết nối cùng đổi một ticket
+    deleted = conn.execute("DELETE FROM event_tickets WHERE ticket_hash = ? AND expires_ts >= ?",
+                           (ticket_hash, time.time())).rowcount
+    return row[0] if row and deleted == 1 else None
+
+@app.get("/api/events")
+async def event_stream(ticket: Optional[str] = None, license_key: Optional[str] = None, hwid: Optional[str] = None):
+    """Server-Sent Events stream of chat events.
+
+    Admin: ?ticket=<ticket từ POST /api/events/ticket> nhận mọi hội thoại.
+    Client: ?license_key=...&hwid=... chỉ nhận hội thoại của mình.
+    """
+    if ticket:
+        username = await database.run_transaction("admin", redeem_event_ticket, ticket)
+        if not username:
+            raise HTTPException(status_code=401, detail="Invalid or expired ticket")
+        topics = [events.admin_topic()]
+    elif license_key and hwid:
+        def lookup(conn):
+            return conn.execute("SELECT hwid FROM licenses WHERE key = ?", (license_key,)).fetchone()
+        
+        license_data = await database.run("license", lookup)
+        if not license_data:
+            raise HTTPException(status_code=404, detail="License not found")
+        if license_data[0] and license_data[0] != hwid:
+            raise HTTPException(status_code=403, detail="License is already used on another device")
+        topics = [events.license_topic(license_key), events.hwid_topic(hwid)]
+    else:
+        raise HTTPException(status_code=400, detail="ticket or license_key and hwid are required")
+    
+    subscription = events.hub.subscribe(topics)
+    return StreamingResponse(
+        events.hub.stream(subscription),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.get("/api/get_active_users")
-async def get_active_users(current_admin: str = Depends(get_current_admin)):
-    """Get list of active users with their chat status - ENDPOINT MỚI"""
-    conn = sqlite3.connect('licenses.db', timeout=10)
-    c = conn.cursor()
-    
-    try:
-        # Lấy tất cả license đang active
-        c.execute("""
-            SELECT key, hwid, last_used 
-            FROM licenses 
-            WHERE is_active = 1 AND hwid IS NOT NULL AND hwid != ''
-        """)
-        licenses = c.fetchall()
+async def get_active_users(http_request: Request,
+                           limit: int = Query(100, ge=1, le=500), offset: int = Query(0, ge=0),
+                           current_admin: str = Depends(get_current_admin)):
+    """Get list of active users with their chat status (ETag / If-None-Match như get_messages)"""
+    now = datetime.now()
+    now_ts = database.epoch(now)
+    
+    def query(conn):
+        # Một truy vấn duy nhất: unread_count đã duy trì sẵn, trang đọc thẳng trên index,
+        # tin nhắn cuối chỉ lấy cho các license trong trang
+        return conn.execute(database.ACTIVE_USERS_QUERY, (limit + 1, offset)).fetchall()
+    
+    async def build():
+        try:
+            rows = await database.run("admin", query)
+        except sqlite3.Error as e:
+            raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
         
         active_users = []
-        
-        for license_key, hwid, last_used in licenses:
-            # Kiểm tra tin nhắn chưa đọc
-            c.execute("""
-                SELECT COUNT(*) FROM chat_messages 
-                WHERE license_key = ? AND sender_type = 'user' AND is_read = 0
-            """, (license_key,))
-            unread_count = c.fetchone()[0]
-            
-            # Lấy tin nhắn cuối cùng
-            c.execute("""
-                SELECT message FROM chat_messages 
-                WHERE license_key = ? 
-                ORDER BY timestamp DESC LIMIT 1
-            """, (license_key,))
-            last_message_data = c.fetchone()
-            last_message = last_message_data[0] if last_message_data else None
-            
+        valid_until = math.inf
+        for license_key, hwid, last_used, last_used_ts, unread_count, last_message in rows[:limit]:
             # Kiểm tra online status (nếu last_used trong 5 phút gần đây)
             is_online = False
-            if last_used:
-                last_used_time = datetime.fromisoformat(last_used)
-                time_diff = datetime.now() - last_used_time
-                is_online = time_diff.total_seconds() < 300  # 5 minutes
+            if last_used_ts is not None:
+                is_online = now_ts - last_used_ts < 300  # 5 minutes
+                if is_online:
+                    valid_until = min(valid_until, last_used_ts + 300)  # lúc chuyển offline
+            else:
+                valid_until = now_ts  # last_seen = now: body đổi mỗi giây
             
             active_users.append({
                 'license_key': license_key,
                 'hwid': hwid,
-                'last_seen': last_used or datetime.now().isoformat(),
+                'last_seen': last_used or now.isoformat(),
                 'is_online': is_online,
                 'unread_count': unread_count,
                 'last_message': last_message
             })
         
-        # Sắp xếp: có tin nhắn chưa đọc lên đầu, sau đó theo thời gian
-        active_users.sort(key=lambda x: (-x['unread_count'], x['last_seen']), reverse=True)
-        
-        conn.close()
-        
         return {
-            "users": active_users
-        }
-        
-    except Exception as e:
-        conn.close()
-        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+            "users": active_users,
+            "next_offset": offset + limit if len(rows) > limit else None
+        }, valid_until
+    
+    return await conditional_json(http_request, change_versions.get("licenses", "chat"), build)
     
     
 @app.post("/api/mark_messages_read")
@@ -514,114 +1386,123 @@ async def mark_messages_read(data: dict, current_admin: str = Depends(get_curren
     if not license_key:
         raise HTTPException(status_code=400, detail="License key is required")
     
-    conn = sqlite3.connect('licenses.db', timeout=10)
-    c = conn.cursor()
-    
-    try:
-        c.execute("""
+    def update(conn):
+        # Chỉ đụng các dòng chưa đọc để rowcount là số tin vừa được đọc
+        return conn.execute("""
             UPDATE chat_messages 
             SET is_read = 1 
-            WHERE license_key = ? AND sender_type = 'user'
-        """, (license_key,))
-        
-        conn.commit()
-        conn.close()
-        
-        return {"status": "success", "message": "Messages marked as read"}
-        
-    except Exception as e:
-        conn.close()
+            WHERE license_key = ? AND sender_type = 'user' AND is_read = 0
+        """, (license_key,)).rowcount
+    
+    try:
+        newly_read = await database.run_transaction("chat", update)
+    except sqlite3.Error as e:
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+    
+    if newly_read:
+        cluster.bus.emit("stats", "messages_read", newly_read)
+    cluster.bus.emit("chat_event", chat_topics(license_key), "read", {"license_key": license_key, "unread_count": 0})
+    
+    return {"status": "success", "message": "Messages marked as read"}
 # Admin endpoints
 @app.post("/api/admin/login")
 async def admin_login(login: AdminLogin):
-    """Admin login - ĐÃ SỬA LỖI DATABASE LOCK"""
+    """Admin login"""
+    def load_hash(conn):
+        row = conn.execute("SELECT password_hash FROM admin_users WHERE username = ? AND is_active = 1",
+                           (login.username,)).fetchone()
+        return row[0] if row else None
+    
+    def upgrade_hash(conn, old_hash: str, new_hash: str):
+        # Chỉ thay nếu hash chưa bị đổi (đổi mật khẩu / login khác đã nâng cấp) trong lúc tính
+        conn.execute("UPDATE admin_users SET password_hash = ? WHERE username = ? AND password_hash = ?",
+                     (new_hash, login.username, old_hash))
+    
     try:
-        conn = sqlite3.connect('licenses.db', timeout=10)  # Thêm timeout
-        c = conn.cursor()
-        
-        c.execute("SELECT * FROM admin_users WHERE username = ? AND is_active = 1", (login.username,))
-        admin_data = c.fetchone()
-        
-        if not admin_data or not verify_password(login.password, admin_data[2]):
-            conn.close()
+        # KDF chạy trên pool riêng của passwords, không chiếm thread DB hay event loop
+        stored = await database.run("admin", load_hash)
+        if stored is None:
+            await passwords.hasher.verify_missing(login.password)
+            raise HTTPException(status_code=401, detail="Invalid credentials")
+        if not await passwords.hasher.verify(login.password, stored):
             raise HTTPException(status_code=401, detail="Invalid credentials")
         
-        # Tạo session token - SỬA: tách riêng database operation
-        access_token = create_session_token(login.username)
+        # Hash SHA-256 cũ (hoặc tham số KDF cũ): băm lại bằng KDF hiện tại khi đã biết mật khẩu đúng.
+        # Chỉ là tối ưu: lỗi ở bước này không được chặn một lần đăng nhập đã hợp lệ
+        if passwords.needs_upgrade(stored):
+            try:
+                await database.run_transaction("admin", upgrade_hash, stored,
+                                               await passwords.hasher.hash(login.password))
+            except (passwords.PasswordBusy, sqlite3.Error) as e:
+                log.warning("password_upgrade_failed", username=login.username, error=str(e) or type(e).__name__)
         
-        conn.close()
+        access_token = create_session_token(login.username)
         
         return {
             "access_token": access_token,
             "token_type": "bearer",
             "username": login.username
         }
+    except HTTPException:
+        raise
+    except passwords.PasswordBusy:
+        raise HTTPException(status_code=503, detail="Too many login attempts in progress",
+                            headers={"Retry-After": "1"})
     except sqlite3.Error as e:
-        print(f"Database error in admin_login: {e}")
+        log.error("admin_login_db_error", username=login.username, error=str(e))
         raise HTTPException(status_code=500, detail="Database error")
     except Exception as e:
-        print(f"Unexpected error in admin_login: {e}")
+        log.error("admin_login_failed", username=login.username, error=repr(e))
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @app.post("/api/admin/logout")
 async def admin_logout(current_admin: str = Depends(get_current_admin)):
     """Admin logout"""
-    conn = sqlite3.connect('licenses.db')
-    c = conn.cursor()
+    def revoke(conn):
+        # Xóa session kiểu cũ lưu trong DB và thu hồi mọi token ký HMAC của user hiện tại
+        conn.execute("DELETE FROM admin_sessions WHERE username = ?", (current_admin,))
+        session_revocations.revoke(conn, current_admin)
     
-    # Xóa session của user hiện tại
-    c.execute("DELETE FROM admin_sessions WHERE username = ?", (current_admin,))
-    conn.commit()
-    conn.close()
+    await database.run_transaction("admin", revoke)
     
     return {"status": "success", "message": "Logged out successfully"}
 
 @app.post("/api/admin/create_user")
 async def create_admin_user(user: AdminCreate, current_admin: str = Depends(get_current_admin)):
     """Create new admin user"""
-    conn = sqlite3.connect('licenses.db')
-    c = conn.cursor()
+    try:
+        password_hash = await passwords.hasher.hash(user.password)
+    except passwords.PasswordBusy:
+        raise HTTPException(status_code=503, detail="Password hashing busy", headers={"Retry-After": "1"})
     
-    # Check if username already exists
-    c.execute("SELECT COUNT(*) FROM admin_users WHERE username = ?", (user.username,))
-    if c.fetchone()[0] > 0:
-        conn.close()
-        raise HTTPException(status_code=400, detail="Username already exists")
+    def insert(conn):
+        c = conn.cursor()
+        
+        # Check if username already exists
+        c.execute("SELECT COUNT(*) FROM admin_users WHERE username = ?", (user.username,))
+        if c.fetchone()[0] > 0:
+            raise HTTPException(status_code=400, detail="Username already exists")
+        
+        # Create new admin user
+        c.execute("INSERT INTO admin_users (username, password_hash, created_at) VALUES (?, ?, ?)",
+                 (user.username, password_hash, datetime.now().isoformat()))
     
-    # Create new admin user
-    password_hash = hash_password(user.password)
-    c.execute("INSERT INTO admin_users (username, password_hash, created_at) VALUES (?, ?, ?)",
-             (user.username, password_hash, datetime.now().isoformat()))
-    
-    conn.commit()
-    conn.close()
+    await database.run_transaction("admin", insert)
+    cluster.bus.emit("stats", "admin_created")
     
     return {
         "status": "success",
         "message": f"Admin user '{user.username}' created successfully"
     }
 
+admin_user_record = responses.record_factory("id", "username", "created_at", "is_active", bools=("is_active",))
+
 @app.get("/api/admin/users")
 async def get_admin_users(current_admin: str = Depends(get_current_admin)):
     """Get all admin users"""
-    conn = sqlite3.connect('licenses.db')
-    c = conn.cursor()
-    
-    c.execute("SELECT id, username, created_at, is_active FROM admin_users")
-    users = c.fetchall()
-    conn.close()
-    
-    return {
-        "users": [
-            {
-                "id": u[0],
-                "username": u[1],
-                "created_at": u[2],
-                "is_active": bool(u[3])
-            } for u in users
-        ]
-    }
+    users = await database.run("admin", fetch_records, admin_user_record,
+                               "SELECT id, username, created_at, is_active FROM admin_users", [])
+    return responses.JSONBytesResponse({"users": users})
 
 @app.delete("/api/admin/users/{username}")
 async def delete_admin_user(username: str, current_admin: str = Depends(get_current_admin)):
@@ -629,162 +1510,527 @@ async def delete_admin_user(username: str, current_admin: str = Depends(get_curr
     if username == current_admin:
         raise HTTPException(status_code=400, detail="Cannot delete your own account")
     
-    conn = sqlite3.connect('licenses.db')
-    c = conn.cursor()
-    
-    c.execute("DELETE FROM admin_users WHERE username = ?", (username,))
+    def delete(conn):
+        admin_data = conn.execute("SELECT is_active FROM admin_users WHERE username = ?", (username,)).fetchone()
+        if not admin_data:
+            return None
+        conn.execute("DELETE FROM admin_users WHERE username = ?", (username,))
+        conn.execute("DELETE FROM admin_sessions WHERE username = ?", (username,))
+        session_revocations.revoke(conn, username)
+        return bool(admin_data[0])
     
-    if c.rowcount == 0:
-        conn.close()
+    was_active = await database.run_transaction("admin", delete)
+    if was_active is None:
         raise HTTPException(status_code=404, detail="User not found")
-    
-    conn.commit()
-    conn.close()
+    cluster.bus.emit("stats", "admin_deleted", was_active)
     
     return {"status": "success", "message": f"User '{username}' deleted successfully"}
 
 @app.get("/api/admin/stats")
-async def get_admin_stats(current_admin: str = Depends(get_current_admin)):
-    """Get admin statistics"""
-    conn = sqlite3.connect('licenses.db')
-    c = conn.cursor()
-    
-    # License stats
-    c.execute("SELECT COUNT(*) FROM licenses")
-    total_licenses = c.fetchone()[0]
-    
-    c.execute("SELECT COUNT(*) FROM licenses WHERE is_active = 1")
-    active_licenses = c.fetchone()[0]
-    
-    c.execute("SELECT COUNT(*) FROM licenses WHERE datetime(expires_at) < datetime('now')")
-    expired_licenses = c.fetchone()[0]
-    
-    c.execute("SELECT COUNT(*) FROM licenses WHERE hwid != '' AND hwid IS NOT NULL")
-    activated_licenses = c.fetchone()[0]
-    
-    # Chat stats
-    c.execute("SELECT COUNT(*) FROM chat_messages")
-    total_messages = c.fetchone()[0]
-    
-    c.execute("SELECT COUNT(*) FROM chat_messages WHERE is_read = 0")
-    unread_messages = c.fetchone()[0]
-    
-    # User stats
-    c.execute("SELECT COUNT(*) FROM admin_users")
-    total_admins = c.fetchone()[0]
-    
-    c.execute("SELECT COUNT(*) FROM admin_users WHERE is_active = 1")
-    active_admins = c.fetchone()[0]
-    
-    # Recent activity
-    c.execute("SELECT COUNT(*) FROM licenses WHERE datetime(last_used) > datetime('now', '-7 days')")
-    recent_activity = c.fetchone()[0]
+async def get_admin_stats(http_request: Request, current_admin: str = Depends(get_current_admin)):
+    """Get admin statistics (served from stats.counters, no table scans).
+
+    Có ETag; khi 304 client giữ body cũ, kể cả server_time của lần tính đó.
+    """
+    versions = (stats.counters.version,)
     
-    conn.close()
+    async def build():
+        now = datetime.now()
+        return admin_stats_body(now), stats.counters.next_change(now)
     
+    return await conditional_json(http_request, versions, build)
+
+def admin_stats_body(now: datetime) -> dict:
+    counts = stats.counters.snapshot(now)
     return {
         "licenses": {
-            "total": total_licenses,
-            "active": active_licenses,
-            "expired": expired_licenses,
-            "activated": activated_licenses
+            "total": counts["total_licenses"],
+            "active": counts["active_licenses"],
+            "expired": counts["expired_licenses"],
+            "activated": counts["activated_licenses"]
         },
         "chat": {
-            "total_messages": total_messages,
-            "unread_messages": unread_messages
+            "total_messages": counts["total_messages"],
+            "unread_messages": counts["unread_messages"]
         },
         "admins": {
-            "total": total_admins,
-            "active": active_admins
+            "total": counts["total_admins"],
+            "active": counts["active_admins"]
         },
-        "recent_activity": recent_activity,
-        "server_time": datetime.now().isoformat()
+        "recent_activity": counts["recent_activity"],
+        "server_time": now.isoformat()
     }
 
-@app.get("/api/licenses")
-async def get_licenses(active_only: bool = False):
-    """Get all licenses"""
-    conn = sqlite3.connect('licenses.db')
-    c = conn.cursor()
+@app.get("/api/admin/runtime")
+async def get_runtime_stats(current_admin: str = Depends(get_current_admin)):
+    """License cache, usage write-behind and database layer counters"""
+    return {
+        "license_cache": license_cache.stats(),
+        "usage_batcher": usage_batcher.stats(),
+        "db_pool": database.pool.stats(),
+        "db_executor": database.executor.stats(),
+        "event_hub": events.hub.stats(),
+        "stats": stats.counters.stats(),
+        "admin_sessions": session_revocations.stats(),
+        "cluster": cluster.bus.stats(),
+        "rate_limits": {name: limiter.stats() for name, limiter in check_limiters.items() if limiter},
+        "bulk_create_limit": bulk_create_limiter.stats() if bulk_create_limiter else None,
+        "license_flights": license_flights.stats(),
+        "passwords": passwords.hasher.stats(),
+        "leases": lease_signer.stats(),
+        "http_cache": etag_cache.stats(),
+        "maintenance": maintenance.maintenance.stats()
+    }
+
+LICENSE_COLUMNS = database.LICENSE_COLUMNS
+LICENSE_SELECT = database.LICENSE_SELECT
+LICENSE_SORT_COLUMNS = {"key": "key", "created_at": "created_ts", "expires_at": "expires_ts"}
+
+class LicenseFilters(NamedTuple):
+    """Server-side filters and ordering shared by /api/licenses and its export"""
+    is_active: Optional[bool]
+    expired: Optional[bool]
+    activated: Optional[bool]
+    search: Optional[str]
+    sort: str
+    descending: bool
+
+def license_filters(active_only: bool = False,
+                    is_active: Optional[bool] = None,
+                    expired: Optional[bool] = None,
+                    activated: Optional[bool] = None,
+                    search: Optional[str] = Query(None, max_length=100),
+                    sort: str = Query("key", pattern="^(key|created_at|expires_at)$"),
+                    order: str = Query("asc", pattern="^(asc|desc)$")) -> LicenseFilters:
+    # active_only giữ lại cho client cũ, tương đương is_active=true
+    if active_only and is_active is None:
+        is_active = True
+    return LicenseFilters(is_active, expired, activated, search or None, sort, order == "desc")
+
+def license_page_query(filters: LicenseFilters, now_ts: int, after: Optional[list], limit: int):
+    """Build (sql, params) for one keyset page: rows ordered by (sort, key) after the cursor"""
+    # Dấu + trước cột lọc: không cho planner chọn index của cột lọc rồi sort cả
+    # tập kết quả, mỗi trang chỉ đi tiếp trên index (sort, key) tới khi đủ limit
+    expires = "expires_ts" if filters.sort == "expires_at" else "+expires_ts"
+    where, params = [], []
+    if filters.is_active is not None:
+        where.append("+is_active = ?")
+        params.append(1 if filters.is_active else 0)
+    if filters.expired is not None:
+        where.append(f"{expires} < ?" if filters.expired else f"{expires} >= ?")
+        params.append(now_ts)
+    if filters.activated is not None:
+        where.append("+hwid IS NOT NULL AND +hwid != ''" if filters.activated else "(+hwid IS NULL OR +hwid = '')")
+    if filters.search:
+        pattern = "%" + filters.search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        where.append("(key LIKE ? ESCAPE '\\' OR customer_name LIKE ? ESCAPE '\\' OR customer_email LIKE ? ESCAPE '\\')")
+        params.extend([pattern] * 3)
+    
+    columns = ("key",) if filters.sort == "key" else (LICENSE_SORT_COLUMNS[filters.sort], "key")
+    if after is not None:
+        params.extend(after)
+    
+    sql = database.license_page_sql(where, columns, filters.descending, after is not None)
+    return sql, params + [limit]
+
+def license_cursor_values(filters: LicenseFilters, row) -> list:
+    if filters.sort == "key":
+        return [row[0]]
+    return [row[LICENSE_SELECT.index(LICENSE_SORT_COLUMNS[filters.sort])], row[0]]
+
+def encode_license_cursor(values: list) -> str:
+    return _b64encode(json.dumps(values, separators=(',', ':')).encode())
+
+def decode_license_cursor(filters: LicenseFilters, cursor: Optional[str]) -> Optional[list]:
+    if cursor is None:
+        return None
+    try:
+        values = json.loads(_b64decode(cursor))
+    except ValueError:
+        values = None
+    # key là chuỗi, created_ts/expires_ts là số nguyên (bool của JSON cũng là int nên loại riêng)
+    types = (str,) if filters.sort == "key" else (int, str)
+    if not isinstance(values, list) or len(values) != len(types) or not all(
+            isinstance(value, t) and not isinstance(value, bool) for value, t in zip(values, types)):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+EXPIRES_TS_INDEX = LICENSE_SELECT.index("expires_ts")
+
+def license_is_expired(l, now_ts: int) -> bool:
+    return l[EXPIRES_TS_INDEX] is not None and now_ts > l[EXPIRES_TS_INDEX]
+
+def license_to_dict(l, now_ts: int) -> dict:
+    license = dict(zip(LICENSE_COLUMNS, l))
+    license["is_active"] = bool(license["is_active"])
+    license["is_expired"] = license_is_expired(l, now_ts)
+    return license
+
+def fetch_rows(conn, sql: str, params: list) -> list:
+    return conn.execute(sql, params).fetchall()
+
+def fetch_records(conn, factory, sql: str, params: list) -> list:
+    """fetch_rows với row_factory riêng cho cursor này (xem responses.record_factory)"""
+    cursor = conn.cursor()
+    cursor.row_factory = factory
+    return cursor.execute(sql, params).fetchall()
+
+def runtime_gauges():
+    """Scrape-time gauges built from the runtime stats of each subsystem"""
+    cache = license_cache.stats()
+    pool = database.pool.stats()
+    lanes = database.executor.stats()["lanes"]
+    hub = events.hub.stats()
+    return [
+        ("license_cache_entries", "gauge", "Entries in the license verdict cache", [({}, cache["size"])]),
+        ("license_cache_lookups_total", "counter", "License cache lookups by result",
+         [({"result": "hit"}, cache["hits"]), ({"result": "miss"}, cache["misses"])]),
+        ("usage_pending_keys", "gauge", "License keys with usage waiting for the next flush",
+         [({}, usage_batcher.stats()["pending_keys"])]),
+        ("db_pool_idle_connections", "gauge", "Idle pooled SQLite connections", [({}, pool["idle"])]),
+        ("db_lane_running", "gauge", "Database calls running per executor lane",
+         [({"lane": lane}, lane_stats["running"]) for lane, lane_stats in lanes.items()]),
+        ("db_lane_queue_depth", "gauge", "Database calls waiting for a slot per executor lane",
+         [({"lane": lane}, lane_stats["queue_depth"]) for lane, lane_stats in lanes.items()]),
+        ("event_subscribers", "gauge", "Open Server-Sent Events subscriptions", [({}, hub["subscribers"])]),
+        ("change_bus_pending", "gauge", "State changes waiting to be published to other workers",
+         [({}, cluster.bus.stats()["pending"])]),
+    ]
+
+metrics.registry.register_collector(runtime_gauges)
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus text exposition of request, SQL and runtime metrics"""
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+def fts_query(text: str) -> str:
+    """Turn free text into an FTS5 query: every word must match, the last one as a prefix.
+
+    Mỗi từ được đặt trong ngoặc kép nên cú pháp FTS5 (AND, NEAR, *, cột:) người
+    dùng gõ vào không thể làm hỏng câu MATCH. Chỉ từ cuối là tiền tố (đang gõ dở):
+    tiền tố phải gộp doclist của mọi từ bắt đầu bằng nó nên đắt hơn nhiều.
+    """
+    words = re.findall(r"\w+", text)
+    return " ".join([f'"{word}"' for word in words[:-1]] + [f'"{word}"*' for word in words[-1:]])
+
+# scope -> (bảng FTS, JOIN về bảng gốc, cột trả về)
+SEARCH_SCOPES = {
+    "messages": ("chat_fts", "chat_messages m ON m.id = chat_fts.rowid",
+                 "m.id, m.license_key, m.hwid, snippet(chat_fts, 0, '[', ']', '…', 16), "
+                 "m.sender_type, m.timestamp, m.is_read"),
+    "licenses": ("licenses_fts", "licenses l ON l.rowid = licenses_fts.rowid",
+                 "l.key, l.customer_name, l.customer_email, l.is_active, l.hwid, l.expires_at"),
+}
+
+def search_query(scope: str, match: str, license_key: Optional[str], order: str):
+    fts, join, columns = SEARCH_SCOPES[scope]
+    where, params = f"{fts} MATCH ?", [match]
+    if scope == "messages" and license_key:
+        where += " AND m.license_key = ?"
+        params.append(license_key)
     
-    if active_only:
-        c.execute("SELECT * FROM licenses WHERE is_active = 1")
+    if order == "rank":
+        # bm25 phải tính cho từng dòng khớp: với từ phổ biến (nửa bảng) chỉ xếp hạng
+        # SEARCH_RANK_WINDOW dòng khớp mới nhất, FTS5 nhận cận rowid >= ... trực tiếp
+        window = f"SELECT {fts}.rowid FROM {fts} JOIN {join} WHERE {where} ORDER BY {fts}.rowid DESC LIMIT 1 OFFSET ?"
+        where, params = f"{where} AND {fts}.rowid >= COALESCE(({window}), 0)", params + params + [SEARCH_RANK_WINDOW - 1]
+        order_by = "rank"
     else:
-        c.execute("SELECT * FROM licenses")
+        order_by = f"{fts}.rowid DESC"
+    return f"SELECT {columns} FROM {fts} JOIN {join} WHERE {where} ORDER BY {order_by} LIMIT ? OFFSET ?", params
+
+@app.get("/api/search")
+async def search(q: str = Query(..., min_length=1, max_length=200),
+                 scope: str = Query("messages", pattern="^(messages|licenses)$"),
+                 license_key: Optional[str] = None,
+                 order: str = Query("rank", pattern="^(rank|recent)$"),
+                 offset: int = Query(0, ge=0, le=10000),
+                 limit: int = Query(SEARCH_PAGE_SIZE, ge=1, le=SEARCH_MAX_PAGE_SIZE),
+                 current_admin: str = Depends(get_current_admin)):
+    """Full-text search, xếp theo độ liên quan (bm25) hoặc mới nhất trước.
+
+    scope=messages: nội dung chat (lọc thêm theo license_key nếu có), kèm snippet
+    với từ khớp đặt trong [ ]. scope=licenses: key, tên và email khách hàng.
+    order=rank xếp hạng SEARCH_RANK_WINDOW kết quả mới nhất; cũ hơn thì dùng
+    order=recent. Trang tiếp theo: offset = next_offset. Tin đã archive không
+    nằm trong index.
+    """
+    if not search_enabled:
+        raise HTTPException(status_code=503, detail="Full-text search is not available on this SQLite build")
+    match = fts_query(q)
+    if not match:
+        raise HTTPException(status_code=400, detail="Search query has no searchable words")
+    
+    sql, params = search_query(scope, match, license_key, order)
+    
+    def query(conn):
+        return conn.execute(sql, params + [limit + 1, offset]).fetchall()
     
-    licenses = c.fetchall()
-    conn.close()
+    try:
+        rows = await database.run("admin", query)
+    except sqlite3.Error as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
     
+    if scope == "messages":
+        results = [{"id": r[0], "license_key": r[1], "hwid": r[2], "snippet": r[3],
+                    "sender_type": r[4], "timestamp": r[5], "is_read": bool(r[6])} for r in rows[:limit]]
+    else:
+        results = [{"key": r[0], "customer_name": r[1], "customer_email": r[2], "is_active": bool(r[3]),
+                    "hwid": r[4], "expires_at": r[5]} for r in rows[:limit]]
     return {
-        "licenses": [
-            {
-                "key": l[0],
-                "created_at": l[1],
-                "expires_at": l[2],
-                "is_active": bool(l[3]),
-                "hwid": l[4],
-                "used_count": l[5],
-                "last_used": l[6],
-                "customer_name": l[7],
-                "customer_email": l[8],
-                "is_expired": datetime.now() > datetime.fromisoformat(l[2]) if l[2] else False
-            } for l in licenses
-        ]
+        "scope": scope,
+        "results": results,
+        "next_offset": offset + limit if len(rows) > limit else None
     }
 
+@app.get("/api/licenses")
+async def get_licenses(http_request: Request,
+                       filters: LicenseFilters = Depends(license_filters),
+                       cursor: Optional[str] = None,
+                       limit: int = Query(LICENSES_PAGE_SIZE, ge=1, le=LICENSES_MAX_PAGE_SIZE)):
+    """Get licenses, một trang mỗi lần.
+
+    Lọc: is_active / expired / activated (true|false), search (key, tên, email khách hàng).
+    Sắp xếp: sort=key|created_at|expires_at, order=asc|desc.
+    Trang tiếp theo: truyền lại next_cursor cùng bộ lọc và sắp xếp.
+    Có ETag; hết hiệu lực khi license bất kỳ được ghi hoặc hết hạn.
+    """
+    after = decode_license_cursor(filters, cursor)
+    
+    async def build():
+        now = datetime.now()
+        now_ts = database.epoch(now)
+        # Lấy trước khi đọc: license hết hạn sau mốc này có thể đổi is_expired / bộ lọc expired
+        valid_until = stats.counters.next_expiry(now)
+        sql, params = license_page_query(filters, now_ts, after, limit + 1)
+        
+        licenses = await database.run("admin", fetch_rows, sql, params)
+        
+        more = len(licenses) > limit
+        licenses = licenses[:limit]
+        return {
+            "licenses": [license_to_dict(l, now_ts) for l in licenses],
+            "next_cursor": encode_license_cursor(license_cursor_values(filters, licenses[-1])) if more else None
+        }, valid_until
+    
+    return await conditional_json(http_request, change_versions.get("licenses"), build)
+
+async def license_chunks(filters: LicenseFilters, now_ts: int):
+    """Yield the filtered licenses chunk by chunk; each chunk borrows a connection only briefly"""
+    after = None
+    while True:
+        sql, params = license_page_query(filters, now_ts, after, LICENSE_EXPORT_CHUNK)
+        rows = await database.run("admin", fetch_rows, sql, params)
+        if rows:
+            yield rows
+        if len(rows) < LICENSE_EXPORT_CHUNK:
+            return
+        after = license_cursor_values(filters, rows[-1])
+
+@app.get("/api/licenses/export")
+async def export_licenses(filters: LicenseFilters = Depends(license_filters),
+                          format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+                          current_admin: str = Depends(get_current_admin)):
+    """Stream every license matching the filters as NDJSON or CSV"""
+    now_ts = database.epoch(datetime.now())
+    
+    async def ndjson():
+        async for rows in license_chunks(filters, now_ts):
+            yield b"".join(responses.dumps(license_to_dict(l, now_ts)) + b"\n" for l in rows)
+    
+    async def csv_rows():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(LICENSE_COLUMNS + ("is_expired",))
+        async for rows in license_chunks(filters, now_ts):
+            for l in rows:
+                writer.writerow(l[:len(LICENSE_COLUMNS)] + (license_is_expired(l, now_ts),))
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue()
+    
+    if format == "csv":
+        body, media_type = csv_rows(), "text/csv"
+    else:
+        body, media_type = ndjson(), "application/x-ndjson"
+    return StreamingResponse(body, media_type=media_type,
+                             headers={"Content-Disposition": f'attachment; filename="licenses.{format}"'})
+
 @app.put("/api/licenses/{license_key}")
 async def update_license(license_key: str, update: LicenseUpdate):
     """Update license information"""
-    conn = sqlite3.connect('licenses.db')
-    c = conn.cursor()
-    
-    c.execute("SELECT * FROM licenses WHERE key = ?", (license_key,))
-    license_data = c.fetchone()
-    
-    if not license_data:
-        conn.close()
-        raise HTTPException(status_code=404, detail="License not found")
-    
-    updates = []
-    params = []
-    
-    if update.is_active is not None:
-        updates.append("is_active = ?")
-        params.append(1 if update.is_active else 0)
-    
-    if update.days_to_add is not None and update.days_to_add > 0:
-        current_expires = datetime.fromisoformat(license_data[2])
-        new_expires = current_expires + timedelta(days=update.days_to_add)
-        updates.append("expires_at = ?")
-        params.append(new_expires.isoformat())
-    
-    if updates:
-        query = f"UPDATE licenses SET {', '.join(updates)} WHERE key = ?"
-        params.append(license_key)
-        c.execute(query, params)
+    def apply(conn):
+        c = conn.cursor()
+        
+        c.execute("SELECT * FROM licenses WHERE key = ?", (license_key,))
+        license_data = c.fetchone()
+        
+        if not license_data:
+            raise HTTPException(status_code=404, detail="License not found")
+        
+        updates = []
+        params = []
+        
+        active_delta = 0
+        new_expires_at = None
+        
+        if update.is_active is not None:
+            updates.append("is_active = ?")
+            params.append(1 if update.is_active else 0)
+            active_delta = int(update.is_active) - int(bool(license_data[3]))
+            if active_delta:
+                # Lease đã phát không thu hồi được: từ giờ phát lease ngắn cho license này
+                updates.append("lease_limited_until = ?")
+                params.append(leases.limited_until())
+        
+        if update.days_to_add is not None and update.days_to_add > 0:
+            current_expires = datetime.fromisoformat(license_data[2])
+            new_expires = current_expires + timedelta(days=update.days_to_add)
+            new_expires_at = new_expires.isoformat()
+            updates.append("expires_at = ?, expires_ts = ?")
+            params.extend((new_expires_at, database.epoch(new_expires)))
+        
+        if updates:
+            query = f"UPDATE licenses SET {', '.join(updates)} WHERE key = ?"
+            params.append(license_key)
+            c.execute(query, params)
+        return active_delta, new_expires_at
     
-    conn.commit()
-    conn.close()
+    active_delta, new_expires_at = await database.run_transaction("admin", apply)
+    cluster.bus.emit("licenses_changed", [license_key])
+    cluster.bus.emit("stats", "license_updated", license_key, active_delta, new_expires_at)
     
     return {"status": "success", "message": "License updated successfully"}
 
 @app.delete("/api/licenses/{license_key}")
 async def delete_license(license_key: str):
     """Delete a license"""
-    conn = sqlite3.connect('licenses.db')
-    c = conn.cursor()
-    
-    c.execute("DELETE FROM licenses WHERE key = ?", (license_key,))
+    def delete(conn):
+        license_data = conn.execute("SELECT is_active, hwid FROM licenses WHERE key = ?", (license_key,)).fetchone()
+        if not license_data:
+            return None
+        conn.execute("DELETE FROM licenses WHERE key = ?", (license_key,))
+        return bool(license_data[0]), bool(license_data[1])
     
-    if c.rowcount == 0:
-        conn.close()
+    deleted = await database.run_transaction("admin", delete)
+    if deleted is None:
         raise HTTPException(status_code=404, detail="License not found")
-    
-    conn.commit()
-    conn.close()
+    cluster.bus.emit("licenses_changed", [license_key])
+    cluster.bus.emit("stats", "license_deleted", license_key, *deleted)
     
     return {"status": "success", "message": "License deleted successfully"}
 
+def license_selection_where(conn, selection: LicenseSelection):
+    """Translate a LicenseSelection into (where, params) for one set-based statement.
+
+    Danh sách key được nạp vào bảng tạm temp.bulk_keys thay vì IN (?, ?, ...)
+    để không đụng giới hạn số tham số của SQLite với lô lớn.
+    """
+    where, params = [], []
+    if selection.keys is not None:
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS bulk_keys (key TEXT PRIMARY KEY)")
+        conn.execute("DELETE FROM temp.bulk_keys")
+        conn.executemany("INSERT OR IGNORE INTO temp.bulk_keys (key) VALUES (?)",
+                         [(key,) for key in selection.keys])
+        where.append("key IN (SELECT key FROM temp.bulk_keys)")
+    for column, value in (("customer_name", selection.customer_name),
+                          ("customer_email", selection.customer_email)):
+        if value is not None:
+            where.append(f"{column} = ?")
+            params.append(value)
+    for column, lower, upper in (("created_ts", selection.created_from, selection.created_to),
+                                 ("expires_ts", selection.expires_from, selection.expires_to)):
+        if lower is not None:
+            where.append(f"{column} >= ?")
+            params.append(database.epoch(lower))
+        if upper is not None:
+            where.append(f"{column} < ?")
+            params.append(database.epoch(upper))
+    return " AND ".join(where), params
+
+def require_selection(selection: LicenseSelection):
+    # Không cho phép thao tác hàng loạt lên toàn bộ bảng do quên truyền bộ lọc
+    fields = selection.model_dump(include=set(LicenseSelection.model_fields))
+    if all(value is None for value in fields.values()):
+        raise HTTPException(status_code=400, detail="keys or at least one filter is required")
+
+@app.post("/api/licenses/bulk_update")
+async def bulk_update_licenses(update: LicenseBulkUpdate, current_admin: str = Depends(get_current_admin)):
+    """Set is_active and/or extend expiry for every selected license in one transaction"""
+    require_selection(update)
+    extend = update.days_to_add is not None and update.days_to_add > 0
+    if update.is_active is None and not extend:
+        raise HTTPException(status_code=400, detail="is_active or days_to_add is required")
+    
+    def apply(conn):
+        conn.execute("BEGIN IMMEDIATE")
+        where, params = license_selection_where(conn, update)
+        selected = conn.execute(f"SELECT key, is_active, expires_ts FROM licenses WHERE {where}", params).fetchall()
+        if not selected:
+            return selected
+        
+        updates, update_params = [], []
+        if update.is_active is not None:
+            updates.append("is_active = ?")
+            update_params.append(1 if update.is_active else 0)
+            # Mọi biểu thức SET đọc dòng cũ: chỉ license thật sự đổi trạng thái bị rút ngắn lease
+            updates.append("lease_limited_until = CASE WHEN is_active IS NOT ? THEN ? ELSE lease_limited_until END")
+            update_params.extend((1 if update.is_active else 0, leases.limited_until()))
+        if extend:
+            # Cộng ngày trên phần giây nguyên rồi nối lại phần micro giây, giữ đúng
+            # định dạng isoformat() (strftime sẽ làm tròn .999999 lên giây kế tiếp)
+            updates.append("expires_at = strftime('%Y-%m-%dT%H:%M:%S', substr(expires_at, 1, 19), ?) || substr(expires_at, 20)")
+            updates.append("expires_ts = expires_ts + ?")
+            update_params.extend((f"+{update.days_to_add} days", update.days_to_add * 86400))
+        conn.execute(f"UPDATE licenses SET {', '.join(updates)} WHERE {where}", update_params + params)
+        return selected
+    
+    selected = await database.run_transaction("admin", apply)
+    
+    keys = [row[0] for row in selected]
+    cluster.bus.emit("licenses_changed", keys)
+    active_delta = 0
+    if update.is_active is not None:
+        active_delta = sum(int(update.is_active) - int(bool(is_active)) for _, is_active, _ in selected)
+    expires_ts = {}
+    if extend:
+        expires_ts = {key: ts + update.days_to_add * 86400 for key, _, ts in selected if ts is not None}
+    if selected:
+        cluster.bus.emit("stats", "licenses_updated", active_delta, expires_ts)
+    
+    return {"status": "success", "updated": len(keys)}
+
+@app.post("/api/licenses/bulk_delete")
+async def bulk_delete_licenses(selection: LicenseSelection, current_admin: str = Depends(get_current_admin)):
+    """Delete every selected license in one transaction"""
+    require_selection(selection)
+    
+    def delete(conn):
+        conn.execute("BEGIN IMMEDIATE")
+        where, params = license_selection_where(conn, selection)
+        selected = conn.execute(f"SELECT key, is_active, hwid FROM licenses WHERE {where}", params).fetchall()
+        if selected:
+            conn.execute(f"DELETE FROM licenses WHERE {where}", params)
+        return selected
+    
+    selected = await database.run_transaction("admin", delete)
+    
+    keys = [row[0] for row in selected]
+    cluster.bus.emit("licenses_changed", keys)
+    if selected:
+        cluster.bus.emit("stats", "licenses_deleted", keys,
+                             sum(1 for _, is_active, _ in selected if is_active),
+                             sum(1 for _, _, hwid in selected if hwid))
+    
+    return {"status": "success", "deleted": len(keys)}
+
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    if cluster.WORKERS > 1:
+        # Mỗi worker import lại "server:app"; trạng thái chung đi qua cluster.bus
+        uvicorn.run("server:app", host="0.0.0.0", port=port, workers=cluster.WORKERS)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=port)
@@ -147,6 +147,7 @@ async function handleLogout() {
         
         // Stop auto-refresh
         if (refreshInterval) clearInterval(refreshInterval);
+        stopEventStream();
         
         // Show login screen
         adminDashboard.classList.add('d-none');
@@ -217,9 +218,17 @@ async function loadDashboardStats() {
     }
 }
 
-async function loadLicenses(activeOnly = false) {
+// Cursor trang tiếp theo của danh sách license (null = đã hết)
+let licensesCursor = null;
+let licensesActiveOnly = false;
+
+async function loadLicenses(activeOnly = false, cursor = null) {
     try {
-        const response = await fetch(`${API_BASE}/licenses?active_only=${activeOnly}`, {
+        let url = `${API_BASE}/licenses?active_only=${activeOnly}`;
+        if (cursor) {
+            url += `&cursor=${encodeURIComponent(cursor)}`;
+        }
+        const response = await fetch(url, {
             headers: {
                 'Authorization': `Bearer ${authToken}`
             }
@@ -228,8 +237,10 @@ async function loadLicenses(activeOnly = false) {
         if (response.ok) {
             const data = await response.json();
             const tbody = document.getElementById('licenses-tbody');
+            licensesActiveOnly = activeOnly;
+            licensesCursor = data.next_cursor;
             
-            tbody.innerHTML = data.licenses.map(license => `
+            const rows = data.licenses.map(license => `
                 <tr>
                     <td><code>${license.key}</code></td>
                     <td>${license.customer_name || 'N/A'}</td>
@@ -255,6 +266,28 @@ async function loadLicenses(activeOnly = false) {
                     </td>
                 </tr>
             `).join('');
+            
+            // Trang sau được nối vào bảng, thay cho dòng "Tải thêm" cũ
+            const moreRow = document.getElementById('licenses-load-more');
+            if (moreRow) {
+                moreRow.remove();
+            }
+            if (cursor) {
+                tbody.insertAdjacentHTML('beforeend', rows);
+            } else {
+                tbody.innerHTML = rows;
+            }
+            if (licensesCursor) {
+                tbody.insertAdjacentHTML('beforeend', `
+                    <tr id="licenses-load-more">
+                        <td colspan="8" class="text-center">
+                            <button class="btn btn-sm btn-outline-secondary" onclick="loadLicenses(licensesActiveOnly, licensesCursor)">
+                                Tải thêm
+                            </button>
+                        </td>
+                    </tr>
+                `);
+            }
         }
     } catch (error) {
         console.error('Error loading licenses:', error);
@@ -303,7 +336,7 @@ async function createLicense() {
 async function editLicense(licenseKey) {
     // Fetch current license data
     try {
-        const response = await fetch(`${API_BASE}/licenses`, {
+        const response = await fetch(`${API_BASE}/licenses?search=${encodeURIComponent(licenseKey)}`, {
             headers: {
                 'Authorization': `Bearer ${authToken}`
             }
@@ -391,10 +424,14 @@ async function deleteLicense(licenseKey) {
 }
 // Thêm hàm này trong script.js
 function startActiveUsersMonitor() {
-    // Refresh mỗi 10 giây
+    // Refresh mỗi 10 giây - chỉ khi không có kết nối push (/api/events)
     setInterval(() => {
+        if (isEventStreamOpen()) return;
         if (document.getElementById('chat-section').classList.contains('d-none') === false) {
             loadActiveUsers();
+            if (selectedUser) {
+                loadChatMessages(selectedUser.licenseKey, true);
+            }
         }
     }, 10000);
 }
@@ -412,6 +449,7 @@ function showAdminDashboard() {
     
     // Start monitors
     startActiveUsersMonitor(); // THÊM DÒNG NÀY
+    startEventStream();
     
     // Start auto-refresh
     if (refreshInterval) clearInterval(refreshInterval);
@@ -419,6 +457,103 @@ function showAdminDashboard() {
     
     showSection('dashboard');
 }
+// Push qua Server-Sent Events: tin nhắn mới / đã đọc được server đẩy xuống,
+// polling ở trên chỉ chạy khi stream không kết nối được
+let eventSource = null;
+let activeUsersRefreshTimer = null;
+
+function isEventStreamOpen() {
+    return eventSource !== null && eventSource.readyState === EventSource.OPEN;
+}
+
+let eventStreamStarting = false;
+
+async function startEventStream() {
+    if (!window.EventSource || eventSource || eventStreamStarting || !authToken) return;
+    
+    // Access token không đặt vào URL: đổi lấy ticket dùng một lần rồi mở stream bằng ticket
+    let ticket;
+    eventStreamStarting = true;
+    try {
+        const response = await fetch(`${API_BASE}/events/ticket`, {
+            method: 'POST',
+            headers: {
+                'Authorization': `Bearer ${authToken}`
+            }
+        });
+        if (!response.ok) return;  // token hết hạn...: tiếp tục polling
+        ticket = (await response.json()).ticket;
+    } catch (error) {
+        console.error('Error opening event stream:', error);
+        return;
+    } finally {
+        eventStreamStarting = false;
+    }
+    if (eventSource || !authToken) return;
+    
+    let reconnecting = false;
+    eventSource = new EventSource(`${API_BASE}/events?ticket=${encodeURIComponent(ticket)}`);
+    
+    eventSource.addEventListener('open', function() {
+        // Mở lại sau khi mất kết nối: lấy các tin đã lỡ trong lúc đó
+        if (reconnecting) {
+            scheduleActiveUsersRefresh();
+            if (selectedUser) loadChatMessages(selectedUser.licenseKey, true);
+        }
+    });
+    
+    eventSource.addEventListener('message', function(e) {
+        const message = JSON.parse(e.data);
+        if (selectedUser && message.license_key === selectedUser.licenseKey
+                && lastMessageId !== null && message.id > lastMessageId) {
+            const chatContainer = document.getElementById('chat-messages');
+            chatContainer.insertAdjacentHTML('beforeend', renderChatMessage(message));
+            chatContainer.scrollTop = chatContainer.scrollHeight;
+            lastMessageId = message.id;
+            if (message.sender_type === 'user') {
+                markMessagesAsRead(message.license_key);
+            }
+        }
+        scheduleActiveUsersRefresh();
+    });
+    
+    eventSource.addEventListener('read', scheduleActiveUsersRefresh);
+    
+    eventSource.addEventListener('resync', function() {
+        // Server báo client xử lý chậm: tải lại dữ liệu rồi kết nối lại
+        stopEventStream();
+        scheduleActiveUsersRefresh();
+        if (selectedUser) loadChatMessages(selectedUser.licenseKey, true);
+        setTimeout(startEventStream, 1000);
+    });
+    
+    eventSource.onerror = function() {
+        // EventSource tự kết nối lại với cùng URL nhưng ticket đã dùng nên bị từ chối
+        // và stream đóng hẳn: xin ticket mới; nếu không được (token hết hạn...) thì polling
+        reconnecting = true;
+        if (eventSource && eventSource.readyState === EventSource.CLOSED) {
+            eventSource = null;
+            setTimeout(startEventStream, 3000);
+        }
+    };
+}
+
+function stopEventStream() {
+    if (eventSource) {
+        eventSource.close();
+        eventSource = null;
+    }
+}
+
+function scheduleActiveUsersRefresh() {
+    if (document.getElementById('chat-section').classList.contains('d-none')) return;
+    if (activeUsersRefreshTimer) clearTimeout(activeUsersRefreshTimer);
+    activeUsersRefreshTimer = setTimeout(() => {
+        activeUsersRefreshTimer = null;
+        loadActiveUsers();
+    }, 500);
+}
+
 async function loadActiveUsers() {
     try {
         // LẤY DỮ LIỆU THỰC TỪ API - ĐÃ SỬA
@@ -498,6 +633,7 @@ async function loadActiveUsers() {
 
 async function selectUser(licenseKey, hwid) {
     selectedUser = { licenseKey, hwid };
+    lastMessageId = null;
     
     // Update UI
     document.getElementById('chat-with').textContent = `Chat với ${licenseKey}`;
@@ -538,30 +674,57 @@ async function markMessagesAsRead(licenseKey) {
     }
 }
 
-async function loadChatMessages(licenseKey) {
+// Cursor của tin nhắn cuối cùng đã hiển thị (next_cursor từ get_messages)
+let lastMessageId = null;
+
+function renderChatMessage(message) {
+    return `
+                <div class="message ${message.sender_type === 'admin' ? 'admin-message' : 'user-message'}">
+                    <div><strong>${message.sender_type}:</strong> ${message.message}</div>
+                    <div class="message-time">${formatDateTime(message.timestamp)}</div>
+                </div>
+            `;
+}
+
+async function loadChatMessages(licenseKey, incremental = false) {
     try {
-        console.log(`DEBUG: Loading messages for ${licenseKey}`); // Debug
-        const response = await fetch(`${API_BASE}/get_messages?license_key=${licenseKey}`, {
+        // Poll chỉ lấy tin mới hơn cursor thay vì tải lại cả lịch sử
+        const params = new URLSearchParams({ license_key: licenseKey });
+        const append = incremental && lastMessageId !== null;
+        if (append) {
+            params.set('since_id', lastMessageId);
+        }
+        
+        const response = await fetch(`${API_BASE}/get_messages?${params}`, {
             headers: {
                 'Authorization': `Bearer ${authToken}`
             }
         });
         
-        console.log(`DEBUG: Response status: ${response.status}`); // Debug
-        
         if (response.ok) {
             const data = await response.json();
-            console.log(`DEBUG: Received ${data.messages.length} messages`); // Debug
+            // Bỏ qua kết quả nếu admin đã chuyển sang user khác
+            if (!selectedUser || selectedUser.licenseKey !== licenseKey) return;
+            
             const chatContainer = document.getElementById('chat-messages');
+            // Tin đến qua SSE trong lúc chờ response đã được chèn: bỏ các id <= lastMessageId
+            const messages = append ? data.messages.filter(m => m.id > lastMessageId) : data.messages;
+            const html = messages.map(renderChatMessage).join('');
             
-            chatContainer.innerHTML = data.messages.map(message => `
-                <div class="message ${message.sender_type === 'admin' ? 'admin-message' : 'user-message'}">
-                    <div><strong>${message.sender_type}:</strong> ${message.message}</div>
-                    <div class="message-time">${formatDateTime(message.timestamp)}</div>
-                </div>
-            `).join('');
+            if (append) {
+                if (html) {
+                    chatContainer.insertAdjacentHTML('beforeend', html);
+                    chatContainer.scrollTop = chatContainer.scrollHeight;
+                }
+            } else {
+                chatContainer.innerHTML = html;
+                chatContainer.scrollTop = chatContainer.scrollHeight;
+            }
             
-            chatContainer.scrollTop = chatContainer.scrollHeight;
+            lastMessageId = append ? Math.max(lastMessageId, data.next_cursor) : data.next_cursor;
+            if (data.has_more) {
+                await loadChatMessages(licenseKey, true);
+            }
         }
     } catch (error) {
         console.error('Error loading chat messages:', error);
@@ -591,9 +754,9 @@ async function sendMessage() {
         });
         
         if (response.ok) {
-            // Clear input and reload messages
+            // Clear input and load new messages
             messageInput.value = '';
-            loadChatMessages(selectedUser.licenseKey);
+            loadChatMessages(selectedUser.licenseKey, true);
         } else {
             const error = await response.json();
             alert(`Lỗi: ${error.detail}`);
@@ -0,0 +1,286 @@
+# stats.py
+"""Materialized counters behind /api/status and /api/admin/stats.
+
+Handlers report what they changed (a license created, a message read, ...)
+through counters.apply() right after their transaction commits, so the
+dashboard endpoints read a handful of integers instead of running COUNT(*)
+over whole tables. The two time-dependent numbers, expired licenses and
+recent activity, are kept as deadline sets: each license sits in a heap with
+the moment it stops counting and reading the number only pops what has
+passed since the last read.
+
+A reconciliation thread recounts everything from the database every
+STATS_RECONCILE_SECONDS and replaces the in-memory state, so writes made
+outside the server (sqlite3 shell, another process) or a missed update can
+only make the numbers drift until the next pass.
+"""
+from datetime import datetime, timedelta
+from typing import Optional
+import heapq
+import math
+import os
+import sqlite3
+import threading
+import time
+
+import database
+import metrics
+
+STATS_RECONCILE_SECONDS = float(os.getenv("STATS_RECONCILE_SECONDS", 300))
+RECENT_ACTIVITY_WINDOW = timedelta(days=7)
+
+log = metrics.StructuredLogger("license_server")
+
+COUNTERS = ("total_licenses", "active_licenses", "activated_licenses",
+            "total_messages", "unread_messages", "total_admins", "active_admins")
+
+def _epoch(iso: Optional[str]) -> float:
+    # Cùng thang với cột *_ts (database.epoch); không có ngày hết hạn = không bao giờ hết hạn
+    return database.epoch(datetime.fromisoformat(iso)) if iso else math.inf
+
+class DeadlineSet:
+    """Keys with a deadline; count() returns how many deadlines are still ahead"""
+
+    def __init__(self):
+        self._deadlines = {}  # key -> deadline (database.epoch seconds)
+        self._heap = []       # (deadline, key), có thể chứa entry cũ đã bị thay
+
+    def set(self, key: str, deadline: float):
+        self._deadlines[key] = deadline
+        heapq.heappush(self._heap, (deadline, key))
+        # Mỗi lần đổi deadline để lại một entry cũ trong heap; dọn khi heap phình to
+        if len(self._heap) > 2 * len(self._deadlines) + 1024:
+            self._heap = [(d, k) for k, d in self._deadlines.items()]
+            heapq.heapify(self._heap)
+
+    def discard(self, key: str):
+        self._deadlines.pop(key, None)
+
+    def count(self, now: float) -> int:
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            deadline, key = heapq.heappop(heap)
+            if self._deadlines.get(key) == deadline:
+                del self._deadlines[key]
+        return len(self._deadlines)
+
+    def next_deadline(self, now: float) -> float:
+        """Earliest deadline after now, math.inf if none (an outdated heap entry can make it early, never late)"""
+        self.count(now)
+        return self._heap[0][0] if self._heap else math.inf
+
+class StatsCounters:
+    """Incrementally maintained license / chat / admin counts"""
+
+    def __init__(self, reconcile_interval: float):
+        self.reconcile_interval = reconcile_interval
+        self._counts = dict.fromkeys(COUNTERS, 0)
+        self._unexpired = DeadlineSet()  # key -> expires_at
+        self._recent = DeadlineSet()     # key -> last_used + RECENT_ACTIVITY_WINDOW
+        self._lock = threading.Lock()
+        self._journal = None  # các thay đổi xảy ra trong lúc reconcile đang đọc DB
+        self._snapshot_id = None  # id change_log lớn nhất khi snapshot của reconcile được mở
+        self._stopping = threading.Event()
+        self._thread = None
+        self.applied = 0
+        self.version = 0  # tăng mỗi lần số liệu có thể đổi, dùng làm ETag của /api/admin/stats
+        self.reconciles = 0
+        self.failed_reconciles = 0
+        self.reconciled_at = None
+        self.last_drift = {}
+
+    def apply(self, event: str, *args, change_id: Optional[int] = None):
+        """Record a committed change, e.g. apply("license_created", key, expires_at).
+
+        change_id: id trong change_log nếu thay đổi đến từ worker khác (cluster.bus.change_id).
+        """
+        handler = getattr(self, f"_on_{event}")
+        with self._lock:
+            handler(*args)
+            self.applied += 1
+            self.version += 1
+            if self._journal is not None:
+                self._journal.append((handler, args, change_id, self._snapshot_id is not None))
+
+    def snapshot(self, now: datetime) -> dict:
+        """Current counts plus expired_licenses and recent_activity as of now"""
+        ts = database.epoch(now)
+        with self._lock:
+            counts = dict(self._counts)
+            counts["expired_licenses"] = counts["total_licenses"] - self._unexpired.count(ts)
+            counts["recent_activity"] = self._recent.count(ts)
+        return counts
+
+    def next_change(self, now: datetime) -> float:
+        """database.epoch moment expired_licenses or recent_activity next changes without any write"""
+        ts = database.epoch(now)
+        with self._lock:
+            return min(self._unexpired.next_deadline(ts), self._recent.next_deadline(ts))
+
+    def next_expiry(self, now: datetime) -> float:
+        """database.epoch moment the next license expires"""
+        ts = database.epoch(now)
+        with self._lock:
+            return self._unexpired.next_deadline(ts)
+
+    # Các sự kiện; tham số là kiểu JSON được để có thể gửi qua process khác
+
+    def _on_license_created(self, key: str, expires_at: Optional[str]):
+        self._counts["total_licenses"] += 1
+        self._counts["active_licenses"] += 1
+        self._unexpired.set(key, _epoch(expires_at))
+
+    def _on_licenses_created(self, keys: list, expires_at: Optional[str]):
+        self._counts["total_licenses"] += len(keys)
+        self._counts["active_licenses"] += len(keys)
+        deadline = _epoch(expires_at)
+        for key in keys:
+            self._unexpired.set(key, deadline)
+
+    def _on_license_deleted(self, key: str, was_active: bool, was_activated: bool):
+        self._counts["total_licenses"] -= 1
+        self._counts["active_licenses"] -= int(was_active)
+        self._counts["activated_licenses"] -= int(was_activated)
+        self._unexpired.discard(key)
+        self._recent.discard(key)
+
+    def _on_license_updated(self, key: str, active_delta: int, expires_at: Optional[str]):
+        self._counts["active_licenses"] += active_delta
+        if expires_at is not None:
+            self._unexpired.set(key, _epoch(expires_at))
+
+    def _on_licenses_deleted(self, keys: list, active: int, activated: int):
+        self._counts["total_licenses"] -= len(keys)
+        self._counts["active_licenses"] -= active
+        self._counts["activated_licenses"] -= activated
+        for key in keys:
+            self._unexpired.discard(key)
+            self._recent.discard(key)
+
+    def _on_licenses_updated(self, active_delta: int, expires_ts: dict):
+        self._counts["active_licenses"] += active_delta
+        for key, deadline in expires_ts.items():
+            self._unexpired.set(key, deadline)
+
+    def _on_license_activated(self, key: str):
+        self._counts["activated_licenses"] += 1
+
+    def _on_license_used(self, key: str, last_used: str):
+        self._recent.set(key, _epoch(last_used) + RECENT_ACTIVITY_WINDOW.total_seconds())
+
+    def _on_message_created(self):
+        self._counts["total_messages"] += 1
+        self._counts["unread_messages"] += 1
+
+    def _on_messages_read(self, count: int):
+        self._counts["unread_messages"] -= count
+
+    def _on_messages_archived(self, count: int, unread: int):
+        self._counts["total_messages"] -= count
+        self._counts["unread_messages"] -= unread
+
+    def _on_admin_created(self):
+        self._counts["total_admins"] += 1
+        self._counts["active_admins"] += 1
+
+    def _on_admin_deleted(self, was_active: bool):
+        self._counts["total_admins"] -= 1
+        self._counts["active_admins"] -= int(was_active)
+
+    def reconcile(self, conn: sqlite3.Connection):
+        """Recount everything from the database and replace the in-memory state"""
+        with self._lock:
+            self._journal, self._snapshot_id = [], None
+        try:
+            counts, unexpired, recent = self._load(conn)
+        except BaseException:
+            with self._lock:
+                self._journal = self._snapshot_id = None
+            raise
+
+        with self._lock:
+            before = dict(self._counts)
+            self._counts, self._unexpired, self._recent = counts, unexpired, recent
+            # Áp lại lên số liệu mới những thay đổi chưa có trong snapshot: của worker khác
+            # thì theo id change_log (ghi sau khi dữ liệu đã commit), của process này thì
+            # những thay đổi áp sau khi snapshot đã mở (emit chạy ngay sau commit)
+            for handler, args, change_id, after_snapshot in self._journal:
+                if change_id > self._snapshot_id if change_id is not None else after_snapshot:
+                    handler(*args)
+            self._journal = self._snapshot_id = None
+            self.version += 1
+            self.last_drift = {name: self._counts[name] - before[name]
+                               for name in COUNTERS if self._counts[name] != before[name]}
+            self.reconciles += 1
+            self.reconciled_at = datetime.now().isoformat()
+
+    def _load(self, conn: sqlite3.Connection):
+        counts = {}
+        unexpired, recent = DeadlineSet(), DeadlineSet()
+        window = RECENT_ACTIVITY_WINDOW.total_seconds()
+
+        # Một read transaction để mọi con số cùng một snapshot; BEGIN (deferred) chưa mở
+        # snapshot, lần đọc đầu tiên mới mở nên đọc luôn id change_log để đánh dấu mốc
+        conn.execute("BEGIN")
+        try:
+            c = conn.cursor()
+            row = c.execute("SELECT seq FROM sqlite_sequence WHERE name = 'change_log'").fetchone()
+            with self._lock:
+                self._snapshot_id = row[0] if row else 0
+            c.execute("""SELECT COUNT(*), COALESCE(SUM(is_active = 1), 0),
+                                COALESCE(SUM(hwid != '' AND hwid IS NOT NULL), 0)
+                         FROM licenses""")
+            counts["total_licenses"], counts["active_licenses"], counts["activated_licenses"] = c.fetchone()
+
+            c.execute("SELECT COUNT(*), COALESCE(SUM(is_read = 0), 0) FROM chat_messages")
+            counts["total_messages"], counts["unread_messages"] = c.fetchone()
+
+            c.execute("SELECT COUNT(*), COALESCE(SUM(is_active = 1), 0) FROM admin_users")
+            counts["total_admins"], counts["active_admins"] = c.fetchone()
+
+            for key, expires_ts, last_used_ts in c.execute("SELECT key, expires_ts, last_used_ts FROM licenses"):
+                unexpired.set(key, math.inf if expires_ts is None else expires_ts)
+                if last_used_ts is not None:
+                    recent.set(key, last_used_ts + window)
+        finally:
+            conn.rollback()
+        return counts, unexpired, recent
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="stats-reconcile", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread.join()
+            self._thread = None
+
+    def stats(self) -> dict:
+        return {
+            "reconcile_interval_seconds": self.reconcile_interval,
+            "applied": self.applied,
+            "reconciles": self.reconciles,
+            "failed_reconciles": self.failed_reconciles,
+            "reconciled_at": self.reconciled_at,
+            "last_drift": self.last_drift
+        }
+
+    def _run(self):
+        while not self._stopping.wait(self.reconcile_interval):
+            started = time.monotonic()
+            try:
+                with database.connection() as conn:
+                    self.reconcile(conn)
+            except sqlite3.Error as e:
+                log.error("stats_reconcile_db_error", error=str(e))
+                self.failed_reconciles += 1
+                continue
+            if self.last_drift:
+                log.warning("stats_drift_corrected", drift=self.last_drift,
+                            ms=round((time.monotonic() - started) * 1000))
+
+counters = StatsCounters(STATS_RECONCILE_SECONDS)
@@ -0,0 +1,102 @@
+# throttle.py
+"""Token-bucket rate limiting and single-flight coalescing for hot endpoints.
+
+RateLimiter keeps one bucket per subject (client IP, license key, HWID):
+`rate` tokens per second refill up to `burst`, each request takes one, and a
+request finding the bucket empty is told how long until a token is back
+(sent as Retry-After). Buckets live in an LRU dict capped at max_subjects so
+a flood of distinct subjects cannot grow memory; an evicted bucket simply
+starts full again. Limits are per process: with WORKERS > 1 a client can get
+up to WORKERS times the configured rate.
+
+SingleFlight runs one coroutine per key at a time: callers arriving while
+it is in flight await the same task instead of starting their own, so a
+herd of identical check_license calls costs one database read. The task is
+shielded, so the caller that started it disconnecting does not cancel it
+for the others.
+"""
+from collections import OrderedDict
+import asyncio
+import threading
+import time
+
+class RateLimiter:
+    """Per-subject token buckets"""
+
+    def __init__(self, rate: float, burst: float, max_subjects: int):
+        self.rate = rate
+        self.burst = burst
+        self.max_subjects = max_subjects
+        self._buckets = OrderedDict()  # subject -> [tokens, updated (monotonic)]
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.limited = 0
+
+    def acquire(self, subject: str, cost: float = 1) -> float:
+        """Take cost tokens; returns 0 if allowed, else seconds until enough tokens refill"""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(subject)
+            if bucket is None:
+                bucket = self._buckets[subject] = [self.burst, now]
+                if len(self._buckets) > self.max_subjects:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(subject)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+
+            if bucket[0] >= cost:
+                bucket[0] -= cost
+                self.allowed += 1
+                return 0.0
+            self.limited += 1
+            return (cost - bucket[0]) / self.rate
+
+    def stats(self) -> dict:
+        return {
+            "rate": self.rate,
+            "burst": self.burst,
+            "subjects": len(self._buckets),
+            "max_subjects": self.max_subjects,
+            "allowed": self.allowed,
+            "limited": self.limited
+        }
+
+class SingleFlight:
+    """Coalesce concurrent calls with the same key into one task; event loop only"""
+
+    def __init__(self):
+        self._tasks = {}
+        self.flights = 0
+        self.coalesced = 0
+
+    async def do(self, key, factory):
+        """Await factory() once for every concurrent caller with this key.
+
+        Returns (result, shared); shared is True for callers that joined a
+        flight started by someone else.
+        """
+        task = self._tasks.get(key)
+        if task is not None:
+            self.coalesced += 1
+            return await asyncio.shield(task), True
+
+        task = asyncio.ensure_future(factory())
+        self._tasks[key] = task
+        task.add_done_callback(lambda done: self._finish(key, done))
+        self.flights += 1
+        return await asyncio.shield(task), False
+
+    def _finish(self, key, task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        if not task.cancelled():
+            task.exception()  # đánh dấu đã đọc lỗi khi mọi caller đã bỏ đi
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._tasks),
+            "flights": self.flights,
+            "coalesced": self.coalesced
+        }